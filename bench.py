@@ -0,0 +1,20 @@
+#!/usr/bin/env python3
+"""Run a benchmark of ftpvista/bench, e.g. ./bench.py listparser [args]"""
+import importlib
+import pkgutil
+import sys
+
+from ftpvista import bench
+
+
+def benchmarks():
+    return sorted(name[:-len('_bench')] for _, name, _ in pkgutil.iter_modules(bench.__path__)
+                  if name.endswith('_bench'))
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks():
+        print('Usage: %s <benchmark> [args]' % sys.argv[0])
+        print('Benchmarks : %s' % ', '.join(benchmarks()))
+        sys.exit(1)
+    module = importlib.import_module('ftpvista.bench.%s_bench' % sys.argv[1])
+    module.main(sys.argv[2:])
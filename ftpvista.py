@@ -6,14 +6,21 @@ import configparser
 import argparse
 import socket
 import os
+import queue
 import sys
 import traceback
 import shutil
 from colorama import init as colorama_init, Fore
 from datetime import timedelta
 from multiprocessing import Queue
-from ftpvista.index import Index, IndexUpdateCoordinator
+from ftpvista.archive import ServerArchive
+from ftpvista.bulkload import rebuild_index
+from ftpvista.index import IndexUpdateCoordinator
+from ftpvista.journal import Journal
+from ftpvista.merging import MergeScheduler, SizeTieredMerge, parse_window
 from ftpvista.multiprocess import OwnedProcess
+from ftpvista.shards import migrate_index, open_index
+from ftpvista.tagcache import TagCache
 from ftpvista import persist as ftpvista_persist
 from ftpvista.sniffer import *
 
@@ -41,6 +48,7 @@ def delete_server(config, sserver):
     persist = get_persist(config)
     index = get_index(config, persist)
     persist.set_index(index)
+    persist.set_archive(get_archive(config))
 
     server = persist.get_server_by_ip(sserver, False)
     if server is not None:
@@ -69,6 +77,11 @@ def clean_db(config, args):
         persist.initialize_store()
         os.remove(uri_strip)
         log.info("Database deleted")
+        # The archived documents belong to servers of the database
+        archive_uri = config.get('index', 'archive', fallback='')
+        if archive_uri != '' and os.path.isdir(archive_uri):
+            shutil.rmtree(archive_uri)
+            log.info("Archive deleted")
         init_django(config, args)
     else:
         log.info("No database : skipping.")
@@ -99,6 +112,43 @@ def clean_index(config, _):
         log.info("Index not found : skipping.")
 
 
+def rebuild_manifest(config, _):
+    logging.basicConfig(level=logging.DEBUG,
+                        format='[%(asctime)s] %(message)s')
+    log = logging.getLogger('ftpvista.rebuild_manifest')
+    log.info('Rebuilding the manifest of the index')
+
+    index = get_index(config, get_persist(config))
+    index.rebuild_manifest()
+    index.close()
+
+
+def shard_index(config, _):
+    logging.basicConfig(level=logging.DEBUG,
+                        format='[%(asctime)s] %(message)s')
+    log = logging.getLogger('ftpvista.shard_index')
+    layout = config.get('index', 'layout', fallback='single')
+    if layout == 'single':
+        log.error('Set the sharded layout to use in the [index] section first')
+        return
+    log.info('Moving the index to the %s layout' % layout)
+    migrate_index(config.get('index', 'uri'), get_persist(config), layout,
+                  config.getint('index', 'partitions', fallback=8))
+
+
+def rebuild(config, args):
+    logging.basicConfig(level=logging.DEBUG,
+                        format='[%(asctime)s] %(message)s')
+    log = logging.getLogger('ftpvista.rebuild_index')
+    index_uri = config.get('index', 'uri')
+    log.info('Rebuilding the index with %s processes' % (args.procs or 'one per CPU,'))
+    rebuild_index(index_uri, args.procs, args.limitmb)
+    layout = config.get('index', 'layout', fallback='single')
+    if layout != 'single':
+        migrate_index(index_uri, get_persist(config), layout,
+                      config.getint('index', 'partitions', fallback=8))
+
+
 def check_online(config):
     handler = logging.FileHandler(config.get('logs', 'online_checker'), encoding='utf-8')
     logging.basicConfig(level=logging.DEBUG,
@@ -111,14 +161,15 @@ def check_online(config):
     persist = ftpvista_persist.FTPVistaPersist(db_uri)
     persist.initialize_store()
 
-    index_uri = config.get('index', 'uri')
-    index = Index(index_uri, persist)
+    index = get_index(config, persist)
     persist.set_index(index)
+    persist.set_archive(get_archive(config))
 
     update_interval = int(config.get('online_checker', 'update_interval'))
     purge_interval = int(config.get('online_checker', 'purge_interval'))
+    archive_interval = config.getint('online_checker', 'archive_interval', fallback=90)
 
-    persist.launch_online_checker(update_interval, purge_interval)
+    persist.launch_online_checker(update_interval, purge_interval, archive_interval)
 
 
 def get_persist(config):
@@ -128,9 +179,30 @@ def get_persist(config):
     return persist
 
 
-def get_index(config, persist):
+def get_index(config, persist, journaled=False):
     index_uri = config.get('index', 'uri')
-    return Index(index_uri, persist)
+    journal = None
+    if journaled and config.getboolean('indexer', 'journal', fallback=True):
+        if not os.path.isdir(index_uri):
+            os.makedirs(index_uri)
+        journal = Journal(index_uri, config.getint('indexer', 'journal_sync_every', fallback=100),
+                          config.getint('indexer', 'journal_sync_interval', fallback=5))
+    return open_index(index_uri, persist, config.get('index', 'layout', fallback='single'),
+                      config.getint('index', 'partitions', fallback=8), journal)
+
+
+def get_archive(config):
+    archive_uri = config.get('index', 'archive', fallback='')
+    if archive_uri == '':
+        return None
+    return ServerArchive(archive_uri, config.getint('index', 'archive_max_size', fallback=1024) * 1024 * 1024)
+
+
+def get_tag_cache(config):
+    tag_cache_uri = config.get('indexer', 'tag_cache', fallback='')
+    if tag_cache_uri == '':
+        return None
+    return TagCache(tag_cache_uri, config.getint('indexer', 'tag_cache_max_entries', fallback=1000000))
 
 
 def main_process(config, ftpserver_queue):
@@ -149,19 +221,80 @@ def main_process(config, ftpserver_queue):
     # Create the DB to store informations about the FTP servers
     persist = get_persist(config)
 
-    # Full-text index for storing terms from the files found on the servers
-    index = get_index(config, persist)
+    # Full-text index for storing terms from the files found on the servers,
+    # the changes not commited yet are journaled by this process only
+    index = get_index(config, persist, journaled=True)
+    persist.set_index(index)
+    # The documents of the servers offline for a long time, restored when
+    # they come back
+    persist.set_archive(get_archive(config))
 
     # This defines how and at which period to perform updates from the servers
     min_update_interval = config.getint('indexer', 'min_update_interval')
 
     max_depth = config.getint('indexer', 'max_depth')
-    update_coordinator = IndexUpdateCoordinator(persist, index, timedelta(hours=min_update_interval), max_depth)
+
+    # Number of simultaneous connections used to crawl a server
+    scan_connections = config.getint('indexer', 'scan_connections', fallback=1)
+
+    # Interrupted scans are resumed from their last checkpoint
+    checkpoint_interval = config.getint('indexer', 'checkpoint_interval', fallback=0)
+    checkpoint_max_age = config.getint('indexer', 'checkpoint_max_age', fallback=24)
+
+    # Unchanged directories are not listed again, but every full_rescan_every scans
+    full_rescan_every = config.getint('indexer', 'full_rescan_every', fallback=0)
+
+    # Try to get the whole tree of the servers with a single LIST -R or STAT -R
+    recursive_listing = config.getboolean('indexer', 'recursive_listing', fallback=False)
+
+    # Days during which the features found on a server are trusted
+    capabilities_max_age = config.getint('indexer', 'capabilities_max_age', fallback=7)
+
+    # Segments are merged after each update, or in the background
+    merge_policy = config.get('indexer', 'merge_policy', fallback='tiered')
+
+    # The documents of a large server are commited by batches during its update
+    commit_every = config.getint('indexer', 'commit_every', fallback=50000)
+    commit_interval = config.getint('indexer', 'commit_interval', fallback=600)
+
+    # Number of audio files of a server whose tags are fetched at once
+    tag_fetch_concurrency = config.getint('indexer', 'tag_fetch_concurrency', fallback=8)
+
+    # The tags already fetched, from this server or another one
+    tag_cache = get_tag_cache(config)
+    update_coordinator = IndexUpdateCoordinator(persist, index, timedelta(hours=min_update_interval), max_depth,
+                                                scan_connections, checkpoint_interval,
+                                                timedelta(hours=checkpoint_max_age), full_rescan_every,
+                                                recursive_listing, timedelta(days=capabilities_max_age),
+                                                merge_policy, commit_every, commit_interval,
+                                                tag_fetch_concurrency, tag_cache)
+    if merge_policy == 'tiered':
+        optimize_interval = config.getint('indexer', 'optimize_interval', fallback=168)
+        MergeScheduler(index,
+                       SizeTieredMerge(config.getint('indexer', 'merge_factor', fallback=10)),
+                       parse_window(config.get('indexer', 'merge_window', fallback='')),
+                       config.getint('indexer', 'merge_idle_rate', fallback=10),
+                       config.getint('indexer', 'merge_check_interval', fallback=300),
+                       timedelta(hours=optimize_interval) if optimize_interval > 0 else None).start()
+
+    # 'ftplib' scans the servers one at a time, 'asyncio' scans all the
+    # servers waiting in the queue at the same time
+    scan_engine = config.get('indexer', 'scan_engine', fallback='ftplib')
+    max_connections = config.getint('indexer', 'async_max_connections', fallback=64)
 
     log.info('Init done, running the update coordinator ...')
     while True:
         # Wait for an FTP server to be detected and update it
-        update_coordinator.update_server(ftpserver_queue.get())
+        if scan_engine == 'asyncio':
+            server_addrs = [ftpserver_queue.get()]
+            while True:
+                try:
+                    server_addrs.append(ftpserver_queue.get_nowait())
+                except queue.Empty:
+                    break
+            update_coordinator.update_servers(server_addrs, max_connections)
+        else:
+            update_coordinator.update_server(ftpserver_queue.get())
 
 
 def launch(config, func, args, category='indexer'):
@@ -199,6 +332,15 @@ def main(args):
         return 0
     elif args.action == 'init':
         launch(config, init_django, (config, args), 'online_checker')
+    elif args.action == 'rebuild-manifest':
+        launch(config, rebuild_manifest, (config, args))
+        return 0
+    elif args.action == 'shard-index':
+        launch(config, shard_index, (config, args))
+        return 0
+    elif args.action == 'rebuild-index':
+        launch(config, rebuild, (config, args))
+        return 0
 
     # From now we can set the application to use a different user id and group id
     # much better for security reasons
@@ -253,6 +395,14 @@ def init():
     # delete
     parser_delete = subparsers.add_parser('delete', help='Manually delete a server from the index')
     parser_delete.add_argument("server", help="IP of the server to delete")
+    # rebuild-manifest
+    subparsers.add_parser('rebuild-manifest', help='Rebuild the list of the indexed files from the index')
+    # shard-index
+    subparsers.add_parser('shard-index', help='Move a single index to the sharded layout of the config file')
+    # rebuild-index
+    parser_rebuild = subparsers.add_parser('rebuild-index', help='Rewrite the whole index with the current schema, with several processes')
+    parser_rebuild.add_argument("--procs", type=int, default=None, help="Number of processes, one per CPU by default")
+    parser_rebuild.add_argument("--limitmb", type=int, default=128, help="Memory used by each process, in MB")
 
     args = parser.parse_args()
 
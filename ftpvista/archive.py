@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""Cold archive of the documents of the servers offline for a long time.
+
+A server offline for `purge_interval` days is first hidden : its
+documents stay in the index but out of the search results. Once offline
+for `archive_interval` days, its documents, with their tags, are moved
+from the index to a file of the archive. When the server comes back, the
+documents are put back in the index before it is scanned again, so that
+only the files changed in the meantime are indexed and have their tags
+fetched.
+
+The archive has a maximum size, the oldest archives are evicted to stay
+below it, their servers are then forgotten for good.
+"""
+
+import gzip
+import logging
+import os
+import pickle
+
+
+class ServerArchive(object):
+    SUFFIX = '.pickle.gz'
+
+    def __init__(self, directory, max_size=0):
+        """
+        :Parameters:
+            -`directory`: where the archives are stored
+            -`max_size`: maximum size of the archive in bytes, 0 for no limit
+        """
+        self.log = logging.getLogger('ftpvista.archive')
+        self._directory = directory
+        self._max_size = max_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, server_id):
+        return os.path.join(self._directory, '%d%s' % (int(server_id), self.SUFFIX))
+
+    def __contains__(self, server_id):
+        return os.path.isfile(self.path(server_id))
+
+    def store(self, server_id, documents):
+        """Archive the given documents of a server, replacing its previous
+        archive. Returns the number of documents."""
+        path = self.path(server_id)
+        count = 0
+        with gzip.open(path + '.tmp', 'wb') as f:
+            for fields in documents:
+                pickle.dump(fields, f, pickle.HIGHEST_PROTOCOL)
+                count += 1
+        os.replace(path + '.tmp', path)
+        self.log.info('%d documents of server %s archived, %d bytes'
+                      % (count, server_id, os.path.getsize(path)))
+        return count
+
+    def load(self, server_id):
+        """Yields the archived documents of a server."""
+        with gzip.open(self.path(server_id), 'rb') as f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    return
+
+    def remove(self, server_id):
+        if server_id in self:
+            os.remove(self.path(server_id))
+
+    def archives(self):
+        """Returns the (mtime, size, server_id) of each archive, the
+        oldest first."""
+        archives = []
+        for name in os.listdir(self._directory):
+            if name.endswith(self.SUFFIX):
+                st = os.stat(os.path.join(self._directory, name))
+                archives.append((st.st_mtime, st.st_size, int(name[:-len(self.SUFFIX)])))
+        return sorted(archives)
+
+    def size(self):
+        return sum(size for _, size, _ in self.archives())
+
+    def evict(self):
+        """Remove the oldest archives until the archive is no larger than
+        its maximum size. Returns the ids of the servers evicted."""
+        if self._max_size <= 0:
+            return []
+        archives = self.archives()
+        total = sum(size for _, size, _ in archives)
+        evicted = []
+        while total > self._max_size and len(archives) > 0:
+            _, size, server_id = archives.pop(0)
+            self.remove(server_id)
+            total -= size
+            evicted.append(server_id)
+            self.log.info('Archive of server %d evicted, %d bytes' % (server_id, size))
+        return evicted
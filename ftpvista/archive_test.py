@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from . import archive
+from . import index
+from . import persist
+
+
+MTIME = datetime(2015, 1, 2, 3, 4, 5)
+
+
+class FakeTools(object):
+    def __init__(self):
+        self.online = set()
+
+    def is_ftp_open(self, ip_addr):
+        return ip_addr in self.online
+
+
+class TestServerArchive(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testStore(self):
+        arch = archive.ServerArchive(self.dir)
+        docs = [{'path': '/a.mp3', 'mtime': MTIME, 'audio_title': 'title'}, {'path': '/b.txt'}]
+        self.assertEqual(arch.store(1, iter(docs)), 2)
+        self.assertIn(1, arch)
+        self.assertNotIn(2, arch)
+        self.assertEqual(list(arch.load(1)), docs)
+        arch.remove(1)
+        self.assertNotIn(1, arch)
+        self.assertEqual(arch.size(), 0)
+
+    def testEvict(self):
+        arch = archive.ServerArchive(self.dir)
+        for server_id in (3, 1, 2):
+            arch.store(server_id, [{'path': '/%d-%d' % (server_id, i)} for i in range(100)])
+            os.utime(arch.path(server_id), (1000 + len(arch.archives()), 1000 + len(arch.archives())))
+        self.assertEqual(arch.evict(), [])
+
+        arch = archive.ServerArchive(self.dir, max_size=arch.size() - 1)
+        self.assertEqual(arch.evict(), [3])
+        self.assertEqual([server_id for _, _, server_id in arch.archives()], [1, 2])
+
+
+class TestTombstones(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.persist = persist.FTPVistaPersist('sqlite://')
+        self.persist.initialize_store()
+        self.persist._tools = FakeTools()
+        self.index = index.Index(os.path.join(self.dir, 'index'), self.persist)
+        self.persist.set_index(self.index)
+        self.persist.set_archive(archive.ServerArchive(os.path.join(self.dir, 'archive')))
+
+        self.server = self.persist.get_server_by_ip('10.0.0.1')
+        self.other = self.persist.get_server_by_ip('10.0.0.2')
+        for server in (self.server, self.other):
+            for path in ('/a.mp3', '/b.txt'):
+                self.index.add_document(str(server.get_server_id()), path[1:], path, 10, MTIME,
+                                        audio_title='title' if path.endswith('mp3') else None)
+        self.index.commit()
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.dir)
+
+    def offline(self, server, days):
+        server.update_last_seen(datetime.now() - timedelta(days=days))
+        self.persist.save()
+
+    def testHideArchiveRestore(self):
+        server_id = self.server.get_server_id()
+        self.persist._tools.online.add(self.other.get_ip_addr())
+        self.offline(self.server, 31)
+        self.persist.check(30, 90)
+        self.assertEqual(self.persist.get_hidden_server_ids(), [server_id])
+        self.assertEqual(self.persist.get_servers(hidden=False), [self.other])
+        # Still indexed
+        self.assertEqual(len(self.index.get_indexed_files(server_id)), 2)
+
+        self.offline(self.server, 91)
+        self.persist.check(30, 90)
+        self.assertEqual(self.index.get_indexed_files(server_id), {})
+        self.assertIn(server_id, self.persist.archive)
+        self.assertEqual(len(self.index.get_indexed_files(self.other.get_server_id())), 2)
+
+        # Back online, the checker leaves the restoration to the indexer
+        self.persist._tools.online.add(self.server.get_ip_addr())
+        self.persist.check(30, 90)
+        self.assertEqual(self.persist.get_hidden_server_ids(), [server_id])
+
+        self.assertEqual(self.persist.restore_server(self.server), 2)
+        self.assertEqual(self.persist.get_hidden_server_ids(), [])
+        self.assertNotIn(server_id, self.persist.archive)
+        with self.index._idx.searcher() as searcher:
+            self.assertEqual(searcher.document(path_key=index.Index.path_key(server_id, '/a.mp3'))['audio_title'],
+                             'title')
+
+        # Only the changed files are indexed again
+        update = index.ServerUpdate(self.index, server_id)
+        to_index = update.filter([('/a.mp3', 10, MTIME), ('/b.txt', 10, MTIME + timedelta(days=1))])
+        self.assertEqual([path for path, _, _ in to_index], ['/b.txt'])
+
+    def testShownAgain(self):
+        self.offline(self.server, 31)
+        self.persist.check(30, 90)
+        self.persist._tools.online.add(self.server.get_ip_addr())
+        self.persist.check(30, 90)
+        self.assertEqual(self.persist.get_hidden_server_ids(), [])
+        self.assertEqual(self.persist.restore_server(self.server), 0)
+
+    def testNoArchive(self):
+        self.persist.set_archive(None)
+        self.offline(self.server, 91)
+        self.persist.check(30, 90)
+        self.persist.check(30, 90)
+        self.assertEqual(self.persist.get_servers(), [self.other])
+        self.assertEqual(self.index.get_indexed_files(self.server.get_server_id()), {})
+
+    def testEviction(self):
+        self.persist.archive = archive.ServerArchive(os.path.join(self.dir, 'archive'), max_size=1)
+        self.offline(self.server, 91)
+        self.persist.check(30, 90)
+        self.persist.check(30, 90)
+        # Larger than the archive, forgotten
+        self.assertEqual(self.persist.get_servers(), [self.other])
+        self.assertEqual(self.persist.archive.archives(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
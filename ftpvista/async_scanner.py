@@ -0,0 +1,392 @@
+# -*- coding: utf-8 -*-
+"""asyncio FTP scanning layer, used to sweep many FTP servers at once.
+
+Only the small subset of the FTP protocol needed to crawl a server
+anonymously is implemented : login, passive data connections, MLSD and
+the LIST fallback used by FTPScanner.
+"""
+
+import asyncio
+import logging
+import re
+
+from .filelist import FileList
+from .scanner import BaseScanner, TooDeepError, parse_list_line
+
+
+class AsyncFTPError(Exception):
+    """An error reply (4xx or 5xx) sent by the server."""
+
+    def __init__(self, response):
+        self.response = response
+        self.code = response[:3]
+
+    def __str__(self):
+        return self.response
+
+    def is_permanent(self):
+        return self.code.startswith('5')
+
+
+class AsyncFTPReplyError(AsyncFTPError):
+    """A reply the client did not expect, like ftplib.error_reply."""
+
+    def is_permanent(self):
+        return False
+
+
+class AsyncFTP(object):
+    """Minimal asyncio FTP client."""
+
+    PASV_PATTERN = re.compile(r'(\d+),(\d+),(\d+),(\d+),(\d+),(\d+)')
+
+    def __init__(self, host, port=21, timeout=30, encoding='utf-8'):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.encoding = encoding
+        self._reader = None
+        self._writer = None
+        # Facts last asked with OPTS MLST on this connection
+        self._mlst_facts = None
+
+    async def connect(self):
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.timeout)
+        return await self.getresp()
+
+    async def _readline(self, reader):
+        line = await asyncio.wait_for(reader.readline(), self.timeout)
+        if not line:
+            raise EOFError('Connection closed by %s' % self.host)
+        return line.decode(self.encoding, 'replace').rstrip('\r\n')
+
+    async def getresp(self):
+        line = await self._readline(self._reader)
+        code = line[:3]
+        lines = [line]
+        if line[3:4] == '-':
+            # Multi-line reply, ends with the same code followed by a space
+            while not (line[:3] == code and line[3:4] != '-'):
+                line = await self._readline(self._reader)
+                lines.append(line)
+        response = '\n'.join(lines)
+        if code[:1] in ('4', '5'):
+            raise AsyncFTPError(response)
+        return response
+
+    async def sendcmd(self, cmd):
+        self._writer.write((cmd + '\r\n').encode(self.encoding))
+        await self._writer.drain()
+        return await self.getresp()
+
+    async def login(self, user='anonymous', passwd='anonymous@'):
+        response = await self.sendcmd('USER %s' % user)
+        if response[:1] == '3':
+            response = await self.sendcmd('PASS %s' % passwd)
+        return response
+
+    async def cwd(self, dir):
+        return await self.sendcmd('CWD %s' % dir)
+
+    async def retrlines(self, cmd):
+        """Run `cmd` over a passive data connection, returns the lines sent.
+
+        The replies are handled like ftplib does in ntransfercmd and
+        retrlines, an unexpected one raises an AsyncFTPReplyError.
+        """
+        await self.sendcmd('TYPE A')
+        response = await self.sendcmd('PASV')
+        match = self.PASV_PATTERN.search(response)
+        if response[:3] != '227' or match is None:
+            raise AsyncFTPReplyError(response)
+        numbers = [int(n) for n in match.groups()]
+        # Like ftplib, do not trust the address sent by the server
+        data_port = (numbers[4] << 8) + numbers[5]
+        data_reader, data_writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, data_port), self.timeout)
+        try:
+            response = await self.sendcmd(cmd)
+            # Some servers send a 200 reply before the 150 one, which is
+            # discarded
+            if response[:1] == '2':
+                response = await self.getresp()
+            if response[:1] != '1':
+                raise AsyncFTPReplyError(response)
+
+            lines = []
+            while True:
+                line = await asyncio.wait_for(data_reader.readline(), self.timeout)
+                if not line:
+                    break
+                lines.append(line.decode(self.encoding, 'replace').rstrip('\r\n'))
+        finally:
+            data_writer.close()
+        response = await self.getresp()
+        if response[:1] != '2':
+            raise AsyncFTPReplyError(response)
+        return lines
+
+    async def mlsd(self, path='', facts=[]):
+        """List `path` with MLSD, the facts being asked once per
+        connection."""
+        if facts and facts != self._mlst_facts:
+            await self.sendcmd('OPTS MLST ' + ';'.join(facts) + ';')
+            self._mlst_facts = list(facts)
+        cmd = 'MLSD %s' % path if path else 'MLSD'
+        entries = []
+        for line in await self.retrlines(cmd):
+            facts_found, _, name = line.rstrip().partition(' ')
+            entry = {}
+            for fact in facts_found[:-1].split(';'):
+                key, _, value = fact.partition('=')
+                entry[key.lower()] = value
+            entries.append((name, entry))
+        return entries
+
+    async def quit(self):
+        try:
+            await self.sendcmd('QUIT')
+        finally:
+            self.close()
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+class AsyncFTPScanner(BaseScanner):
+    """Crawl a FTP server with asyncio, see FTPScanner for the semantics."""
+
+    def __init__(self, host, port=21, connections=1, limiter=None, timeout=30):
+        """
+        :Parameters:
+            -`host`: the server IP address
+            -`port`: the server FTP port
+            -`connections`: number of connections used to crawl the server
+            -`limiter`: optional asyncio.Semaphore shared between several
+                        scanners to limit the total number of connections
+            -`timeout`: network timeout in seconds
+        """
+        self.host = host
+        self.port = port
+        self.connections = max(1, connections)
+        self.limiter = limiter
+        self.timeout = timeout
+        # False once the server answered that it does not support MLSD
+        self.mlsd = None
+        self.log = logging.getLogger('ftpvista.ascanner.%s' % self.host.replace('.', '_'))
+
+    async def connect(self):
+        ftp = AsyncFTP(self.host, self.port, self.timeout)
+        try:
+            await ftp.connect()
+            await ftp.login()
+            try:
+                await ftp.sendcmd('OPTS UTF8 ON')
+            except AsyncFTPError as e:
+                # Not supported, the names are decoded anyway
+                if not e.is_permanent():
+                    raise
+        except Exception:
+            ftp.close()
+            raise
+        return ftp
+
+    async def list_files(self, ftp, dir):
+        extra_dirs = []
+        files = FileList()
+
+        if self.mlsd is not False:
+            try:
+                for filename, facts in await ftp.mlsd(dir, facts=["type", "size", "perm", "modify"]):
+                    self.add_entry(dir, filename, facts, files, extra_dirs)
+                self.mlsd = True
+                return files, extra_dirs
+            except AsyncFTPError as e:
+                if e.code not in ('500', '501', '502'):
+                    raise
+                if self.mlsd is None:
+                    self.mlsd = False
+
+        # LIST does not take paths with spaces on every server
+        await ftp.cwd(dir)
+        for line in await ftp.retrlines('LIST'):
+            entry = parse_list_line(line)
+            if entry is not None:
+                self.add_entry(dir, entry[0], entry[1], files, extra_dirs)
+
+        return files, extra_dirs
+
+    async def _scan(self, ignores, max_depth):
+        cond = asyncio.Condition()
+        dirs = set([('/', 0)])          # (path, depth) we need to process
+        visited = set()                 # paths already processed or being processed
+        files = FileList()
+        state = {'busy': 0, 'error': None}
+        retried = set()                 # paths listed again after an error
+
+        async def next_dir():
+            # Must be called with the condition acquired
+            while True:
+                await cond.wait_for(lambda: len(dirs) > 0 or state['busy'] == 0 or
+                                    state['error'] is not None)
+                if state['error'] is not None or len(dirs) == 0:
+                    return None
+
+                cwd, depth = dirs.pop()
+
+                if cwd in ignores:
+                    self.log.info('Skipping %s' % cwd)
+                    continue
+
+                if cwd in visited:
+                    self.log.warn('Loop detected, %s was already visited' % cwd)
+                    continue
+
+                visited.add(cwd)
+                state['busy'] += 1
+                return cwd, depth
+
+        async def work(ftp):
+            while True:
+                async with cond:
+                    item = await next_dir()
+                    if item is None:
+                        cond.notify_all()
+                        return ftp
+                cwd, depth = item
+
+                try:
+                    cwd_files, cwd_dirs = await self.list_files(ftp, cwd)
+                except (AsyncFTPError, OSError, EOFError, asyncio.TimeoutError) as e:
+                    self.log.error('Unable to list %s, reconnecting : %r' % (cwd, e))
+                    # Still busy while reconnecting, the other connections
+                    # must not end the scan before the directory is queued
+                    # again
+                    ftp.close()
+                    ftp = await self.connect()
+                    async with cond:
+                        visited.discard(cwd)
+                        state['busy'] -= 1
+                        # Listed again once on the new connection, its files
+                        # would be deleted from the index otherwise
+                        if cwd not in retried:
+                            retried.add(cwd)
+                            dirs.add((cwd, depth))
+                        cond.notify_all()
+                    continue
+
+                async with cond:
+                    state['busy'] -= 1
+                    if depth < max_depth:
+                        for d in cwd_dirs:
+                            dirs.add((d, depth+1))
+                    else:
+                        state['error'] = TooDeepError(depth, cwd)
+                        cond.notify_all()
+                        self._too_deep(depth, cwd)
+                    files.extend(cwd_files)
+                    cond.notify_all()
+
+                    self.log.debug('%d directories left to scan' % len(dirs))
+
+        async def run(n, connected=None):
+            if self.limiter is not None:
+                await self.limiter.acquire()
+            try:
+                try:
+                    ftp = await self.connect()
+                except (AsyncFTPError, OSError, EOFError, asyncio.TimeoutError) as e:
+                    if n == 0:
+                        raise
+                    # The server may limit the number of connections per
+                    # client, just continue with a smaller pool
+                    self.log.warn('Unable to open an extra connection: %s' % e)
+                    return
+                finally:
+                    if connected is not None:
+                        connected.set()
+                ftp = await work(ftp)
+                await ftp.quit()
+            except TooDeepError:
+                pass
+            except Exception as e:
+                async with cond:
+                    if state['error'] is None:
+                        state['error'] = e
+                    cond.notify_all()
+            finally:
+                if self.limiter is not None:
+                    self.limiter.release()
+
+        # Wait for the first connection before opening the other ones so
+        # that login errors are reported like in the sequential scan
+        connected = asyncio.Event()
+        first = asyncio.ensure_future(run(0, connected))
+        await connected.wait()
+        others = [run(n) for n in range(1, self.connections) if state['error'] is None]
+        await asyncio.gather(first, *others)
+
+        if state['error'] is not None:
+            raise state['error']
+        return files
+
+    async def scan(self, ignores=None, max_depth=50):
+        self.log.info('Starting FTP scan.')
+        try:
+            files = await self._scan(set(ignores or []), max_depth)
+            self.log.info('Scan complete.')
+            return files
+        except AsyncFTPError as e:
+            if e.is_permanent():
+                self.log.error('Permission error during scan, probably couldn\'t log in.')
+                self.log.error('Error was: %s' % e)
+            else:
+                self.log.error('Error while scanning FTP: %s' % e)
+            self.log.error('Scan terminated.')
+        except (OSError, EOFError, asyncio.TimeoutError) as e:
+            self.log.error('Error while scanning FTP: %s' % e)
+            self.log.error('Scan terminated.')
+
+
+class AsyncScanPool(object):
+    """Scan many FTP servers at the same time in the current process."""
+
+    def __init__(self, max_connections=64, connections_per_server=2, port=21, timeout=30):
+        """
+        :Parameters:
+            -`max_connections`: maximum number of connections opened at once,
+                                all servers included
+            -`connections_per_server`: maximum number of connections opened
+                                       on each server
+        """
+        self.log = logging.getLogger('ftpvista.ascanner')
+        self.max_connections = max_connections
+        self.connections_per_server = connections_per_server
+        self.port = port
+        self.timeout = timeout
+
+    async def scan_all(self, hosts, ignores=None, max_depth=50):
+        """Scan every host, returns a {host => files} mapping.
+
+        The files of a host are None if its scan failed.
+        """
+        limiter = asyncio.Semaphore(self.max_connections)
+
+        async def scan_one(host):
+            scanner = AsyncFTPScanner(host, self.port, self.connections_per_server,
+                                      limiter, self.timeout)
+            try:
+                return await scanner.scan(ignores, max_depth)
+            except TooDeepError as e:
+                self.log.error('Scan of %s aborted: %s' % (host, e))
+                return None
+
+        hosts = list(hosts)
+        results = await asyncio.gather(*[scan_one(host) for host in hosts])
+        return dict(zip(hosts, results))
+
+    def scan(self, hosts, ignores=None, max_depth=50):
+        return asyncio.run(self.scan_all(hosts, ignores, max_depth))
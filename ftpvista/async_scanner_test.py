@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+import ftplib
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+import logging
+
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import FTPHandler
+from pyftpdlib.servers import FTPServer
+
+from . import async_scanner
+from . import scanner
+
+
+TREE = {
+    'root.txt': 10,
+    'music/a.mp3': 20,
+    'music/album/b.mp3': 30,
+    'music/album/c d.mp3': 40,
+    'videos/e.avi': 50,
+}
+
+
+def start_ftp_server(root, handler_class=FTPHandler):
+    """Serve `root` anonymously on a free port, returns the server."""
+    authorizer = DummyAuthorizer()
+    authorizer.add_anonymous(root)
+    handler = type('TestHandler', (handler_class,), {'authorizer': authorizer})
+    server = FTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, kwargs={'timeout': 0.1})
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class NoMLSDHandler(FTPHandler):
+    """A FTP handler for servers not supporting MLSD"""
+    def ftp_MLSD(self, path):
+        self.respond('501 Unknown command.')
+
+
+class RecordingHandler(FTPHandler):
+    """A FTP handler recording the commands received, and answering some
+    of them like less common servers.
+
+    `failures` maps a path to the number of times listing it must fail.
+    """
+    commands = []
+    no_utf8 = False
+    early_reply = False
+    failures = {}
+
+    def pre_process_command(self, line, cmd, arg):
+        self.commands.append(cmd)
+        return FTPHandler.pre_process_command(self, line, cmd, arg)
+
+    def ftp_OPTS(self, line):
+        if self.no_utf8 and line.upper().startswith('UTF8'):
+            self.respond('501 Invalid argument.')
+            return
+        return FTPHandler.ftp_OPTS(self, line)
+
+    def ftp_MLSD(self, path):
+        ftp_path = self.fs.fs2ftp(path)
+        if self.failures.get(ftp_path, 0) > 0:
+            self.failures[ftp_path] -= 1
+            self.respond('425 Can\'t open data connection.')
+            return
+        if self.early_reply:
+            self.respond('200 Listing follows.')
+        return FTPHandler.ftp_MLSD(self, path)
+
+
+def make_ftp_class(port):
+    class PortFTP(ftplib.FTP):
+        def __init__(self, host):
+            ftplib.FTP.__init__(self)
+            self.connect(host, port)
+    return PortFTP
+
+
+class TestAsyncFTPScanner(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for path, size in TREE.items():
+            full_path = os.path.join(self.root, path)
+            if not os.path.isdir(os.path.dirname(full_path)):
+                os.makedirs(os.path.dirname(full_path))
+            with open(full_path, 'wb') as f:
+                f.write(b'x' * size)
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.close_all()
+        shutil.rmtree(self.root)
+
+    def start(self, handler_class=FTPHandler):
+        server = start_ftp_server(self.root, handler_class)
+        self.servers.append(server)
+        return server.address[1]
+
+    def assertSameAsFTPScanner(self, port, files):
+        expected = scanner.FTPScanner('127.0.0.1', ftp_class=make_ftp_class(port)).scan()
+        self.assertEqual(set(files), set(expected))
+        self.assertEqual(set((path, size) for path, size, _ in files),
+                         set(('/' + path, size) for path, size in TREE.items()))
+
+    def testScanMLSD(self):
+        port = self.start()
+        ascanner = async_scanner.AsyncFTPScanner('127.0.0.1', port, connections=3)
+        files = async_scanner.asyncio.run(ascanner.scan())
+        self.assertSameAsFTPScanner(port, files)
+
+    def testScanIgnores(self):
+        port = self.start()
+        ascanner = async_scanner.AsyncFTPScanner('127.0.0.1', port, connections=2)
+        files = async_scanner.asyncio.run(ascanner.scan(ignores=['/music']))
+        self.assertEqual(set(path for path, _, _ in files), set(['/root.txt', '/videos/e.avi']))
+
+    def testTooDeep(self):
+        port = self.start()
+        ascanner = async_scanner.AsyncFTPScanner('127.0.0.1', port, connections=2)
+        self.assertRaises(scanner.TooDeepError, async_scanner.asyncio.run, ascanner.scan(max_depth=1))
+
+    def testScanLegacyList(self):
+        port = self.start(NoMLSDHandler)
+        ascanner = async_scanner.AsyncFTPScanner('127.0.0.1', port)
+        files = async_scanner.asyncio.run(ascanner.scan())
+        self.assertEqual(set((path, size) for path, size, _ in files),
+                         set(('/' + path, size) for path, size in TREE.items()))
+
+    def recording(self, **kwargs):
+        return type('Handler', (RecordingHandler,), dict(kwargs, commands=[]))
+
+    def testCommands(self):
+        handler = self.recording()
+        port = self.start(handler)
+        ascanner = async_scanner.AsyncFTPScanner('127.0.0.1', port, connections=2)
+        files = async_scanner.asyncio.run(ascanner.scan())
+        commands = list(handler.commands)
+        self.assertSameAsFTPScanner(port, files)
+        # Each directory listed with a single MLSD, the facts asked once
+        # per connection
+        self.assertEqual(commands.count('MLSD'), len(set(os.path.dirname('/' + path) for path in TREE)))
+        self.assertNotIn('CWD', commands)
+        self.assertLessEqual(commands.count('OPTS'), 2 * 2)
+
+    def testNoUTF8(self):
+        port = self.start(self.recording(no_utf8=True))
+        ascanner = async_scanner.AsyncFTPScanner('127.0.0.1', port)
+        files = async_scanner.asyncio.run(ascanner.scan())
+        self.assertEqual(set((path, size) for path, size, _ in files),
+                         set(('/' + path, size) for path, size in TREE.items()))
+
+    def testEarlyReply(self):
+        port = self.start(self.recording(early_reply=True))
+        ascanner = async_scanner.AsyncFTPScanner('127.0.0.1', port)
+        self.assertSameAsFTPScanner(port, async_scanner.asyncio.run(ascanner.scan()))
+
+    def testListingFails(self):
+        # Listed again once on a new connection
+        port = self.start(self.recording(failures={'/music/album': 1}))
+        ascanner = async_scanner.AsyncFTPScanner('127.0.0.1', port, connections=2)
+        files = async_scanner.asyncio.run(ascanner.scan())
+        self.assertEqual(set((path, size) for path, size, _ in files),
+                         set(('/' + path, size) for path, size in TREE.items()))
+
+    def testListingFailsTwice(self):
+        port = self.start(self.recording(failures={'/music/album': 2}))
+        ascanner = async_scanner.AsyncFTPScanner('127.0.0.1', port, connections=2)
+        files = async_scanner.asyncio.run(ascanner.scan())
+        self.assertEqual(set(path for path, _, _ in files),
+                         set(['/root.txt', '/music/a.mp3', '/videos/e.avi']))
+
+    def testConnectionRefused(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        ascanner = async_scanner.AsyncFTPScanner('127.0.0.1', port)
+        self.assertEqual(async_scanner.asyncio.run(ascanner.scan()), None)
+
+    def testScanPool(self):
+        # every server of the pool must share the same port
+        port = self.start()
+        pool = async_scanner.AsyncScanPool(max_connections=3, connections_per_server=2, port=port)
+        results = pool.scan(['127.0.0.1', 'localhost'])
+        self.assertEqual(set(results.keys()), set(['127.0.0.1', 'localhost']))
+        for files in results.values():
+            self.assertSameAsFTPScanner(port, files)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=100)
+    unittest.main()
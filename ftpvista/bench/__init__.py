@@ -0,0 +1,2 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks of the indexer, run them with bench.py"""
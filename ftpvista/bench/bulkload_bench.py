@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""Throughput of the bulk load versus the writer of Index.
+
+Indexes N synthetic files (2 million by default) once with the
+AsyncWriter of Index, committing every 100000 documents as the indexer
+does, then with bulk_load and 1, 2, 4 and 8 processes (or the counts
+given as the second argument, e.g. 4,16), and reports the documents
+indexed per second. The writer of Index can be skipped by giving 0 as
+the third argument, it takes hours on millions of documents.
+"""
+
+import os
+import shutil
+import tempfile
+import time
+
+from .filelist_bench import synthetic_files
+from ..bulkload import bulk_load
+from ..index import Index
+
+
+def documents(count):
+    for i, (path, size, mtime) in enumerate(synthetic_files(count)):
+        yield Index.document_fields(str(i % 20), os.path.basename(path), path, size, mtime)
+
+
+def index_writer(directory, count):
+    idx = Index(directory, None)
+    for i, fields in enumerate(documents(count)):
+        idx._add_document(fields)
+        if (i + 1) % 100000 == 0:
+            idx.commit(merge=False)
+    idx.commit(merge=False)
+    idx.close()
+
+
+def main(args):
+    count = int(args[0]) if args else 2000000
+    counts = [int(n) for n in args[1].split(',')] if len(args) > 1 else [1, 2, 4, 8]
+    with_index = len(args) < 3 or args[2] != '0'
+    root = tempfile.mkdtemp()
+    try:
+        print('%d documents, %d CPUs' % (count, os.cpu_count()))
+        print('  %-16s %10s %12s' % ('writer', 'time (s)', 'docs/s'))
+        runs = [('bulk_load x%d' % procs, lambda d, procs=procs: bulk_load(d, documents(count), procs))
+                for procs in counts]
+        if with_index:
+            runs.insert(0, ('Index', lambda d: index_writer(d, count)))
+        for name, build in runs:
+            directory = os.path.join(root, name.replace(' ', '_'))
+            begin = time.perf_counter()
+            build(directory)
+            elapsed = time.perf_counter() - begin
+            print('  %-16s %10.1f %12.0f' % (name, elapsed, count / elapsed))
+            shutil.rmtree(directory)
+    finally:
+        shutil.rmtree(root)
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""Memory used by the files found by a scan.
+
+Compares a FileList with the list of (path, size, mtime) tuples it
+replaced, for a synthetic server of N files (200000 by default) spread
+in directories of 50 files.
+"""
+
+import random
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from ..filelist import FileList
+
+
+def synthetic_files(count, per_dir=50, seed=42):
+    rand = random.Random(seed)
+    start = datetime(2010, 1, 1)
+    for i in range(count):
+        dir = '/share/Music/Artist %04d/Album %02d' % (i // (per_dir * 10), i // per_dir % 10)
+        yield ('%s/%02d - Some track title %d.mp3' % (dir, i % per_dir, i),
+               rand.randint(0, 1 << 32),
+               start + timedelta(seconds=rand.randint(0, 10 ** 8)))
+
+
+def measure(build, count):
+    """Returns the bytes used by `build(files)`, the time it took to build
+    and the time needed to iterate over the files."""
+    begin = time.perf_counter()
+    build(synthetic_files(count))
+    elapsed = time.perf_counter() - begin
+
+    # The tuples are made as the scanner does, one at a time
+    tracemalloc.start()
+    built = build(synthetic_files(count))
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    begin = time.perf_counter()
+    for _ in built:
+        pass
+    return used, elapsed, time.perf_counter() - begin
+
+
+def main(args):
+    count = int(args[0]) if args else 200000
+    tuples_mem, tuples_build, tuples_iter = measure(list, count)
+    files_mem, files_build, files_iter = measure(FileList, count)
+
+    print('%d files' % count)
+    print('  list of tuples : %6.1f bytes per file, built in %.2fs (with the generation), iterated in %.2fs'
+          % (tuples_mem / count, tuples_build, tuples_iter))
+    print('  FileList       : %6.1f bytes per file, built in %.2fs (with the generation), iterated in %.2fs'
+          % (files_mem / count, files_build, files_iter))
+    print('  x%.1f less memory' % (tuples_mem / files_mem))
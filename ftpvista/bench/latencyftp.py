@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""A local FTP server answering with some latency, to measure the
+fetching of the tags as on a real network."""
+
+import logging
+import os
+import threading
+import time
+
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import FTPHandler
+from pyftpdlib.servers import ThreadedFTPServer
+
+from ..index import id3_tag_size
+
+MP3_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'test', 'mp3')
+
+
+def mp3_corpus(directory, count, padding=4 << 20):
+    """Copy `count` mp3 files of the tests to `directory`, the tagged ones
+    and not, returns their (path, size) relative to it.
+
+    `padding` bytes are inserted after the tag at the beginning of the
+    files, or at their beginning, so that their sizes are more like the
+    size of real songs. The files are sparse.
+    """
+    names = sorted(name for name in os.listdir(MP3_DIR) if name.endswith('.mp3'))
+    files = []
+    for i in range(count):
+        name = names[i % len(names)]
+        path = '/%03d/%s' % (i // len(names), name)
+        target = directory + path
+        if not os.path.isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+        with open(os.path.join(MP3_DIR, name), 'rb') as f:
+            content = f.read()
+        tagsize = id3_tag_size(content[:10])
+        split = 0 if tagsize is None else min(tagsize + 10, len(content))
+        with open(target, 'wb') as f:
+            f.write(content[:split])
+            f.seek(padding, os.SEEK_CUR)
+            f.write(content[split:])
+        files.append((path, os.path.getsize(target)))
+    return files
+
+
+class CommandCounter(object):
+    """Counts the commands received by the server."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.commands = {}
+
+    def reset(self):
+        with self.lock:
+            self.commands = {}
+
+    def __getitem__(self, cmd):
+        return self.commands.get(cmd, 0)
+
+
+def start_latency_server(root, latency, counter=None):
+    """Serve `root` anonymously on a free port, each command being answered
+    after `latency` seconds. Every connection has its own thread, a slow
+    reply does not delay the others. Returns the server."""
+    # Not a line per command on the output
+    log = logging.getLogger('pyftpdlib')
+    if len(log.handlers) == 0:
+        log.addHandler(logging.NullHandler())
+        log.setLevel(logging.WARNING)
+    authorizer = DummyAuthorizer()
+    authorizer.add_anonymous(root)
+
+    class LatencyHandler(FTPHandler):
+        def pre_process_command(self, line, cmd, arg):
+            time.sleep(latency)
+            if counter is not None:
+                with counter.lock:
+                    counter.commands[cmd] = counter.commands.get(cmd, 0) + 1
+            FTPHandler.pre_process_command(self, line, cmd, arg)
+
+    LatencyHandler.authorizer = authorizer
+    server = ThreadedFTPServer(('127.0.0.1', 0), LatencyHandler)
+    server.max_cons = 256
+    thread = threading.Thread(target=server.serve_forever, kwargs={'timeout': 0.1, 'handle_exit': False})
+    thread.daemon = True
+    thread.start()
+    return server
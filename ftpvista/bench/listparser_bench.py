@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""LIST parsing throughput.
+
+Compares parse_list_line with the former NLST + LIST parsing, which
+split every line and paired it by index with the NLST output. Captured
+listings can be given on the command line, a synthetic one is used
+otherwise.
+"""
+
+import datetime
+import random
+import re
+import time
+
+from ..scanner import parse_list_line
+
+
+def legacy_parse(line, file_name):
+    """The parsing of a LIST line before parse_list_line, Unix only."""
+    permissions = line.pop(0)
+    line.pop(0)
+    line.pop(0)
+    line.pop(0)
+    size = line.pop(0)
+    month = line.pop(0)
+    month = datetime.datetime.strptime(month, "%b").month
+    if month < 10:
+        month = '0%d' % month
+    else:
+        month = str(month)
+    day = line.pop(0)
+    hour = line.pop(0)
+    if re.match(r'([0-9]+)\:([0-9])', hour):
+        year = str(datetime.date.today().year)
+    else:
+        year = hour
+        hour = '00:00'
+    hour = re.sub(':', '', hour)
+    modify = '%s%s%s%s00' % (year, month, day, hour)
+    typ = 'dir' if permissions[0] == 'd' else 'file'
+    perm = 'adfrw' if typ == 'file' else 'flcdmpe'
+    return (file_name, {'perm': perm, 'type': typ, 'modify': modify, 'size': size})
+
+
+def synthetic_listing(count, dos=False, seed=42):
+    rand = random.Random(seed)
+    months = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+    lines = []
+    for i in range(count):
+        name = 'Some Artist - Track %05d.mp3' % i if i % 3 else 'file%d.avi' % i
+        size = rand.randint(0, 4 << 30)
+        if dos:
+            lines.append('%02d-%02d-%02d  %02d:%02dPM %18d %s'
+                         % (rand.randint(1, 12), rand.randint(1, 28), rand.randint(0, 15),
+                            rand.randint(1, 12), rand.randint(0, 59), size, name))
+        elif i % 2:
+            lines.append('-rw-r--r--   1 ftp      ftp      %10d %s %2d  %d %s'
+                         % (size, rand.choice(months), rand.randint(1, 28),
+                            rand.randint(2000, 2015), name))
+        else:
+            lines.append('-rw-r--r--   1 ftp      ftp      %10d %s %2d %02d:%02d %s'
+                         % (size, rand.choice(months), rand.randint(1, 28),
+                            rand.randint(0, 23), rand.randint(0, 59), name))
+    return lines
+
+
+def run_legacy(lines):
+    # NLST returned the names, LIST the lines, both are needed
+    names = [line.split(None, 8)[8] for line in lines]
+    items = [line.split() for line in lines]
+    return [legacy_parse(item, names[i]) for i, item in enumerate(items)]
+
+
+def run_parser(lines):
+    return [entry for entry in map(parse_list_line, lines) if entry is not None]
+
+
+def measure(func, lines, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(lines)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(args):
+    if args:
+        listings = []
+        for path in args:
+            with open(path, encoding='utf-8', errors='replace') as f:
+                listings.append((path, [line.rstrip('\r\n') for line in f]))
+    else:
+        listings = [('synthetic Unix', synthetic_listing(200000)),
+                    ('synthetic DOS', synthetic_listing(200000, dos=True))]
+
+    for name, lines in listings:
+        parsed = len(run_parser(lines))
+        elapsed = measure(run_parser, lines)
+        print('%s : %d lines, %d entries' % (name, len(lines), parsed))
+        print('  parse_list_line : %.3fs, %d lines/s' % (elapsed, len(lines) / elapsed))
+        try:
+            legacy = measure(run_legacy, lines)
+            print('  NLST + LIST     : %.3fs, %d lines/s (x%.1f)'
+                  % (legacy, len(lines) / legacy, legacy / elapsed))
+        except (ValueError, IndexError):
+            print('  NLST + LIST     : unable to parse this listing')
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""Search latency versus the number of partitions of the index.
+
+Indexes N synthetic files (20000 by default) in a single index and in
+'hash' indexes of 1, 2, 4 and 8 partitions (or the counts given as the
+second argument, e.g. 2,4,16), then runs the same queries as the search
+site, scored and sorted by date, and reports their latency.
+"""
+
+import os
+import shutil
+import statistics
+import tempfile
+import time
+
+from whoosh.qparser import MultifieldParser
+from whoosh.sorting import FieldFacet
+
+from .filelist_bench import synthetic_files
+from ..shards import open_index, open_searcher
+
+QUERIES = ['track', 'title 1*', 'artist', 'album 05', '"some track"', 'mp3']
+REPEAT = 5
+PAGELEN = 100
+
+
+def build(directory, layout, count, partitions=1):
+    idx = open_index(directory, None, layout, partitions)
+    for i, (path, size, mtime) in enumerate(synthetic_files(count)):
+        idx.add_document(str(i % 20), os.path.basename(path), path, size, mtime)
+        if (i + 1) % 50000 == 0:
+            idx.commit(merge=False)
+    idx.commit()
+    idx.optimize()
+    idx.close()
+
+
+def latencies(directory, sortedby):
+    """Returns the latency of each query in ms, with the first page of
+    hits and whether it is the last page, as the search site does."""
+    times = []
+    with open_searcher(directory) as searcher:
+        parser = MultifieldParser(['name', 'path'], schema=searcher.schema)
+        for query in QUERIES:
+            query = parser.parse(query)
+            for _ in range(REPEAT):
+                begin = time.perf_counter()
+                page = searcher.search_page(query, 1, pagelen=PAGELEN, sortedby=sortedby)
+                [hit['path'] for hit in page]
+                page.is_last_page()
+                times.append((time.perf_counter() - begin) * 1000)
+    return times
+
+
+def main(args):
+    count = int(args[0]) if args else 20000
+    counts = [int(n) for n in args[1].split(',')] if len(args) > 1 else [1, 2, 4, 8]
+    root = tempfile.mkdtemp()
+    try:
+        layouts = [('single', 'single', 1)] + [('hash x%d' % n, 'hash', n) for n in counts]
+        print('%d files, %d CPUs, %d queries x %d' % (count, os.cpu_count(), len(QUERIES), REPEAT))
+        print('  %-10s %12s %12s %12s' % ('layout', 'build (s)', 'scored (ms)', 'by date (ms)'))
+        for name, layout, partitions in layouts:
+            directory = os.path.join(root, name.replace(' ', '_'))
+            begin = time.perf_counter()
+            build(directory, layout, count, partitions)
+            elapsed = time.perf_counter() - begin
+            scored = latencies(directory, None)
+            by_date = latencies(directory, FieldFacet('mtime', reverse=True))
+            print('  %-10s %12.1f %12.1f %12.1f' % (name, elapsed, statistics.mean(scored),
+                                                     statistics.mean(by_date)))
+        print('  (mean latency of a page of %d hits)' % PAGELEN)
+    finally:
+        shutil.rmtree(root)
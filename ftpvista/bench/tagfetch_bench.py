@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""Throughput of the fetching of the ID3 tags versus the concurrency.
+
+Serves N mp3 files (200 by default) with a local FTP server answering
+every command after L milliseconds (20 by default), then fetches their
+tags with FetchID3TagsStage, one file after the other, first with the
+precise ranges then with the speculative ones, with FTPFetchID3TagsStage
+over a single connection, and with
+ConcurrentFetchID3TagsStage and 1, 4, 16 and 32 transfers at once (or the
+counts given as the third argument, e.g. 8,64). Reports the requests and
+the bytes per file of each run.
+
+Then fetches the tags of FLAC, Ogg, Wave and WMA files, with pictures or
+padding in their headers, over a single connection and reports the
+requests and bytes per file of each format.
+"""
+
+import os
+import shutil
+import tempfile
+import time
+
+from .latencyftp import CommandCounter, mp3_corpus, start_latency_server
+from .. import pipeline
+from ..rangefile_test import audio_files
+from ..index import ConcurrentFetchID3TagsStage, FetchID3TagsStage, FileIndexerContext, FTPFetchID3TagsStage
+
+
+class Collect(pipeline.Stage):
+    def __init__(self):
+        self.tags = {}
+
+    def execute(self, context):
+        self.tags[context.get_path()] = context.get_extra_data()
+        return True
+
+
+def fetch(stage, collect, files):
+    pipe = pipeline.Pipeline()
+    pipe.append_stage(stage)
+    pipe.append_stage(collect)
+    begin = time.perf_counter()
+    for path, size in files:
+        pipe.execute(FileIndexerContext(path, size, None))
+    pipe.flush()
+    pipe.close()
+    return time.perf_counter() - begin
+
+
+def main(args):
+    count = int(args[0]) if args else 200
+    latency = float(args[1]) / 1000 if len(args) > 1 else 0.02
+    counts = [int(n) for n in args[2].split(',')] if len(args) > 2 else [1, 4, 16, 32]
+    root = tempfile.mkdtemp()
+    server = None
+    try:
+        files = mp3_corpus(root, count)
+        counter = CommandCounter()
+        server = start_latency_server(root, latency, counter)
+        addr = '127.0.0.1:%d' % server.address[1]
+
+        print('%d files, %d ms per command' % (count, latency * 1000))
+        print('  %-18s %10s %10s %12s %10s %12s %10s %10s' % ('stage', 'time (s)', 'files/s', 'connections',
+                                                              'requests', 'bytes/file', 'ms/file', 'same tags'))
+        expected = None
+        runs = [('sequential precise', lambda collect: FetchID3TagsStage(addr, speculative=False)),
+                ('sequential', lambda collect: FetchID3TagsStage(addr)),
+                ('sequential warm', lambda collect: FTPFetchID3TagsStage(addr))]
+        runs += [('concurrent x%d' % n, lambda collect, n=n: ConcurrentFetchID3TagsStage(addr, collect, concurrency=n))
+                 for n in counts]
+        for name, make_stage in runs:
+            collect = Collect()
+            counter.reset()
+            stage = make_stage(collect)
+            elapsed = fetch(stage, collect, files)
+            if expected is None:
+                expected = collect.tags
+            print('  %-18s %10.2f %10.1f %12d %10.2f %12.0f %10.0f %10s'
+                  % (name, elapsed, count / elapsed, counter['USER'], counter['RETR'] / count,
+                     stage.stats.bytes / max(stage.stats.files, 1),
+                     stage.stats.seconds * 1000 / max(stage.stats.files, 1), collect.tags == expected))
+
+        print('Other formats, %d files each' % count)
+        print('  %-18s %12s %10s %12s %10s' % ('format', 'file size', 'requests', 'bytes/file', 'ms/file'))
+        for name, content in audio_files():
+            paths = []
+            for i in range(count):
+                paths.append(('/other/%d-%s' % (i, name), len(content)))
+                if not os.path.isdir(root + '/other'):
+                    os.makedirs(root + '/other')
+                with open(root + paths[-1][0], 'wb') as f:
+                    f.write(content)
+            counter.reset()
+            stage = FTPFetchID3TagsStage(addr)
+            fetch(stage, Collect(), paths)
+            print('  %-18s %12d %10.2f %12.0f %10.0f'
+                  % (name.rpartition('.')[2], len(content), counter['RETR'] / count,
+                     stage.stats.bytes / count, stage.stats.seconds * 1000 / count))
+    finally:
+        if server is not None:
+            server.close_all()
+        shutil.rmtree(root)
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""Bulk (re)building of an index with several processes.
+
+The writer of Index analyzes every document on a single core, rewriting
+a whole index with it takes hours. A bulk load gives the documents to the
+multiprocessing writer of whoosh instead : batches of documents are sent
+to `procs` processes, each one building its own segment. The segments are
+not merged at the end, which would be done on one core again, they are
+left to the MergeScheduler or to the next optimization.
+"""
+
+import logging
+import os
+import shutil
+
+from whoosh import index as whoosh_index
+
+from .index import Index
+from .journal import Journal
+from .manifest import Manifest
+from .shards import LAYOUTS, index_layout
+
+
+def export_documents(directory):
+    """Yields the fields of every document of the index in `directory`,
+    whatever its layout and its schema version, as they are given to
+    bulk_load."""
+    layout = index_layout(directory)
+    if layout is None:
+        raise ValueError('No index in %s' % directory)
+    if layout == 'single':
+        directories = [directory]
+    else:
+        shards_dir = os.path.join(directory, LAYOUTS[layout].SHARDS_DIR)
+        directories = [os.path.join(shards_dir, name) for name in sorted(os.listdir(shards_dir))
+                       if whoosh_index.exists_in(os.path.join(shards_dir, name))]
+
+    for path in directories:
+        with whoosh_index.open_dir(path).reader() as reader:
+            for fields in reader.all_stored_fields():
+                yield Index.upgrade_fields(fields)
+
+
+def bulk_load(directory, documents, procs=None, limitmb=128, batchsize=100):
+    """Build a new single index in `directory` from the given documents.
+
+    documents -- an iterable of the fields of the documents, see
+                 Index.document_fields
+    procs     -- number of processes building the segments, one per CPU
+                 by default
+    limitmb   -- memory used by the writer of each process, in MB
+    batchsize -- number of documents sent to a process at once
+
+    The manifest of the new index is built too. Returns the number of
+    documents.
+    """
+    log = logging.getLogger('ftpvista.bulkload')
+    if index_layout(directory) is not None:
+        raise ValueError('There is already an index in %s' % directory)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    procs = procs or os.cpu_count() or 1
+
+    ix = whoosh_index.create_in(directory, schema=Index.get_schema())
+    if procs > 1:
+        writer = ix.writer(procs=procs, multisegment=True, limitmb=limitmb, batchsize=batchsize)
+    else:
+        writer = ix.writer(limitmb=limitmb)
+    log.info('Bulk loading the index in %s with %d processes' % (directory, procs))
+    count = 0
+    try:
+        for fields in documents:
+            writer.add_document(**fields)
+            count += 1
+            if count % 100000 == 0:
+                log.info('%d documents loaded' % count)
+    except BaseException:
+        writer.cancel()
+        raise
+    writer.commit(merge=False)
+
+    manifest = Manifest(directory)
+    with ix.reader() as reader:
+        manifest.rebuild(Index.manifest_entries(reader), {None: ix.latest_generation()})
+    manifest.close()
+    log.info('Index loaded : %d documents in %d segments' % (count, len(ix._segments())))
+    return count
+
+
+def rebuild_index(directory, procs=None, limitmb=128):
+    """Rewrite every document of the index in `directory` with the current
+    schema, with bulk_load, then replace the index by the new one.
+
+    The indexer must be stopped, and must have replayed its journal. The
+    new index has the single layout, whatever the layout of the old one.
+    Returns the number of documents.
+    """
+    log = logging.getLogger('ftpvista.bulkload')
+    # Fails if the indexer is running
+    journal = Journal(directory)
+    try:
+        if len(journal) > 0:
+            raise ValueError('The journal of %s is not empty, start the indexer once to replay it first'
+                             % directory)
+        directory = directory.rstrip(os.sep)
+        rebuilt = directory + '.rebuild'
+        if os.path.isdir(rebuilt):
+            # Left by an interrupted rebuild
+            shutil.rmtree(rebuilt)
+        count = bulk_load(rebuilt, export_documents(directory), procs, limitmb)
+    finally:
+        journal.close()
+
+    old = directory + '.old'
+    os.rename(directory, old)
+    os.rename(rebuilt, directory)
+    shutil.rmtree(old)
+    log.info('Index rebuilt : %d documents' % count)
+    return count
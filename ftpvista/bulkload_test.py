@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+from whoosh import index as whoosh_index
+from whoosh.query import Term
+
+from . import bulkload
+from . import index
+from . import journal
+from . import shards
+
+
+MTIME = datetime(2015, 1, 2, 3, 4, 5)
+
+
+def documents(count):
+    for i in range(count):
+        path = '/music/artist %d/track %d.mp3' % (i % 7, i)
+        yield index.Index.document_fields(str(1 + i % 2), os.path.basename(path), path, i, MTIME,
+                                          audio_title='title %d' % i)
+
+
+class TestBulkLoad(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'index')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testBulkLoad(self):
+        self.assertEqual(bulkload.bulk_load(self.path, documents(500), procs=2, batchsize=50), 500)
+        ix = whoosh_index.open_dir(self.path)
+        # At most one segment per process, left for the merges
+        sizes = [segment.doc_count() for segment in ix._segments()]
+        self.assertLessEqual(len(sizes), 2)
+        self.assertEqual(sum(sizes), 500)
+        with ix.searcher() as searcher:
+            self.assertEqual(len(searcher.search(Term('path', 'music'), limit=None)), 500)
+            hits = searcher.search(Term('audio_title', '42'))
+            self.assertEqual([hit['path'] for hit in hits], ['/music/artist 0/track 42.mp3'])
+
+        # The manifest matches the index, nothing is rebuilt
+        idx = index.Index(self.path, None)
+        self.assertEqual(idx._manifest.generation, ix.latest_generation())
+        self.assertEqual(len(idx.get_indexed_files(1)), 250)
+        idx.delete_file(1, '/music/artist 0/track 0.mp3')
+        idx.commit()
+        self.assertEqual(len(idx.get_indexed_files(1)), 249)
+        idx.close()
+
+        self.assertRaises(ValueError, bulkload.bulk_load, self.path, documents(1))
+
+    def testRebuild(self):
+        for layout in ('single', 'hash'):
+            idx = shards.open_index(self.path, None, layout, 3)
+            for fields in documents(60):
+                idx._add_document(fields)
+            idx.commit()
+            idx.close()
+
+            self.assertEqual(bulkload.rebuild_index(self.path, procs=2), 60)
+            self.assertEqual(shards.index_layout(self.path), 'single')
+            self.assertEqual(sorted(os.listdir(self.dir)), ['index'])
+            idx = index.Index(self.path, None)
+            self.assertEqual(sorted(idx.get_indexed_files(2)),
+                             sorted(fields['path'] for fields in documents(60) if fields['server_id'] == '2'))
+            idx.close()
+            shutil.rmtree(self.path)
+
+    def testJournalNotReplayed(self):
+        os.mkdir(self.path)
+        idx = shards.open_index(self.path, None, 'single', journal=journal.Journal(self.path))
+        idx.add_document('1', 'a.txt', '/a.txt', 10, MTIME)
+        # The indexer is running
+        self.assertRaises(journal.JournalLocked, bulkload.rebuild_index, self.path)
+        idx._journal.close()
+        self.assertRaises(ValueError, bulkload.rebuild_index, self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+"""Extensions of the files by category, shared by the indexer and the
+search site."""
+
+AUDIO_EXTENSIONS = ['mp3', 'wma', 'cda', 'ogg', 'flac', 'aac', 'aiff', 'm4a', 'wav']
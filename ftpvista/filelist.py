@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""Compact storage of the files found on a FTP server."""
+
+from array import array
+from datetime import datetime, timedelta
+
+EPOCH = datetime(1970, 1, 1)
+SECOND = timedelta(seconds=1)
+
+
+class FileList(object):
+    """A list of (path, size, mtime) tuples, stored by column.
+
+    Each directory path is stored once and referenced by an id, the
+    basenames are packed in a single UTF-8 buffer and the sizes and
+    mtimes (whole seconds) live in arrays. It takes a fraction of the
+    memory of a list of tuples, which matters for servers with millions
+    of files, and is iterated as the tuples it replaces.
+    """
+
+    def __init__(self, files=()):
+        self._dirs = []                 # directory paths, with a trailing /
+        self._dir_ids = {}              # directory path => index in _dirs
+        self._dir_column = array('I')
+        self._names = bytearray()
+        self._name_ends = array('q')    # end of each name in _names
+        self._sizes = array('q')
+        self._mtimes = array('q')       # seconds since EPOCH
+        self.extend(files)
+
+    def _dir_id(self, dir):
+        dir_id = self._dir_ids.get(dir)
+        if dir_id is None:
+            dir_id = self._dir_ids[dir] = len(self._dirs)
+            self._dirs.append(dir)
+        return dir_id
+
+    def add(self, dir, name, size, mtime):
+        """Append the file `name` of the directory `dir`."""
+        if not dir.endswith('/'):
+            dir += '/'
+        self._dir_column.append(self._dir_id(dir))
+        self._names += name.encode('utf-8', 'surrogatepass')
+        self._name_ends.append(len(self._names))
+        self._sizes.append(size)
+        self._mtimes.append((mtime - EPOCH) // SECOND)
+
+    def append(self, file):
+        """Append a (path, size, mtime) tuple."""
+        path, size, mtime = file
+        dir, _, name = path.rpartition('/')
+        self.add(dir, name, size, mtime)
+
+    def extend(self, files):
+        if not isinstance(files, FileList):
+            for file in files:
+                self.append(file)
+            return
+
+        dir_ids = [self._dir_id(dir) for dir in files._dirs]
+        self._dir_column.extend(dir_ids[dir_id] for dir_id in files._dir_column)
+        offset = len(self._names)
+        self._names += files._names
+        self._name_ends.extend(end + offset for end in files._name_ends)
+        self._sizes.extend(files._sizes)
+        self._mtimes.extend(files._mtimes)
+
+    def _file(self, i):
+        start = self._name_ends[i - 1] if i > 0 else 0
+        name = self._names[start:self._name_ends[i]].decode('utf-8', 'surrogatepass')
+        return (self._dirs[self._dir_column[i]] + name, self._sizes[i],
+                EPOCH + SECOND * self._mtimes[i])
+
+    def __iter__(self):
+        dirs, names = self._dirs, self._names
+        start = 0
+        for dir_id, end, size, mtime in zip(self._dir_column, self._name_ends,
+                                            self._sizes, self._mtimes):
+            yield (dirs[dir_id] + names[start:end].decode('utf-8', 'surrogatepass'),
+                   size, EPOCH + SECOND * mtime)
+            start = end
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._file(j) for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('FileList index out of range')
+        return self._file(i)
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def __eq__(self, other):
+        if not isinstance(other, (FileList, list, tuple)):
+            return NotImplemented
+        return len(self) == len(other) and list(self) == list(other)
+
+    def __repr__(self):
+        return 'FileList(%r)' % list(self)
+
+    def total_size(self):
+        return sum(self._sizes)
+
+    def chunks(self, size=1000):
+        """Yields the files as lists of at most `size` tuples."""
+        for i in range(0, len(self), size):
+            yield self[i:i+size]
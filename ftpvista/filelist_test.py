@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from datetime import datetime
+
+from .filelist import FileList
+
+
+FILES = [
+    ('/root.txt', 10, datetime(2015, 1, 2, 3, 4, 5)),
+    ('/a/a.txt', 20, datetime(2015, 1, 2)),
+    ('/a/b c/été.mp3', 3 << 40, datetime(1969, 12, 31, 23, 59, 59)),
+    ('/a/b.txt', 0, datetime(2038, 1, 20)),
+]
+
+
+class TestFileList(unittest.TestCase):
+    def testIterate(self):
+        files = FileList(FILES)
+        self.assertEqual(len(files), 4)
+        self.assertEqual(list(files), FILES)
+        self.assertEqual(files, FILES)
+
+    def testAdd(self):
+        files = FileList()
+        files.add('/', 'root.txt', 10, datetime(2015, 1, 2, 3, 4, 5))
+        files.add('/a', 'a.txt', 20, datetime(2015, 1, 2))
+        self.assertEqual(list(files), FILES[:2])
+
+    def testDirectoriesAreStoredOnce(self):
+        files = FileList(FILES)
+        self.assertEqual(files._dirs, ['/', '/a/', '/a/b c/'])
+
+    def testIndexing(self):
+        files = FileList(FILES)
+        self.assertEqual(files[0], FILES[0])
+        self.assertEqual(files[-1], FILES[-1])
+        self.assertEqual(files[1:3], FILES[1:3])
+        self.assertRaises(IndexError, files.__getitem__, 4)
+
+    def testExtend(self):
+        files = FileList(FILES[:2])
+        files.extend(FileList(FILES[2:]))
+        files.extend(FILES[:1])
+        self.assertEqual(list(files), FILES + FILES[:1])
+        self.assertEqual(files._dirs, ['/', '/a/', '/a/b c/'])
+
+    def testChunks(self):
+        files = FileList(FILES)
+        self.assertEqual(list(files.chunks(3)), [FILES[:3], FILES[3:]])
+        self.assertEqual(files.total_size(), sum(size for _, size, _ in FILES))
+
+    def testSurrogates(self):
+        # names not in UTF-8, decoded with surrogateescape
+        name = b'caf\xe9.txt'.decode('utf-8', 'surrogateescape')
+        files = FileList([('/' + name, 1, datetime(2015, 1, 1))])
+        self.assertEqual(files[0][0], '/' + name)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import ftplib
 import socket
 import logging
 
@@ -13,3 +14,136 @@ class FTPTools:
         sock.settimeout(1)
         result = sock.connect_ex((addr, 21))
         return result == 0
+
+
+class FTPRangeReader(object):
+    """Reads byte ranges of the files of a server with REST and RETR, over
+    a connection kept logged in from one file to the next.
+
+    The files of a directory are read after a single CWD, the files should
+    be read directory by directory. The connection of a scanner using a
+    single connection is borrowed while it is idle, that is while the
+    files it yields are processed.
+    """
+
+    def __init__(self, server_addr, scanner=None):
+        """
+        :Parameters:
+            -`server_addr`: the server IP address, with an optional ':port'
+            -`scanner`: a scanner.FTPScanner whose connection is used when
+                        open
+        """
+        self.log = logging.getLogger('ftpvista.ranges.%s' % server_addr.replace('.', '_'))
+        host, _, port = server_addr.partition(':')
+        self._host = host
+        self._port = int(port) if port else 21
+        self._scanner = scanner
+        self._scanner_commands = None
+        self._own = None
+        self._ftp = None
+        self._cwd = None
+        self._binary = False
+        # Logins and commands sent
+        self.connections = 0
+        self.commands = 0
+
+    def _borrowed(self):
+        """Returns the connection of the scanner if it is open, None
+        otherwise."""
+        if self._scanner is None:
+            return None
+        ftp = getattr(self._scanner, 'ftp', None)
+        if ftp is None or ftp.sock is None:
+            return None
+        if ftp is not self._ftp or self._scanner.stats.commands != self._scanner_commands:
+            # New or used by the scanner in the meantime
+            self._use(ftp)
+        return ftp
+
+    def _use(self, ftp):
+        self._ftp = ftp
+        self._cwd = None
+        self._binary = False
+
+    def _connection(self):
+        ftp = self._borrowed()
+        if ftp is not None:
+            return ftp
+        if self._own is None or self._own.sock is None:
+            self._own = ftplib.FTP()
+            self._own.connect(self._host, self._port)
+            self._own.login()
+            self._own.set_pasv(True)
+            self._own.encoding = 'utf-8'
+            self.connections += 1
+            self.commands += 2
+        if self._ftp is not self._own:
+            self._use(self._own)
+        return self._own
+
+    def _sendcmd(self, ftp, cmd):
+        self.commands += 1
+        return ftp.voidcmd(cmd)
+
+    def _read(self, directory, name, first, last):
+        ftp = self._connection()
+        if self._cwd != directory:
+            self.commands += 1
+            ftp.cwd(directory)
+            self._cwd = directory
+        if not self._binary:
+            self._sendcmd(ftp, 'TYPE I')
+            self._binary = True
+
+        # PASV, REST and RETR
+        self.commands += 2 if first == 0 else 3
+        wanted = last - first + 1
+        chunks = []
+        received = 0
+        with ftp.transfercmd('RETR ' + name, rest=first or None) as conn:
+            while received < wanted:
+                chunk = conn.recv(min(65536, wanted - received))
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                received += len(chunk)
+        if received < wanted:
+            ftp.voidresp()
+        else:
+            # Interrupted, the server may complain about it
+            try:
+                ftp.voidresp()
+            except ftplib.error_temp:
+                pass
+        return b''.join(chunks)
+
+    def read(self, path, first, last):
+        """Returns the bytes `first` to `last` of the file at `path`,
+        less if the file is shorter. FTP errors are raised."""
+        directory, _, name = path.rpartition('/')
+        try:
+            return self._read(directory or '/', name, first, last)
+        except ftplib.error_perm:
+            raise
+        except ftplib.all_errors as e:
+            self.log.debug('Reading %s failed, trying again on a new connection : %r' % (path, e))
+            if self._ftp is not None and self._ftp is not self._own:
+                # The connection of the scanner is never closed here, it is
+                # not borrowed anymore. If broken, the scanner gets an FTP
+                # error on its next command and reconnects
+                self._scanner = None
+            elif self._own is not None:
+                self._own.close()
+            self._use(None)
+            return self._read(directory or '/', name, first, last)
+        finally:
+            if self._scanner is not None and self._ftp is not None and self._ftp is not self._own:
+                self._scanner_commands = self._scanner.stats.commands
+
+    def close(self):
+        if self._own is not None and self._own.sock is not None:
+            try:
+                self._own.quit()
+            except ftplib.all_errors:
+                self._own.close()
+        self._own = None
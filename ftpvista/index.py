@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
 
+import ftplib
 import logging
 import os
 import os.path
-from datetime import datetime
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
 from io import BytesIO
 from urllib.request import pathname2url
 
@@ -11,49 +15,210 @@ import pycurl
 import struct
 from . import tinytag
 from whoosh import index
-from whoosh.fields import Schema, ID, TEXT
-from whoosh.query import Term
+from whoosh.fields import Schema, DATETIME, ID, NUMERIC, TEXT
+from whoosh.index import LockError
+from whoosh.query import Or, Term
 from whoosh.writing import AsyncWriter, IndexingError
 from whoosh.analysis import CharsetFilter, StemmingAnalyzer
 from whoosh.support.charset import accent_map
 from . import pipeline
-from .scanner import FTPScanner
+from .persist import ServerScanCheckpoint, ServerListingCache
+from .filelist import EPOCH, SECOND, FileList
+from .manifest import Manifest
+from .scanner import FTPScanner, FTPCapabilities
+from .async_scanner import AsyncScanPool
+from .ftp_tools import FTPRangeReader
+from .rangefile import RangeFile
+from .extensions import AUDIO_EXTENSIONS
 from functools import reduce
 
 
+def parse_mtime(mtime):
+    """Returns the datetime of a mtime stored as a string by the first
+    versions of the schema, None if invalid."""
+    try:
+        return datetime.strptime(mtime, '%Y-%m-%d %H:%M:%S')
+    except (TypeError, ValueError):
+        return None
+
+
+def mtime_seconds(mtime):
+    """Convert a stored mtime to seconds since the Epoch, 0 if invalid."""
+    if not isinstance(mtime, datetime):
+        mtime = parse_mtime(mtime)
+    if mtime is None:
+        return 0
+    return (mtime - EPOCH) // SECOND
+
+
+class CancellableAsyncWriter(AsyncWriter):
+    """An AsyncWriter whose delayed commit can be cancelled.
+
+    When the index is locked, AsyncWriter commits in a thread waiting for
+    the lock forever : once cancelled, that thread gives up instead of
+    writing changes which were rolled back.
+    """
+
+    def __init__(self, index, delay=0.25, writerargs=None):
+        self._cancel_lock = threading.Lock()
+        self._cancelled = False
+        AsyncWriter.__init__(self, index, delay, writerargs)
+
+    def run(self):
+        self.running = True
+        writer = self.writer
+        while writer is None and not self._cancelled:
+            try:
+                writer = self.index.writer(**self.writerargs)
+            except LockError:
+                time.sleep(self.delay)
+        if writer is None:
+            return
+        with self._cancel_lock:
+            if self._cancelled:
+                writer.cancel()
+                return
+            for method, args, kwargs in self.events:
+                getattr(writer, method)(*args, **kwargs)
+            writer.commit(*self.commitargs, **self.commitkwargs)
+
+    def cancel(self, *args, **kwargs):
+        with self._cancel_lock:
+            self._cancelled = True
+            AsyncWriter.cancel(self, *args, **kwargs)
+
+
 class Index(object):
-    def __init__(self, directory, persist):
+    # Number of documents deleted by a single query
+    DELETE_BATCH = 1000
+
+    # Version of the schema returned by get_schema :
+    #  1. first version
+    #  2. path_key, exact key of the documents
+    #  3. NUMERIC size and DATETIME mtime, for range queries and sorting
+    SCHEMA_VERSION = 3
+
+    # Seconds to wait for the writer of another process
+    LOCK_TIMEOUT = 60
+
+    def __init__(self, directory, persist, journal=None):
+        """Open, or create, the index in `directory`.
+
+        journal -- an optional journal.Journal of the changes not commited,
+                   replayed if the last process did not commit them
+        """
         self.log = logging.getLogger('ftpvista.index')
 
         self._persist = persist
-        if not os.path.exists(directory):
+        if not index.exists_in(directory):
             self.log.info('Creating the index in %s' % directory)
-            os.mkdir(directory)
+            if not os.path.isdir(directory):
+                os.mkdir(directory)
             self._idx = index.create_in(directory, schema=self.get_schema())
         else:
             self.log.info('Opening the index in %s' % directory)
             self._idx = index.open_dir(directory)
-
-        self._searcher = self._idx.searcher()
+            version = self.schema_version(self._idx.schema)
+            if version < self.SCHEMA_VERSION:
+                self._migrate(version)
+
+        self._manifest = Manifest(directory)
+        if self._manifest.generation is None:
+            self.log.info('Building the manifest of the index')
+            self.rebuild_manifest()
+        elif self._manifest.generation != self._idx.latest_generation():
+            self.log.warning('The manifest does not match the index, rebuilding it')
+            self.rebuild_manifest()
+
+        # Held while merging segments, see merge
+        self._merge_lock = threading.Lock()
+        # Number of documents added or deleted, to estimate the write rate
+        self.write_count = 0
+        # Opened by the first change only, it holds the lock of the index
         self._writer = None
-        self.open_writer()
-        self._last_optimization = None
+        self._manifest_deleted = []
+        self._manifest_added = []
+        self._load_last_optimization()
+        self._open_journal(journal)
 
     def open_writer(self):
         # self._writer = BufferedWriter(self._idx, 120, 4000)
-        self._writer = AsyncWriter(self._idx)
-
-    def get_schema(self):
+        # Wait for a running merge, the AsyncWriter would buffer everything
+        # in memory otherwise
+        with self._merge_lock:
+            self._writer = CancellableAsyncWriter(self._idx)
+        # Changes of the writer, applied to the manifest once commited
+        self._manifest_deleted = []
+        self._manifest_added = []
+
+    def _current_writer(self):
+        """Returns the writer of the changes not commited, opened if this
+        is the first one."""
+        if self._writer is None:
+            self.open_writer()
+        return self._writer
+
+    @staticmethod
+    def manifest_entries(reader):
+        """Yields the (server_id, path, size, mtime) manifest entry of each
+        document of a whoosh reader."""
+        for fields in reader.all_stored_fields():
+            yield Index._manifest_entry(fields)
+
+    @staticmethod
+    def _manifest_entry(fields):
+        return (fields['server_id'], fields['path'], int(fields.get('size') or 0),
+                mtime_seconds(fields.get('mtime')))
+
+    def _open_journal(self, journal):
+        self._journal = journal
+        if journal is not None and len(journal) > 0:
+            self._replay_journal()
+
+    def _replay_journal(self):
+        """Redo the changes left in the journal by a process killed before
+        commiting them."""
+        self.log.warning('Replaying the changes of %s, %d bytes' % (self._journal.path, len(self._journal)))
+        deleted = {}    # server_id => paths
+        added = []
+        for operation in self._journal.records():
+            if operation[0] == 'add':
+                fields = operation[1]
+                deleted.setdefault(fields['server_id'], []).append(fields['path'])
+                added.append(fields)
+            elif operation[0] == 'delete':
+                deleted.setdefault(operation[1], []).extend(operation[2])
+
+        # Deleting only affects the documents commited before, whatever the
+        # order. Deleting the added documents too makes the replay
+        # idempotent, they may have been commited just before the crash
+        for server_id, paths in deleted.items():
+            self._delete_files(server_id, paths)
+        for fields in added:
+            self._add_document(fields)
+        self.commit()
+        self.log.info('Journal replayed : %d documents added, %d deleted'
+                      % (len(added), sum(len(paths) for paths in deleted.values())))
+
+    def rebuild_manifest(self):
+        """Fill the manifest with the stored fields of the documents."""
+        with self._idx.reader() as reader:
+            self._manifest.rebuild(self.manifest_entries(reader),
+                                   {None: self._idx.latest_generation()})
+
+    @staticmethod
+    def get_schema():
         analyzer = StemmingAnalyzer('([a-zA-Z0-9])+')
         my_analyzer = analyzer | CharsetFilter(accent_map)
         return Schema(
             server_id=ID(stored=True),
             has_id=ID(),
             path=TEXT(analyzer=my_analyzer, stored=True),
+            path_key=ID(),
             name=TEXT(analyzer=my_analyzer, stored=True),
             ext=TEXT(analyzer=my_analyzer, stored=True),
-            size=ID(stored=True),
-            mtime=ID(stored=True, sortable=True),
+            size=NUMERIC(bits=64, stored=True, sortable=True),
+            mtime=DATETIME(stored=True, sortable=True),
             audio_album=TEXT(analyzer=my_analyzer, stored=True),
             audio_artist=TEXT(analyzer=my_analyzer, stored=True),
             audio_title=TEXT(analyzer=my_analyzer, stored=True),
@@ -61,12 +226,115 @@ class Index(object):
             audio_year=ID(stored=True)
         )
 
+    @staticmethod
+    def path_key(server_id, path):
+        """Exact key of the document of a file, `path` being analyzed."""
+        return '%s:%s' % (server_id, path)
+
+    @staticmethod
+    def schema_version(schema):
+        """Returns the version of the given schema, see SCHEMA_VERSION."""
+        if 'path_key' not in schema:
+            return 1
+        if not isinstance(schema['size'], NUMERIC):
+            return 2
+        return 3
+
+    @staticmethod
+    def upgrade_fields(fields):
+        """Returns the fields of a document of the current schema, from
+        its stored fields in an index of any schema version."""
+        fields = dict(fields, has_id='a')
+        fields['path_key'] = Index.path_key(fields['server_id'], fields['path'])
+        try:
+            fields['size'] = int(fields.get('size') or 0)
+        except ValueError:
+            fields['size'] = 0
+        if not isinstance(fields.get('mtime'), datetime):
+            mtime = parse_mtime(fields.pop('mtime', None))
+            if mtime is not None:
+                fields['mtime'] = mtime
+        return fields
+
+    def _migrate(self, version):
+        """Upgrade an index made with an older schema, in place.
+
+        Every document is rewritten with the current schema, the index
+        is then optimized so that nothing remains of the old fields.
+        """
+        self.log.info('Migrating the index from schema version %d to %d, every document is rewritten'
+                      % (version, self.SCHEMA_VERSION))
+        schema = self.get_schema()
+        writer = self._idx.writer()
+        for name in ('path_key', 'size', 'mtime'):
+            if name in writer.schema:
+                if type(writer.schema[name]) is type(schema[name]):
+                    continue
+                writer.remove_field(name)
+            writer.add_field(name, schema[name])
+
+        count = 0
+        with writer.searcher() as searcher:
+            for docnum, fields in searcher.reader().iter_docs():
+                writer.delete_document(docnum)
+                writer.add_document(**self.upgrade_fields(fields))
+                count += 1
+        writer.commit(optimize=True)
+        self.log.info('Index migrated : %d documents' % count)
+
     def delete_all_docs(self, server):
-        self.open_writer()
-        self._writer.delete_by_term('server_id', str(server.get_server_id()))
-        self._writer.commit()
+        # Commited with the changes not commited yet, once written
+        self._current_writer().delete_by_term('server_id', str(server.get_server_id()))
+        self.commit()
+        self._manifest.apply([], [], self._idx.latest_generation(),
+                             deleted_servers=[server.get_server_id()])
         self.log.info('All documents of server %s deleted' % server.get_ip_addr())
 
+    def server_documents(self, server_id):
+        """Yields the fields of the commited documents of a server, as
+        given to add_fields."""
+        for shard in self.shards():
+            with self._whoosh_index(shard).searcher() as searcher:
+                for fields in searcher.documents(server_id=str(server_id)):
+                    yield self.upgrade_fields(fields)
+
+    def get_indexed_files(self, server_id):
+        """Returns a {path => mtime} mapping of the documents indexed
+        for the given server, the mtimes being in seconds since the Epoch.
+
+        The stored fields are not read, the answer comes from the manifest.
+        """
+        return self._manifest.get_files(server_id)
+
+    def delete_file(self, server_id, path):
+        """Delete the document of a file from the index.
+
+        Changes need to be commited.
+        """
+        self.delete_files(server_id, [path])
+
+    def delete_files(self, server_id, paths):
+        """Delete the documents of the given files of a server, in batches.
+
+        Changes need to be commited.
+        """
+        paths = list(paths)
+        if self._journal is not None:
+            self._journal.append(('delete', server_id, paths))
+        self._delete_files(server_id, paths)
+
+    def _delete_files(self, server_id, paths):
+        for i in range(0, len(paths), self.DELETE_BATCH):
+            query = Or([Term('path_key', self.path_key(server_id, path))
+                        for path in paths[i:i+self.DELETE_BATCH]])
+            try:
+                self._current_writer().delete_by_query(query)
+            except IndexingError:
+                self.open_writer()
+                self._writer.delete_by_query(query)
+        self._manifest_deleted.extend((server_id, path) for path in paths)
+        self.write_count += len(paths)
+
     def incremental_server_update(self, server_id, current_files):
         """Prepares to incrementaly update the documents for the given server.
 
@@ -74,50 +342,40 @@ class Index(object):
         current_files  -- a list of (path, size, mtime) tuples for each files
                           currently on the server.
 
-        Delete all the outdated files from the index and returns a list
-        of files needing to be reindexed.
+        Delete all the outdated files from the index and returns the files
+        needing to be reindexed.
         """
-
-        def delete_doc(writer, serverid, path):
-            writer.delete_by_query(Term('server_id', str(serverid)) & Term('path', path))
-
-        # Build a {path => (size, mtime)} mapping for quick lookups
-        to_index = {}
-        for path, size, mtime in current_files:
-            to_index[path] = (size, mtime)
-
-        results = self._searcher.documents(server_id=str(server_id))
-        if results:
-            for fields in results:
-                indexed_path = fields['path']
-
-                if indexed_path not in to_index:
-                    # This file was deleted from the server since it was indexed
-                    delete_doc(self._writer, server_id, indexed_path)
-                    self.log.debug("%s has been removed" % indexed_path)
-                else:
-                    size, mtime = to_index[indexed_path]
-                    try:
-                        if mtime > datetime.strptime(fields['mtime'], '%Y-%m-%d %H:%M:%S'):
-                            # This file has been modified since it was indexed
-                            delete_doc(self._writer, server_id, indexed_path)
-                        else:
-                            # up to date, no need to reindex
-                            del to_index[indexed_path]
-                    except ValueError:
-                        delete_doc(self._writer, server_id, indexed_path)
-
-        # return the remaining files
-        return [(path, xsize, xmtime) for (path, (xsize, xmtime)) in to_index.items()]
+        update = ServerUpdate(self, server_id)
+        files = update.filter(current_files)
+        update.finish()
+        return files
 
     def add_document(self, server_id, name, path, size, mtime,
                      audio_album=None, audio_artist=None,
                      audio_title=None, audio_year=None):
         """Add a document with the specified fields in the index.
 
-        Changes need to be commited.
+        `size` is an int and `mtime` a datetime. Changes need to be
+        commited.
+
+        """
+        self.add_fields(self.document_fields(server_id, name, path, size, mtime,
+                                             audio_album, audio_artist, audio_title, audio_year))
 
+    def add_fields(self, fields):
+        """Add a document from all its fields, see document_fields.
+
+        Changes need to be commited.
         """
+        if self._journal is not None:
+            self._journal.append(('add', fields))
+        self._add_document(fields)
+
+    @staticmethod
+    def document_fields(server_id, name, path, size, mtime,
+                        audio_album=None, audio_artist=None,
+                        audio_title=None, audio_year=None):
+        """Returns the fields of the document of a file, see add_document."""
 
         # passing the optional arguments is quite a mess
         # let's build a dict for that purpose
@@ -129,6 +387,7 @@ class Index(object):
                   'name': name,
                   'ext': ext,
                   'path': path,
+                  'path_key': Index.path_key(server_id, path),
                   'size': size,
                   'mtime': mtime,
                   'has_id': 'a'}
@@ -146,30 +405,220 @@ class Index(object):
         if audio_year is not None:
             kwargs['audio_year'] = audio_year
 
+        return kwargs
+
+    def _add_document(self, fields):
         try:
-            self._writer.add_document(**kwargs)
+            self._current_writer().add_document(**fields)
         except IndexingError:
             self.open_writer()
-            self._writer.add_document(**kwargs)
+            self._writer.add_document(**fields)
+        self._manifest_added.append(self._manifest_entry(fields))
+        self.write_count += 1
+
+    def commit(self, optimize=False, merge=True):
+        """Commit the changes in the index.
 
-    def commit(self, optimize=False):
-        """ Commit the changes in the index and optimize it """
+        optimize  -- merge every segment into one
+        merge     -- let whoosh merge the small segments, False to only
+                     write a new segment and leave merging to a
+                     MergeScheduler
+        """
         self.log.info(' -- Begin of Commit -- ')
+        generation = self._idx.latest_generation()
         try:
-            self._writer.commit(optimize=optimize)
+            self._current_writer().commit(optimize=optimize, merge=merge)
         except IndexingError:
             self.open_writer()
-            self._writer.commit(optimize=optimize)
+            self._writer.commit(optimize=optimize, merge=merge)
+        self._wait_commit(self._idx, self._writer, generation)
+        # Released the lock of the index
+        self._writer = None
+        if optimize:
+            self._optimized(datetime.now())
         self.log.info('Index commited')
 
-        self._searcher = self._idx.searcher()
+        # Deleting only affects the documents commited before
+        self._manifest.apply(self._manifest_deleted, self._manifest_added,
+                             self._idx.latest_generation())
+        self._manifest_deleted = []
+        self._manifest_added = []
+        if self._journal is not None:
+            self._journal.truncate()
         self.log.info(' -- End of Commit -- ')
 
+    def rollback(self):
+        """Drop the changes not commited yet."""
+        if self._writer is not None:
+            try:
+                self._writer.cancel()
+            except IndexingError:
+                # Already commited
+                pass
+        self._writer = None
+        self._manifest_deleted = []
+        self._manifest_added = []
+        if self._journal is not None:
+            self._journal.truncate()
+
+    def _wait_commit(self, idx, writer, generation):
+        """Wait for the commit of an AsyncWriter to be written.
+
+        When the index was locked as the writer was opened, whoosh commits
+        in a thread of its own once the lock is released, the journal must
+        not be emptied before. Raises IndexingError if the generation of
+        the index did not change from `generation`, or if the lock was not
+        released within LOCK_TIMEOUT seconds : the commit is then cancelled.
+        """
+        if writer.writer is None:
+            writer.join(self.LOCK_TIMEOUT)
+            if writer.is_alive():
+                writer.cancel()
+                raise IndexingError('%s is still locked after %d seconds'
+                                    % (idx, self.LOCK_TIMEOUT))
+        if idx.latest_generation() == generation:
+            raise IndexingError('The changes were not commited in %s' % idx)
+
+    def shards(self):
+        """Names of the whoosh indexes holding the documents, None being
+        the only one of an index which is not sharded."""
+        return [None]
+
+    def _whoosh_index(self, shard):
+        return self._idx
+
+    def segment_sizes(self, shard=None):
+        """Number of documents, deleted ones included, of each segment."""
+        return [segment.doc_count_all() for segment in self._whoosh_index(shard)._segments()]
+
+    def merge(self, mergetype=None, optimize=False, shard=None):
+        """Merge segments with a writer of its own, while no update is
+        being written.
+
+        mergetype  -- a whoosh merge function, see merging.SizeTieredMerge
+        optimize   -- merge every segment into one
+
+        Returns False if the index is being written.
+        """
+        if not self._merge_lock.acquire(blocking=False):
+            return False
+        try:
+            idx = self._whoosh_index(shard)
+            try:
+                writer = idx.writer()
+            except LockError:
+                self.log.debug('Index locked by a writer, merge postponed')
+                return False
+            before = len(self.segment_sizes(shard))
+            writer.commit(mergetype=mergetype, optimize=optimize)
+            # Merging does not change the documents, only the generation
+            self._manifest.apply([], [], idx.latest_generation(), shard=shard)
+            self.log.info('Merged %s from %d to %d segments'
+                          % ('the index' if shard is None else 'shard %s' % shard,
+                             before, len(self.segment_sizes(shard))))
+            return True
+        finally:
+            self._merge_lock.release()
+
+    def optimize(self, now=None):
+        """Merge every segment into one, in every shard. Returns False if
+        the index is being written."""
+        for shard in self.shards():
+            if len(self.segment_sizes(shard)) > 1 and not self.merge(optimize=True, shard=shard):
+                return False
+        self._optimized(now or datetime.now())
+        return True
+
+    def _load_last_optimization(self):
+        seconds = self._manifest.get_last_optimization()
+        self._last_optimization = None if seconds is None else EPOCH + timedelta(seconds=seconds)
+
+    def _optimized(self, when):
+        """Remember the time of an optimization, in the manifest so that
+        the next process does not optimize the index again too soon."""
+        self._last_optimization = when
+        self._manifest.set_last_optimization(mtime_seconds(when))
+
+    def optimization_age(self, now=None):
+        """Time elapsed since the last optimization, a timedelta.max if
+        the index has not been optimized yet."""
+        if self._last_optimization is None:
+            return timedelta.max
+        return (now or datetime.now()) - self._last_optimization
+
     def close(self):
         self.log.info(' -- Closing writer and index -- ')
         # self._writer.close()
         """ Close the index """
         self._idx.close()
+        self._manifest.close()
+        if self._journal is not None:
+            self._journal.close()
+
+
+class ServerUpdate(object):
+    """Incremental update of the documents of one server.
+
+    The files currently on the server are given to `filter` as they are
+    found, directory after directory. Once the whole server has been
+    scanned, `finish` deletes the documents of the files never seen.
+
+    The outdated documents are deleted by batches, `flush` must be called
+    before commiting the index.
+    """
+
+    def __init__(self, myindex, server_id):
+        self.log = logging.getLogger('ftpvista.index')
+        self._index = myindex
+        self._server_id = server_id
+        # {path => mtime} of the indexed files not seen on the server yet
+        self._unseen = myindex.get_indexed_files(server_id)
+        # paths of the documents to delete
+        self._stale = []
+
+    def _delete(self, path):
+        self._stale.append(path)
+        if len(self._stale) >= Index.DELETE_BATCH:
+            self.flush()
+
+    def flush(self):
+        """Delete the outdated documents found so far."""
+        if len(self._stale) > 0:
+            self._index.delete_files(self._server_id, self._stale)
+            self._stale = []
+
+    def filter(self, files):
+        """Mark the outdated documents of the given files for deletion and
+        returns the files needing to be reindexed.
+
+        files -- an iterable of (path, size, mtime) tuples.
+        """
+        to_index = FileList()
+        for path, size, mtime in files:
+            if path not in self._unseen:
+                # New file
+                to_index.append((path, size, mtime))
+                continue
+
+            indexed_mtime = self._unseen.pop(path)
+            if (mtime - EPOCH) // SECOND > indexed_mtime:
+                # This file has been modified since it was indexed
+                self._delete(path)
+                to_index.append((path, size, mtime))
+            # else up to date, no need to reindex
+        return to_index
+
+    def finish(self):
+        """Delete the documents of the files which were not found on
+        the server. Returns the number of deleted documents."""
+        for path in self._unseen:
+            # This file was deleted from the server since it was indexed
+            self._delete(path)
+            self.log.debug("%s has been removed" % path)
+        deleted = len(self._unseen)
+        self._unseen = {}
+        self.flush()
+        return deleted
 
 
 class FileIndexerContext(pipeline.Context):
@@ -196,109 +645,567 @@ class FileIndexerContext(pipeline.Context):
         return self._extra_data
 
 
+def id3_tag_size(header):
+    """Returns the size of the ID3v2 tag starting with the given 10 bytes,
+    None if they are not the header of a tag."""
+    if len(header) != 10:
+        return None
+    header = struct.unpack('3sBBB4B', header)
+    if header[0] not in [b'ID3', b'3DI']:
+        return None
+    # length of some mp3 header fields is described
+    # by "7-bit-bytes" or sometimes 8-bit bytes...
+    size = 0
+    for b in header[4:9]:
+        size <<= 7
+        size += b
+    return size
+
+
+def id3_ranges(size):
+    """Generator of the byte ranges of a mp3 file of `size` bytes to fetch
+    to get its ID3 tags.
+
+    Each range is yielded as a 'first-last' string and is sent back the
+    bytes fetched, the generator returns the data holding the tags.
+    Nothing is fetched from a file smaller than the header of a tag.
+    """
+    if size < 10:
+        return b''
+    data = yield '0-9'
+    tagsize = id3_tag_size(data)
+    if tagsize is not None:
+        # Tags are at the beginning of the file, so download some more bytes
+        return (yield '0-%d' % (tagsize+10))
+
+    # Tags are perhaps at the end of file then
+    data = yield '%d-%d' % (size-10, size)
+    tagsize = id3_tag_size(data)
+    if tagsize is not None:
+        return (yield '%d-%d' % (max(size-tagsize, 0), size-10))
+
+    # See if there is ID3v1
+    data = yield '%d-%d' % (max(size-128, 0), size)
+    if data[0:3] != b'TAG' or size < 138:
+        return data
+    id3v1 = data
+    data = yield '%d-%d' % (size-138, size-129)
+    tagsize = id3_tag_size(data)
+    if tagsize is None:
+        # ID3v1 only
+        return id3v1
+    # See if there is ID3v2 before ID3v1
+    data = yield '%d-%d' % (max(size-tagsize-148, 0), size-129)
+    return data + id3v1  # Concat ID3v1 to ID3v2
+
+
+def speculative_id3_ranges(size, head, tail=1024, observe=None):
+    """Generator of the byte ranges of a mp3 file of `size` bytes to fetch
+    to get its ID3 tags, see id3_ranges, which gives the same data.
+
+    The first `head` bytes are fetched at once, then the last `tail` bytes
+    if there is no tag at the beginning of the file, instead of the
+    headers of the tags one after the other. A tag larger than that is
+    completed by a precise request. `observe` is called with the size of
+    the tags found at the beginning of the files.
+    """
+    if size < 10:
+        return b''
+    # At least ID3v1 and the header of a tag before it
+    tail = max(tail, 138)
+    known = {}  # offset of the first byte => bytes fetched
+
+    def read(first, last):
+        last = min(last, size - 1)
+        if first < 0:
+            return None
+        for offset, data in known.items():
+            if offset <= first and last < offset + len(data):
+                return data[first-offset:last-offset+1]
+        return None
+
+    if size <= head + tail:
+        known[0] = yield '0-%d' % (size-1)
+    else:
+        known[0] = yield '0-%d' % (head-1)
+
+    tagsize = id3_tag_size(read(0, 9) or b'')
+    if tagsize is not None:
+        if observe is not None:
+            observe(tagsize+10)
+        data = read(0, tagsize+10)
+        if data is None:
+            # Larger than guessed, fetch the rest of the tag
+            data = known[0]
+            known[len(data)] = yield '%d-%d' % (len(data), tagsize+10)
+            data += known[len(data)]
+        return data
+
+    tail_first = max(size-tail, 0)
+    if read(tail_first, size-1) is None:
+        known[tail_first] = yield '%d-%d' % (tail_first, size-1)
+
+    # Tags are perhaps at the end of file then
+    tagsize = id3_tag_size(read(size-10, size-1) or b'')
+    if tagsize is not None:
+        first = max(size-tagsize, 0)
+        data = read(first, size-10)
+        if data is None:
+            data = (yield '%d-%d' % (first, tail_first-1)) + read(tail_first, size-10)
+        return data
+
+    # See if there is ID3v1
+    id3v1 = read(max(size-128, 0), size-1)
+    if id3v1[0:3] != b'TAG':
+        return id3v1
+    header = read(size-138, size-129)
+    tagsize = id3_tag_size(header or b'')
+    if tagsize is None:
+        # ID3v1 only
+        return id3v1
+    # ID3v2 before ID3v1
+    first = max(size-tagsize-148, 0)
+    data = read(first, size-129)
+    if data is None:
+        data = (yield '%d-%d' % (first, tail_first-1)) + read(tail_first, size-129)
+    return data + id3v1  # Concat ID3v1 to ID3v2
+
+
+class TagSizeEstimator(object):
+    """Learns how many bytes to fetch at the beginning of the audio files
+    of a server to get their whole tags, see speculative_id3_ranges.
+
+    The head size covers `percentile` of the last `window` tags found,
+    the others need a second request.
+    """
+
+    def __init__(self, initial=4096, minimum=1024, maximum=256*1024, percentile=0.9, window=200):
+        self._initial = initial
+        self._minimum = minimum
+        self._maximum = maximum
+        self._percentile = percentile
+        self._sizes = deque(maxlen=window)
+        self._head = initial
+
+    def observe(self, tagsize):
+        self._sizes.append(tagsize)
+        if len(self._sizes) >= 10:
+            sizes = sorted(self._sizes)
+            size = sizes[min(int(len(sizes) * self._percentile), len(sizes) - 1)]
+            # Rounded up to the next KB
+            size = (size // 1024 + 1) * 1024
+            self._head = max(self._minimum, min(self._maximum, size))
+
+    def head_size(self):
+        return self._head
+
+
+class TagFetchStats(object):
+    """Requests, connections, bytes and time needed to fetch the tags of
+    the files."""
+
+    def __init__(self):
+        self.files = 0
+        self.requests = 0
+        self.connections = 0
+        self.bytes = 0
+        # Spent fetching the files, one after the other or not
+        self.seconds = 0
+
+    def __str__(self):
+        files = max(self.files, 1)
+        return ('%d files, %.2f requests, %.2f connections, %d bytes and %.0f ms per file'
+                % (self.files, self.requests / files, self.connections / files, self.bytes / files,
+                   self.seconds * 1000 / files))
+
+
+# The tinytag parsers of the formats other than mp3, run over a RangeFile
+TAG_PARSERS = {'flac': tinytag.Flac, 'ogg': tinytag.Ogg, 'oga': tinytag.Ogg,
+               'wav': tinytag.Wave, 'wma': tinytag.Wma}
+
+# The extensions of the audio files whose tags are fetched
+TAG_EXTENSIONS = [ext for ext in AUDIO_EXTENSIONS if ext == 'mp3' or ext in TAG_PARSERS]
+
+
 class FetchID3TagsStage(pipeline.Stage):
-    """Pipeline stage to find the ID3 tags of audio files."""
+    """Pipeline stage to find the tags of audio files.
 
-    def __init__(self, server_addr, persist=None, extensions=['mp3']):
+    The ID3 tags of the mp3 files are fetched with id3_ranges or
+    speculative_id3_ranges, the tags of the other formats by the tinytag
+    parsers reading a RangeFile.
+    """
+
+    FETCH_ERRORS = (pycurl.error,)
+
+    # Raised by the parsers on broken files
+    TAG_ERRORS = (struct.error, ValueError, LookupError, ZeroDivisionError)
+
+    def __init__(self, server_addr, persist=None, extensions=TAG_EXTENSIONS, speculative=True,
+                 tag_cache=None):
         """
         :Parameters:
             -`server_addr`: the server IP address
             -`extensions`: list of file extensions for which to try to get tags
+            -`speculative`: fetch the beginning and the end of the files at
+                            once, instead of the headers of the tags one
+                            after the other
+            -`tag_cache`: a tagcache.ServerTagCache looked up before
+                          fetching anything, None to always fetch the tags
         """
         self.log = logging.getLogger('ftpvista.pipe.id3.%s' % server_addr.replace('.', '_'))
         self._server_addr = server_addr
         self._extensions = extensions
         self._persist = persist
+        self._speculative = speculative
+        self._tag_cache = tag_cache
+        self._estimator = TagSizeEstimator()
+        self.stats = TagFetchStats()
         self._buffer = BytesIO()
         self._curl = pycurl.Curl()
 
+    def _url(self, path):
+        return 'ftp://{}{}'.format(self._server_addr, pathname2url(path))
+
+    @staticmethod
+    def _extension(path):
+        return os.path.splitext(path)[1][1:].lower()
+
+    def _is_candidate(self, path, size):
+        """Whether the tags of the file are fetched, not if it is smaller
+        than the header of an ID3 tag, empty files included."""
+        return size >= 10 and self._extension(path) in self._extensions
+
+    def _ranges(self, size):
+        """Returns the generator of the ranges to fetch for a file."""
+        self.stats.files += 1
+        if self._speculative:
+            return speculative_id3_ranges(size, self._estimator.head_size(),
+                                          observe=self._estimator.observe)
+        return id3_ranges(size)
+
     def _fetch_range(self, arange):
         self._buffer = BytesIO()
         self._curl.setopt(pycurl.WRITEDATA, self._buffer)
         self._curl.setopt(pycurl.RANGE, arange)
+        self.stats.requests += 1
         self._curl.perform()
+        self.stats.connections += self._curl.getinfo(pycurl.NUM_CONNECTS)
+        self.stats.bytes += len(self._buffer.getvalue())
 
-    def _calc_size(self, bytestr, bits_per_byte):
-        # length of some mp3 header fields is described
-        # by "7-bit-bytes" or sometimes 8-bit bytes...
-        ret = 0
-        for b in bytestr:
-            ret <<= bits_per_byte
-            ret += b
-        return ret
-
-    def _get_tag_size(self):
-        self._fetch_range('0-9')
-        header = struct.unpack('3sBBB4B', self._buffer.getbuffer())
-        if header[0] in [b'ID3', b'3DI']:
-            return self._calc_size(header[4:9], 7)
-        return None
+    def _open(self, path):
+        """Prepare the fetching of the ranges of the file at path."""
+        self._curl.setopt(pycurl.URL, self._url(path))
 
     def _fetch_data(self, path, size):
-        self._curl.setopt(pycurl.URL, 'ftp://{}{}'.format(self._server_addr, pathname2url(path)))
+        self._open(path)
+        ranges = self._ranges(size)
         try:
-            tagsize = self._get_tag_size()
-            if tagsize is not None:
-                # Tags are at the beginning of the file, so download some more bytes
-                self._fetch_range('0-%d' % (tagsize+10))
-            else:
-                # Tags are perhaps at the end of file then
-                self._fetch_range('%d-%d' % (size-10, size))
-                tagsize = self._get_tag_size()
-                if tagsize is not None:
-                    self._fetch_range('%d-%d' % (size-tagsize, size-10))
-                else:
-                    # See if there is ID3v1
-                    self._fetch_range('%d-%d' % (size-128, size))
-                    if self._buffer.getvalue()[0:3] == b'TAG':
-                        id3v1 = self._buffer.getvalue()
-                        self._fetch_range('%d-%d' % (size-138, size-129))
-                        tagsize = self._get_tag_size()
-                        # See if there is ID3v2 before ID3v1
-                        if tagsize is not None:
-                            self._fetch_range('%d-%d' % (size-tagsize-148, size-129))
-                            self._buffer.write(id3v1)  # Concat ID3v1 to ID3v2
-            self._buffer.seek(0)
+            arange = next(ranges)
+            while True:
+                self._fetch_range(arange)
+                arange = ranges.send(self._buffer.getvalue())
+        except StopIteration as e:
+            self._buffer = BytesIO(e.value)
             return True
-        except pycurl.error as e:
-            self.log.exception('_fetch_data error', e)
+        except self.FETCH_ERRORS as e:
+            self.log.error('%s : %r' % (path, e))
             return False
 
+    @classmethod
+    def _parser(cls, path):
+        """Returns the tinytag parser of the file read with a RangeFile,
+        None for a mp3 file."""
+        return TAG_PARSERS.get(cls._extension(path))
+
+    def _read_tags(self, path, data, parser=tinytag.ID3, size=None):
+        """Returns the {tag => value} mapping of the tags found in the
+        fetched data."""
+        found = {}
+        try:
+            tags = parser(data, size)
+            tags.load(tags=True, duration=False, image=False)
+            for tag in ['album', 'artist', 'title', 'track', 'year', 'genre']:
+                value = getattr(tags, tag)
+                if value is not None:
+                    found[tag] = value
+        except self.TAG_ERRORS as e:
+            self.log.error('%s : %r' % (path, e))
+        return found
+
+    def _set_tags(self, context, tags):
+        """Add the tags in the context object."""
+        for tag, value in tags.items():
+            context.set_extra_data('audio_%s' % tag, value)
+
+    def _cached_tags(self, context):
+        """Returns the tags of the file from the cache, None if unknown."""
+        if self._tag_cache is None:
+            return None
+        return self._tag_cache.get(context.get_path(), context.get_size(), mtime_seconds(context.get_mtime()))
+
+    def _fetched_tags(self, context, data, parser=tinytag.ID3):
+        """Read the tags in the fetched data, add them in the context
+        object and in the cache."""
+        tags = self._read_tags(context.get_path(), data, parser, context.get_size())
+        self._set_tags(context, tags)
+        if self._tag_cache is not None:
+            self._tag_cache.put(context.get_path(), context.get_size(), mtime_seconds(context.get_mtime()), tags)
+
     def execute(self, context):
         path = context.get_path()
         size = context.get_size()
 
         # if the file has a candidate extension
-        if any([path.lower().endswith(x) for x in self._extensions]):
-            self.log.debug('Trying to get ID3 data for %s' % path)
-
-            # Fetch the data from the server
-            if self._fetch_data(path, size):
-                id3_map = {
-                    'album': None,
-                    'artist': None,
-                    'title': None,
-                    'track': None,
-                    'year': None,
-                    'genre': None
-                }
-                # Look for tags
-                try:
-                    tags = tinytag.ID3(self._buffer, None)
-                    tags.load(tags=True, duration=False, image=False)
-                    for tag in ['album', 'artist', 'title', 'track', 'year', 'genre']:
-                        value = getattr(tags, tag)
-                        if value is not None:
-                            id3_map[tag] = value
-                            # add the tag in the context object
-                            context.set_extra_data('audio_%s' % tag, value)
-                except (UnicodeDecodeError, struct.error) as e:
-                    self.log.error('%s : %r' % (path, e))
+        if self._is_candidate(path, size):
+            tags = self._cached_tags(context)
+            if tags is not None:
+                self._set_tags(context, tags)
+            else:
+                self.log.debug('Trying to get ID3 data for %s' % path)
+
+                # Fetch the data from the server
+                self._fetch_tags(context)
 
         # Whatever the outcome of this stage,
         # continue the execution of the pipeline
         return True
 
+    def _fetch_tags(self, context):
+        """Fetch the tags of a file one request after the other."""
+        path = context.get_path()
+        begin = time.monotonic()
+        parser = self._parser(path)
+        if parser is not None:
+            self._fetch_lazily(context, parser)
+        elif self._fetch_data(path, context.get_size()):
+            self._fetched_tags(context, self._buffer)
+        self._fetched(path, begin)
+
+    def _read_range(self, first, last):
+        self._fetch_range('%d-%d' % (first, last))
+        return self._buffer.getvalue()
+
+    def _fetch_lazily(self, context, parser):
+        """Fetch the tags of a file of another format than mp3, only the
+        blocks its parser reads are fetched."""
+        path = context.get_path()
+        self.stats.files += 1
+        self._open(path)
+        try:
+            self._fetched_tags(context, RangeFile(self._read_range, context.get_size()), parser)
+        except self.FETCH_ERRORS as e:
+            self.log.error('%s : %r' % (path, e))
+
+    def _fetched(self, path, begin):
+        """Count the time spent fetching a file since begin."""
+        elapsed = time.monotonic() - begin
+        self.stats.seconds += elapsed
+        self.log.debug('%s fetched in %.0f ms' % (path, elapsed * 1000))
+
+    def flush(self):
+        if self.stats.files > 0:
+            self.log.info('Tags fetched : %s' % self.stats)
+        if self._tag_cache is not None:
+            self._tag_cache.flush()
+            if self._tag_cache.stats.lookups() > 0:
+                self.log.info('Tag cache : %s' % self._tag_cache.stats)
+
+
+class _TagFetch(object):
+    """The transfers of the ranges of one file, see
+    ConcurrentFetchID3TagsStage"""
+
+    def __init__(self, context, handle, ranges):
+        self.context = context
+        self.handle = handle
+        self.ranges = ranges
+        self.range = None
+        self.buffer = None
+        self.retried = False
+        self.begin = time.monotonic()
+
+
+class ConcurrentFetchID3TagsStage(FetchID3TagsStage):
+    """Pipeline stage fetching the ID3 tags of many audio files at the same
+    time, with a pycurl.CurlMulti.
+
+    The contexts of the mp3 files are handed to `next_stage` once their
+    tags are fetched, in any order, the execution of the pipeline stops
+    there for them. The other contexts go on right away, the tags of the
+    other audio formats being fetched first, one request after the other.
+    `flush` waits for the transfers still running.
+    """
+
+    def __init__(self, server_addr, next_stage, persist=None, extensions=TAG_EXTENSIONS, concurrency=8,
+                 speculative=True, tag_cache=None):
+        """
+        :Parameters:
+            -`server_addr`: the server IP address
+            -`next_stage`: the stage executed with the contexts once their
+                           tags are fetched
+            -`extensions`: list of file extensions for which to try to get tags
+            -`concurrency`: maximum number of files fetched at once
+            -`speculative`: see FetchID3TagsStage
+            -`tag_cache`: see FetchID3TagsStage, the files found in it go
+                          on right away
+        """
+        super(ConcurrentFetchID3TagsStage, self).__init__(server_addr, persist, extensions, speculative,
+                                                          tag_cache)
+        self._next_stage = next_stage
+        self._multi = pycurl.CurlMulti()
+        try:
+            self._multi.setopt(pycurl.M_MAX_HOST_CONNECTIONS, concurrency)
+        except (AttributeError, pycurl.error):
+            # libcurl older than 7.30, the handles are limited anyway
+            pass
+        self._free = [pycurl.Curl() for _ in range(concurrency)]
+        self._fetches = {}   # handle => _TagFetch
+
+    def execute(self, context):
+        path = context.get_path()
+        if not self._is_candidate(path, context.get_size()):
+            return True
+        tags = self._cached_tags(context)
+        if tags is not None:
+            self._set_tags(context, tags)
+            return True
+        if self._parser(path) is not None:
+            # Read block after block by its parser, on the side
+            self._fetch_tags(context)
+            return True
+
+        self.log.debug('Trying to get ID3 data for %s' % path)
+        while len(self._free) == 0:
+            self._wait()
+        fetch = _TagFetch(context, self._free.pop(), self._ranges(context.get_size()))
+        fetch.handle.setopt(pycurl.URL, self._url(path))
+        self._fetches[fetch.handle] = fetch
+        self._next_range(fetch, None)
+        self._perform()
+        return False
+
+    def flush(self):
+        while len(self._fetches) > 0:
+            self._wait()
+        super(ConcurrentFetchID3TagsStage, self).flush()
+
+    def _next_range(self, fetch, data):
+        """Start the transfer of the next range of the file, given the data
+        of the previous one."""
+        try:
+            arange = next(fetch.ranges) if data is None else fetch.ranges.send(data)
+        except StopIteration as e:
+            self._done(fetch, e.value)
+            return
+        fetch.range = arange
+        fetch.retried = False
+        fetch.handle.setopt(pycurl.FRESH_CONNECT, 0)
+        self._start(fetch)
+
+    def _start(self, fetch):
+        fetch.buffer = BytesIO()
+        fetch.handle.setopt(pycurl.WRITEDATA, fetch.buffer)
+        fetch.handle.setopt(pycurl.RANGE, fetch.range)
+        self.stats.requests += 1
+        self._multi.add_handle(fetch.handle)
+
+    def _done(self, fetch, data):
+        del self._fetches[fetch.handle]
+        self._free.append(fetch.handle)
+        if data is not None:
+            self._fetched_tags(fetch.context, BytesIO(data))
+        self._fetched(fetch.context.get_path(), fetch.begin)
+        self._next_stage.execute(fetch.context)
+
+    def _perform(self):
+        """Let the transfers progress, without waiting."""
+        while True:
+            ret, _ = self._multi.perform()
+            if ret != pycurl.E_CALL_MULTI_PERFORM:
+                break
+        while True:
+            queued, ok, failed = self._multi.info_read()
+            for handle in ok:
+                self._multi.remove_handle(handle)
+                fetch = self._fetches[handle]
+                self.stats.connections += handle.getinfo(pycurl.NUM_CONNECTS)
+                self.stats.bytes += len(fetch.buffer.getvalue())
+                self._next_range(fetch, fetch.buffer.getvalue())
+            for handle, _, message in failed:
+                self._multi.remove_handle(handle)
+                fetch = self._fetches[handle]
+                self.stats.connections += handle.getinfo(pycurl.NUM_CONNECTS)
+                if not fetch.retried:
+                    # The reply to an interrupted transfer may come late
+                    # on a reused connection and be taken for the reply
+                    # to the next command, try again on a new connection
+                    self.log.debug('%s : %s, retrying' % (fetch.context.get_path(), message))
+                    fetch.retried = True
+                    handle.setopt(pycurl.FRESH_CONNECT, 1)
+                    self._start(fetch)
+                    continue
+                self.log.error('%s : %s' % (fetch.context.get_path(), message))
+                self._done(fetch, None)
+            if queued == 0:
+                break
+
+    def _wait(self):
+        """Wait for some transfers to progress."""
+        if self._multi.select(1.0) == -1:
+            # Nothing to wait for, libcurl may be between two steps
+            time.sleep(0.01)
+        self._perform()
+
+
+def parse_range(arange):
+    """Returns the first and the last byte of a 'first-last' range, see
+    id3_ranges."""
+    first, _, last = arange.rpartition('-')
+    return max(int(first), 0), int(last)
+
+
+class FTPFetchID3TagsStage(FetchID3TagsStage):
+    """Pipeline stage fetching the ID3 tags of audio files one after the
+    other with a ftp_tools.FTPRangeReader : over a single connection kept
+    logged in, with a single CWD per directory.
+
+    The files are expected directory by directory, as sorted by
+    IndexUpdateCoordinator. The connection of the scanner is used while
+    it is idle.
+    """
+
+    FETCH_ERRORS = ftplib.all_errors
+
+    def __init__(self, server_addr, persist=None, extensions=TAG_EXTENSIONS, speculative=True,
+                 tag_cache=None, scanner=None):
+        """
+        :Parameters:
+            -`server_addr`: the server IP address
+            -`extensions`: list of file extensions for which to try to get tags
+            -`speculative`: see FetchID3TagsStage
+            -`tag_cache`: see FetchID3TagsStage
+            -`scanner`: the scanner.FTPScanner listing the server, whose
+                        connection is borrowed while open, or None
+        """
+        super(FTPFetchID3TagsStage, self).__init__(server_addr, persist, extensions, speculative,
+                                                   tag_cache)
+        self._reader = FTPRangeReader(server_addr, scanner)
+        self._path = None
+
+    def _open(self, path):
+        self._path = path
+
+    def _fetch_range(self, arange):
+        first, last = parse_range(arange)
+        self.stats.requests += 1
+        connections = self._reader.connections
+        self._buffer = BytesIO(self._reader.read(self._path, first, last))
+        self.stats.connections += self._reader.connections - connections
+        self.stats.bytes += len(self._buffer.getvalue())
+
+    def close(self):
+        self._reader.close()
+
 
 class WriteDataStage(pipeline.Stage):
     """ Pipeline stage object that writes the informations in the given index.
@@ -322,8 +1229,8 @@ class WriteDataStage(pipeline.Stage):
             server_id=str(self._server_id),
             name=os.path.basename(path),
             path=path,
-            size=str(context.get_size()),
-            mtime=str(context.get_mtime()),
+            size=context.get_size(),
+            mtime=context.get_mtime(),
             audio_artist=get_extra('audio_artist'),
             audio_title=get_extra('audio_title'),
             audio_album=get_extra('audio_album'),
@@ -333,11 +1240,29 @@ class WriteDataStage(pipeline.Stage):
         return True
 
 
-def build_indexer_pipeline(server_id, server_addr, myindex, persist):
-    """Helper function to make a basic indexing pipeline"""
+def build_indexer_pipeline(server_id, server_addr, myindex, persist, tag_fetch_concurrency=1,
+                           tag_cache=None, scanner=None):
+    """Helper function to make a basic indexing pipeline
+
+    tag_fetch_concurrency -- number of files whose tags are fetched at
+                             the same time, the pipeline must be flushed
+                             when more than 1. 1 fetches them over a
+                             single connection kept open
+    tag_cache             -- a tagcache.TagCache looked up before fetching
+                             the tags, or None
+    scanner               -- a FTPScanner whose connection is used to fetch
+                             the tags one after the other while idle
+    """
     pipe = pipeline.Pipeline()
-    pipe.append_stage(FetchID3TagsStage(server_addr, persist))
-    pipe.append_stage(WriteDataStage(server_addr, server_id, myindex))
+    write = WriteDataStage(server_addr, server_id, myindex)
+    server_cache = None if tag_cache is None else tag_cache.server(server_id)
+    if tag_fetch_concurrency > 1:
+        pipe.append_stage(ConcurrentFetchID3TagsStage(server_addr, write, persist,
+                                                      concurrency=tag_fetch_concurrency,
+                                                      tag_cache=server_cache))
+    else:
+        pipe.append_stage(FTPFetchID3TagsStage(server_addr, persist, tag_cache=server_cache, scanner=scanner))
+    pipe.append_stage(write)
 
     return pipe
 
@@ -345,7 +1270,14 @@ def build_indexer_pipeline(server_id, server_addr, myindex, persist):
 class IndexUpdateCoordinator(object):
     """Coordinate the scanning and indexing of FTP servers."""
 
-    def __init__(self, persist, myindex, min_update_interval, max_depth):
+    MERGE_POLICIES = ('tiered', 'commit', 'optimize')
+
+    def __init__(self, persist, myindex, min_update_interval, max_depth,
+                 scan_connections=1, checkpoint_interval=0,
+                 checkpoint_max_age=timedelta(hours=24), full_rescan_every=0,
+                 recursive_listing=False, capabilities_max_age=timedelta(days=7),
+                 merge_policy='tiered', commit_every=0, commit_interval=0,
+                 tag_fetch_concurrency=1, tag_cache=None):
         """Initialize an update coordinator.
 
         Args:
@@ -353,19 +1285,86 @@ class IndexUpdateCoordinator(object):
           index: an instance of Index
           min_update_interval : a timedelta object, this is the minimum time
                                 we want to wait between two updates.
+          scan_connections : number of connections used to crawl each server.
+          checkpoint_interval : seconds between two checkpoints of a scan,
+                                0 to disable resumable scans.
+          checkpoint_max_age : a timedelta object, age after which the
+                               checkpoint of an interrupted scan is dropped.
+          full_rescan_every : the unchanged directories are served from a
+                              listing cache, but every full_rescan_every
+                              scans. 0 to disable the listing cache.
+          recursive_listing : try to list the whole servers at once with
+                              LIST -R or STAT -R.
+          capabilities_max_age : a timedelta object, age after which the
+                                 features of a server are probed again.
+          merge_policy : what is done with the segments of the index once a
+                         server is updated. 'tiered' only writes a new
+                         segment, merged later by a MergeScheduler,
+                         'commit' lets whoosh merge the small segments
+                         and 'optimize' merges the whole index.
+          commit_every : number of documents indexed between two partial
+                         commits during the update of a server, 0 to
+                         commit only once the server is updated.
+          commit_interval : maximum seconds between two partial commits
+                            during the update of a server, 0 to disable.
+          tag_fetch_concurrency : number of audio files of a server whose
+                                  tags are fetched at the same time.
+          tag_cache : a tagcache.TagCache of the tags already fetched, or
+                      None.
         """
         self.log = logging.getLogger('ftpvista.coordinator')
         self._persist = persist
         self._index = myindex
         self._update_interval = min_update_interval
         self._max_depth = max_depth
+        self._scan_connections = scan_connections
+        self._checkpoint_interval = checkpoint_interval
+        self._checkpoint_max_age = checkpoint_max_age
+        self._full_rescan_every = full_rescan_every
+        self._recursive_listing = recursive_listing
+        self._capabilities_max_age = capabilities_max_age
+        if merge_policy not in self.MERGE_POLICIES:
+            raise ValueError('Unknown merge policy %r' % merge_policy)
+        self._merge_policy = merge_policy
+        self._commit_every = commit_every
+        self._commit_interval = commit_interval
+        self._tag_fetch_concurrency = tag_fetch_concurrency
+        self._tag_cache = tag_cache
+
+    def _needs_update(self, server):
+        return (datetime.now() - server.get_last_scanned()) >= self._update_interval
 
     def update_server(self, server_addr):
         """Update the server at the given address if an update is needed."""
         server = self._persist.get_server_by_ip(server_addr)
-        if(datetime.now() - server.get_last_scanned()) >= self._update_interval:
+        if self._needs_update(server):
             self._do_update(server)
 
+    def update_servers(self, server_addrs, max_connections=64):
+        """Update the servers at the given addresses if an update is needed.
+
+        The servers are all scanned at the same time with the asyncio
+        scanning engine, then indexed one after the other.
+        """
+        servers = []
+        for server_addr in server_addrs:
+            server = self._persist.get_server_by_ip(server_addr)
+            if server not in servers and self._needs_update(server):
+                servers.append(server)
+        if len(servers) == 0:
+            return
+
+        self.log.info('Starting to scan %d servers at once' % len(servers))
+        pool = AsyncScanPool(max_connections, self._scan_connections)
+        results = pool.scan([server.get_ip_addr() for server in servers], max_depth=self._max_depth)
+        for server in servers:
+            files = results[server.get_ip_addr()]
+            try:
+                self._index_files(server, None if files is None else files.chunks())
+            except IndexingError as e:
+                self.log.error('Unable to commit the update of %s, retried later : %s'
+                               % (server.get_ip_addr(), e))
+
     def _do_update(self, server):
         server_addr = server.get_ip_addr()
         server_id = server.get_server_id()
@@ -373,46 +1372,157 @@ class IndexUpdateCoordinator(object):
         # list the files present on the server
         self.log.info('Starting to scan %s (server id : %d)' % (server_addr, server_id))
 
-        scanner = FTPScanner(server_addr)
-        files = scanner.scan(max_depth=self._max_depth)
-        if files is None:
+        checkpoint = None
+        if self._checkpoint_interval > 0:
+            checkpoint = ServerScanCheckpoint(self._persist, server, self._checkpoint_max_age)
+        listing_cache = None
+        if self._full_rescan_every > 0:
+            listing_cache = ServerListingCache(self._persist, server, self._full_rescan_every)
+        known = self._persist.get_capabilities(server, self._capabilities_max_age)
+        capabilities = None
+        if known is not None:
+            capabilities = FTPCapabilities.from_dict(known)
+        scanner = FTPScanner(server_addr, connections=self._scan_connections,
+                             checkpoint=checkpoint, checkpoint_interval=self._checkpoint_interval,
+                             listing_cache=listing_cache, recursive=self._recursive_listing,
+                             capabilities=capabilities)
+        try:
+            # A single connection is idle while its files are indexed
+            self._index_files(server, scanner.iter_scan(max_depth=self._max_depth),
+                              scanner if self._scan_connections <= 1 else None)
+        except ftplib.all_errors as e:
+            scanner.log_scan_error(e)
+        except IndexingError as e:
+            # Rolled back by _index_files
+            self.log.error('Unable to commit the update of %s, retried later : %s' % (server_addr, e))
+        finally:
+            # Keep what was found, even if the scan failed
+            if scanner.capabilities.probed:
+                self._persist.save_capabilities(server, scanner.capabilities.to_dict(),
+                                                probed=known is None)
+
+    def _commit(self):
+        if self._merge_policy == 'optimize':
+            self._index.commit(optimize=True)
+        else:
+            self._index.commit(merge=self._merge_policy == 'commit')
+
+    def _partial_commit_due(self, nb_docs, since):
+        """Whether the documents indexed so far must be commited, nb_docs
+        documents were indexed since the last commit, done at since."""
+        if nb_docs == 0:
+            return False
+        if self._commit_every > 0 and nb_docs >= self._commit_every:
+            return True
+        return self._commit_interval > 0 and time.monotonic() - since >= self._commit_interval
+
+    def _partial_commit(self, server, update, mypipeline):
+        """Commit the documents indexed so far, the update of the server
+        goes on.
+
+        The server is not marked as scanned, if the update is interrupted
+        the next one goes through the whole server again and only indexes
+        the files not commited yet.
+        """
+        mypipeline.flush()
+        update.flush()
+        self._commit()
+        self.log.info('Partial commit of server %d (%s)' % (server.get_server_id(),
+                                                           server.get_ip_addr()))
+
+    def _index_files(self, server, files_stream, scanner=None):
+        """Index the files of the server as they are found.
+
+        files_stream -- an iterable of lists of (path, size, mtime) tuples,
+                        usually one list per directory, or None if the
+                        server could not be scanned.
+        scanner      -- the FTPScanner of files_stream, whose connection
+                        may be used to fetch the tags
+        """
+        server_addr = server.get_ip_addr()
+        server_id = server.get_server_id()
+
+        if files_stream is None:
             self.log.error('Impossible to scan any file, f**k it.')
             return
-        if len(files) == 0:
-            self.log.info('No file in this FTP, we can skip it.')
-            self._persist.rollback()
-            return
-        # compute the size of all the files found
-        size = reduce(lambda total_size, file: total_size + file[1], files, 0)
-        self.log.info('Found %d files (%d G) on %s' % (len(files),
-                                                       size / (1073741824),  # 1073741824 = 1024 ** 3
-                                                       server_addr))
-
-        # Set new informatons about this server in the DB
-        server.set_nb_files(len(files))
-        server.set_files_size(size)
-
-        # filter out the files already indexed and up to date
-        files = self._index.incremental_server_update(server_id, files)
-
-        # sort the files by path, may reduce the CWDs if needed to fetch infos
-        # from the FTP server and makes the potential errors append always in
-        # the same order.
-        files = sorted(files, key=lambda file: file[0])
-
-        # Index the files
-        mypipeline = build_indexer_pipeline(server_id, server_addr, self._index, self._persist)
-        # Reopen writer
-        # self._index.open_writer()
-        for path, size, mtime in files:
-            ctx = FileIndexerContext(path, size, mtime)
-            mypipeline.execute(ctx)
-
-        # Scan done, update the last scanned date
-        server.update_last_scanned()
 
-        # commit the changes
-        self._persist.save()
-        self._index.commit(optimize=True)
+        # A server back after a long time gets its archived documents
+        # back, only the files changed since are indexed again
+        self._persist.restore_server(server)
 
-        self.log.info('Server %d (%s) updated' % (server_id, server_addr))
+        update = ServerUpdate(self._index, server_id)
+        mypipeline = build_indexer_pipeline(server_id, server_addr, self._index, self._persist,
+                                            self._tag_fetch_concurrency, self._tag_cache, scanner)
+        try:
+            nb_files = 0
+            size = 0
+            # documents indexed since the last commit
+            nb_docs = 0
+            last_commit = time.monotonic()
+            try:
+                for files in files_stream:
+                    nb_files += len(files)
+                    size += reduce(lambda total_size, file: total_size + file[1], files, 0)
+
+                    # filter out the files already indexed and up to date, then
+                    # sort them by path, may reduce the CWDs if needed to fetch
+                    # infos from the FTP server and makes the potential errors
+                    # append always in the same order.
+                    for path, fsize, mtime in sorted(update.filter(files), key=lambda file: file[0]):
+                        ctx = FileIndexerContext(path, fsize, mtime)
+                        mypipeline.execute(ctx)
+                        nb_docs += 1
+                        if self._partial_commit_due(nb_docs, last_commit):
+                            self._partial_commit(server, update, mypipeline)
+                            nb_docs = 0
+                            last_commit = time.monotonic()
+            except ftplib.all_errors:
+                # Keep what has been indexed so far, but the files not seen yet
+                # must not be deleted
+                self._persist.rollback()
+                mypipeline.flush()
+                update.flush()
+                self._commit()
+                raise
+
+            if nb_files == 0:
+                self.log.info('No file in this FTP, we can skip it.')
+                self._persist.rollback()
+                return
+
+            self.log.info('Found %d files (%d G) on %s' % (nb_files,
+                                                           size / (1073741824),  # 1073741824 = 1024 ** 3
+                                                           server_addr))
+
+            # The tags still being fetched
+            mypipeline.flush()
+
+            # The files not found during the scan were deleted from the server
+            update.finish()
+
+            # Set new informatons about this server in the DB
+            server.set_nb_files(nb_files)
+            server.set_files_size(size)
+
+            # Scan done, update the last scanned date
+            server.update_last_scanned()
+
+            # commit the changes, the server is scanned again if the index
+            # could not be
+            self._commit()
+            self._persist.save()
+
+            self.log.info('Server %d (%s) updated' % (server_id, server_addr))
+        except ftplib.all_errors:
+            raise
+        except Exception:
+            # Not commited with the next server, they are indexed again by
+            # the next update of this one
+            self.log.error('Update of server %d (%s) failed, the changes not commited are dropped'
+                           % (server_id, server_addr))
+            self._persist.rollback()
+            self._index.rollback()
+            raise
+        finally:
+            # The connection kept open to fetch the tags
+            mypipeline.close()
@@ -0,0 +1,545 @@
+# -*- coding: utf-8 -*-
+
+import ftplib
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from datetime import datetime
+from io import BytesIO
+
+from whoosh import index as whoosh_index
+from whoosh.fields import ID
+from whoosh.query import DateRange, NumericRange
+
+from . import index
+from . import pipeline
+from . import tagcache
+from . import tinytag
+from .async_scanner_test import make_ftp_class, start_ftp_server
+from .rangefile_test import audio_files, expected_tags
+from .scanner import FTPScanner
+from pyftpdlib.handlers import FTPHandler
+
+
+OLD = datetime(2015, 1, 2, 3, 4, 5)
+NEW = datetime(2016, 1, 2, 3, 4, 5)
+
+
+class TestIndexUpdate(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'index')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def open(self):
+        return index.Index(self.path, None)
+
+    def add(self, idx, server_id, path, mtime=OLD):
+        idx.add_document(str(server_id), os.path.basename(path), path, 10, mtime)
+
+    def paths(self, idx, server_id):
+        with idx._idx.searcher() as searcher:
+            return sorted(fields['path'] for fields in searcher.documents(server_id=str(server_id)))
+
+    def fill(self, idx):
+        for path in ('/a b.txt', '/a.txt', '/b/a b.txt', '/keep.txt', '/a-b.txt'):
+            self.add(idx, 1, path)
+        self.add(idx, 2, '/a b.txt')
+        idx.commit()
+
+    def testExactDeletion(self):
+        idx = self.open()
+        self.fill(idx)
+
+        update = index.ServerUpdate(idx, 1)
+        to_index = update.filter([('/a.txt', 10, NEW), ('/keep.txt', 10, OLD), ('/a-b.txt', 10, OLD)])
+        self.assertEqual(list(to_index), [('/a.txt', 10, NEW)])
+        self.add(idx, 1, '/a.txt', NEW)
+        self.assertEqual(update.finish(), 2)
+        idx.commit()
+
+        self.assertEqual(self.paths(idx, 1), ['/a-b.txt', '/a.txt', '/keep.txt'])
+        self.assertEqual(self.paths(idx, 2), ['/a b.txt'])
+        self.assertEqual(idx.get_indexed_files(1)['/a.txt'], index.mtime_seconds(NEW))
+
+    def testBatches(self):
+        idx = self.open()
+        for i in range(25):
+            self.add(idx, 1, '/dir/file %d.txt' % i)
+        idx.commit()
+
+        old_batch, index.Index.DELETE_BATCH = index.Index.DELETE_BATCH, 4
+        try:
+            update = index.ServerUpdate(idx, 1)
+            update.filter([('/dir/file 3.txt', 10, OLD)])
+            self.assertEqual(update.finish(), 24)
+        finally:
+            index.Index.DELETE_BATCH = old_batch
+        idx.commit()
+        self.assertEqual(self.paths(idx, 1), ['/dir/file 3.txt'])
+
+    def testManifest(self):
+        idx = self.open()
+        self.fill(idx)
+        self.assertEqual(sorted(idx.get_indexed_files(1)), self.paths(idx, 1))
+        # Not commited yet
+        idx.delete_file(1, '/a.txt')
+        self.add(idx, 2, '/new.txt')
+        self.assertIn('/a.txt', idx.get_indexed_files(1))
+        self.assertNotIn('/new.txt', idx.get_indexed_files(2))
+        idx.commit()
+        self.assertEqual(sorted(idx.get_indexed_files(1)), self.paths(idx, 1))
+        self.assertEqual(sorted(idx.get_indexed_files(2)), ['/a b.txt', '/new.txt'])
+
+    def testManifestRebuild(self):
+        idx = self.open()
+        self.fill(idx)
+        idx._manifest.apply([(1, '/a.txt')], [(3, '/ghost', 1, 1)], idx._idx.latest_generation() - 1)
+        idx.close()
+
+        idx = self.open()
+        self.assertEqual(sorted(idx.get_indexed_files(1)), self.paths(idx, 1))
+        self.assertEqual(idx.get_indexed_files(3), {})
+
+    def testDeleteAllDocs(self):
+        idx = self.open()
+        self.fill(idx)
+        # Locked by another process, the changes are written once released
+        locker = idx._idx.writer()
+        threading.Timer(0.5, locker.cancel).start()
+        self.add(idx, 2, '/new.txt')
+        idx.delete_all_docs(FakeServer(1))
+        self.assertEqual(self.paths(idx, 1), [])
+        self.assertEqual(idx.get_indexed_files(1), {})
+        self.assertEqual(self.paths(idx, 2), ['/a b.txt', '/new.txt'])
+        self.assertEqual(sorted(idx.get_indexed_files(2)), ['/a b.txt', '/new.txt'])
+
+    def makeOldIndex(self, version):
+        schema = index.Index.get_schema()
+        schema.remove('size')
+        schema.remove('mtime')
+        schema.add('size', ID(stored=True))
+        schema.add('mtime', ID(stored=True, sortable=True))
+        if version == 1:
+            schema.remove('path_key')
+        os.mkdir(self.path)
+        writer = whoosh_index.create_in(self.path, schema).writer()
+        for path, size, mtime in (('/a b.txt', 10, OLD), ('/a.txt', 2000, NEW), ('/c.txt', 30, None)):
+            fields = {'server_id': '1', 'has_id': 'a', 'name': path[1:], 'ext': 'txt',
+                      'path': path, 'size': str(size), 'mtime': str(mtime)}
+            if version > 1:
+                fields['path_key'] = index.Index.path_key(1, path)
+            writer.add_document(**fields)
+        writer.commit()
+
+    def testMigration(self):
+        for version in (1, 2):
+            self.makeOldIndex(version)
+            idx = self.open()
+            self.assertEqual(index.Index.schema_version(idx._idx.schema), index.Index.SCHEMA_VERSION)
+            self.assertEqual(self.paths(idx, 1), ['/a b.txt', '/a.txt', '/c.txt'])
+            with idx._idx.searcher() as searcher:
+                docs = dict((fields['path'], fields) for fields in searcher.documents())
+                self.assertEqual(docs['/a.txt']['size'], 2000)
+                self.assertEqual(docs['/a.txt']['mtime'], NEW)
+                self.assertNotIn('mtime', docs['/c.txt'])
+                large = searcher.search(NumericRange('size', 100, None))
+                self.assertEqual([hit['path'] for hit in large], ['/a.txt'])
+                recent = searcher.search(DateRange('mtime', datetime(2015, 6, 1), None))
+                self.assertEqual([hit['path'] for hit in recent], ['/a.txt'])
+            self.assertEqual(idx.get_indexed_files(1)['/a.txt'], index.mtime_seconds(NEW))
+
+            idx.delete_file(1, '/a b.txt')
+            idx.commit()
+            self.assertEqual(self.paths(idx, 1), ['/a.txt', '/c.txt'])
+            idx.close()
+            shutil.rmtree(self.path)
+
+
+class FakeServer(object):
+    def __init__(self, server_id):
+        self.server_id = server_id
+        self.nb_files = None
+        self.scanned = False
+
+    def get_server_id(self):
+        return self.server_id
+
+    def get_ip_addr(self):
+        return '10.0.0.%d' % self.server_id
+
+    def set_nb_files(self, nb_files):
+        self.nb_files = nb_files
+
+    def set_files_size(self, files_size):
+        pass
+
+    def update_last_scanned(self):
+        self.scanned = True
+
+
+class FakePersist(object):
+    def restore_server(self, server):
+        return 0
+
+    def save(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class TestPartialCommits(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.idx = index.Index(os.path.join(self.dir, 'index'), None)
+
+    def tearDown(self):
+        self.idx.close()
+        shutil.rmtree(self.dir)
+
+    def coordinator(self, commit_every=0, commit_interval=0):
+        return index.IndexUpdateCoordinator(FakePersist(), self.idx, None, 10,
+                                            commit_every=commit_every, commit_interval=commit_interval)
+
+    def commited(self):
+        with self.idx._idx.searcher() as searcher:
+            return sorted(fields['path'] for fields in searcher.documents())
+
+    def stream(self, names, fail=False):
+        for name in names:
+            yield [('/%s.txt' % name, 10, OLD)]
+        if fail:
+            raise ftplib.error_temp('421 Too many users')
+
+    def testEvery(self):
+        server = FakeServer(1)
+        seen = []
+
+        def stream():
+            for files in self.stream('abcde'):
+                seen.append(self.commited())
+                yield files
+        self.coordinator(commit_every=2)._index_files(server, stream())
+        self.assertEqual(seen, [[], [], ['/a.txt', '/b.txt'], ['/a.txt', '/b.txt'],
+                                ['/a.txt', '/b.txt', '/c.txt', '/d.txt']])
+        self.assertEqual(self.commited(), ['/a.txt', '/b.txt', '/c.txt', '/d.txt', '/e.txt'])
+        self.assertTrue(server.scanned)
+        self.assertEqual(server.nb_files, 5)
+
+    def testInterval(self):
+        server = FakeServer(1)
+        seen = []
+
+        def stream():
+            for files in self.stream('abc'):
+                seen.append(self.commited())
+                yield files
+        # Due after every document
+        self.coordinator(commit_interval=1e-9)._index_files(server, stream())
+        self.assertEqual(seen, [[], ['/a.txt'], ['/a.txt', '/b.txt']])
+
+    def testInterrupted(self):
+        server = FakeServer(1)
+        coordinator = self.coordinator(commit_every=2)
+        self.assertRaises(ftplib.error_temp, coordinator._index_files, server,
+                          self.stream('abc', fail=True))
+        # What was commited stays, but the server is not marked as scanned
+        # and is updated again
+        self.assertEqual(self.commited(), ['/a.txt', '/b.txt', '/c.txt'])
+        self.assertFalse(server.scanned)
+        self.assertIsNone(server.nb_files)
+
+        coordinator._index_files(server, self.stream('bd'))
+        self.assertEqual(self.commited(), ['/b.txt', '/d.txt'])
+        self.assertTrue(server.scanned)
+        self.assertEqual(server.nb_files, 2)
+
+    def testFailed(self):
+        def stream():
+            yield from self.stream('abc')
+            raise ValueError('Not an FTP error')
+        server = FakeServer(1)
+        coordinator = self.coordinator(commit_every=2)
+        self.assertRaises(ValueError, coordinator._index_files, server, stream())
+        self.assertEqual(self.commited(), ['/a.txt', '/b.txt'])
+        self.assertFalse(server.scanned)
+
+        # The documents not commited are not commited with the next server
+        coordinator._index_files(FakeServer(2), self.stream('d'))
+        self.assertEqual(self.commited(), ['/a.txt', '/b.txt', '/d.txt'])
+        self.assertEqual(sorted(self.idx.get_indexed_files(1)), ['/a.txt', '/b.txt'])
+
+def serve_ranges(ranges, content):
+    """Runs a generator of ranges over `content`, returns the data and
+    the number of requests."""
+    requests = 0
+    data = None
+    try:
+        while True:
+            first, last = (int(n) for n in ranges.send(data).split('-'))
+            data = content[first:last+1]
+            requests += 1
+    except StopIteration as e:
+        return e.value, requests
+
+
+class TestTagRanges(unittest.TestCase):
+    def testSpeculative(self):
+        root = TestFetchID3Tags.ROOT
+        for name in sorted(os.listdir(root)):
+            with open(os.path.join(root, name), 'rb') as f:
+                content = f.read()
+            expected, precise = serve_ranges(index.id3_ranges(len(content)), content)
+            for head in (16, 1024, 1 << 20):
+                for tail in (138, 1024):
+                    data, requests = serve_ranges(index.speculative_id3_ranges(len(content), head, tail), content)
+                    self.assertEqual(data, expected, (name, head, tail))
+                    self.assertLessEqual(requests, 3)
+                    if head + tail >= len(content):
+                        self.assertEqual(requests, 1)
+                    if head >= 1024 and tail >= 1024:
+                        self.assertLessEqual(requests, precise)
+
+    def testSmallFiles(self):
+        # Nothing to fetch below the size of an ID3 header, and never a
+        # reversed range
+        for size in range(0, 300):
+            content = bytes(size)
+            for ranges in (index.id3_ranges(size), index.speculative_id3_ranges(size, 16, 138)):
+                data, requests = serve_ranges(ranges, content)
+                if size < 10:
+                    self.assertEqual((data, requests), (b'', 0))
+
+    def testID3v1Only(self):
+        id3v1 = (b'TAG' + b'A title'.ljust(30, b'\0') + b'An artist'.ljust(30, b'\0') +
+                 b'An album'.ljust(30, b'\0') + b'2001' + bytes(30) + b'\xff')
+        for size in (0, 10, 1000):
+            content = bytes(size) + id3v1
+            for ranges in (index.id3_ranges(len(content)), index.speculative_id3_ranges(len(content), 16, 138)):
+                data, requests = serve_ranges(ranges, content)
+                self.assertEqual(data, id3v1, size)
+                tags = tinytag.ID3(BytesIO(data), len(data))
+                tags.load(tags=True, duration=False, image=False)
+                self.assertEqual((tags.title, tags.artist, tags.year), ('A title', 'An artist', '2001'))
+
+    def testEstimator(self):
+        estimator = index.TagSizeEstimator(initial=4096, maximum=64*1024)
+        for size in [2000] * 9:
+            estimator.observe(size)
+        self.assertEqual(estimator.head_size(), 4096)
+        for size in [2000] * 20 + [30000] * 2:
+            estimator.observe(size)
+        self.assertEqual(estimator.head_size(), 2048)
+        for size in [30000] * 30:
+            estimator.observe(size)
+        self.assertEqual(estimator.head_size(), 30720)
+        for size in [1 << 20] * 100:
+            estimator.observe(size)
+        self.assertEqual(estimator.head_size(), 64*1024)
+
+
+class Collect(pipeline.Stage):
+    def __init__(self):
+        self.contexts = []
+
+    def execute(self, context):
+        self.contexts.append(context)
+        return True
+
+
+class TestFetchID3Tags(unittest.TestCase):
+    ROOT = os.path.join(os.path.dirname(__file__), 'test', 'mp3')
+
+    def setUp(self):
+        self.server = start_ftp_server(self.ROOT)
+        self.addr = '127.0.0.1:%d' % self.server.address[1]
+
+    def tearDown(self):
+        self.server.close_all()
+
+    def contexts(self):
+        for name in sorted(os.listdir(self.ROOT)) + ['notes.txt']:
+            path = os.path.join(self.ROOT, name)
+            yield index.FileIndexerContext('/' + name, os.path.getsize(path) if os.path.exists(path) else 0, OLD)
+
+    def testConcurrent(self):
+        expected = {}
+        stage = index.FetchID3TagsStage(self.addr, speculative=False)
+        for context in self.contexts():
+            stage.execute(context)
+            expected[context.get_path()] = context.get_extra_data()
+        self.assertEqual(expected['/v1andv24tags.mp3']['audio_artist'], 'ARTIST123456789012345678901234')
+
+        collect = Collect()
+        pipe = pipeline.Pipeline()
+        pipe.append_stage(index.ConcurrentFetchID3TagsStage(self.addr, collect, concurrency=4))
+        pipe.append_stage(collect)
+        for context in self.contexts():
+            pipe.execute(context)
+        pipe.flush()
+        self.assertEqual(dict((context.get_path(), context.get_extra_data()) for context in collect.contexts),
+                         expected)
+
+    def testWarmConnection(self):
+        expected = {}
+        stage = index.FetchID3TagsStage(self.addr, speculative=False)
+        for context in self.contexts():
+            stage.execute(context)
+            expected[context.get_path()] = context.get_extra_data()
+
+        for speculative in (False, True):
+            stage = index.FTPFetchID3TagsStage(self.addr, speculative=speculative)
+            for context in self.contexts():
+                stage.execute(context)
+                self.assertEqual(context.get_extra_data(), expected[context.get_path()])
+            stage.close()
+            self.assertEqual(stage.stats.connections, 1)
+            self.assertGreaterEqual(stage.stats.requests, stage.stats.files)
+
+        # The connection of the scanner, which can still list afterwards
+        scanner = FTPScanner('127.0.0.1', make_ftp_class(self.server.address[1]))
+        scanner.connect()
+        stage = index.FTPFetchID3TagsStage(self.addr, scanner=scanner)
+        for context in self.contexts():
+            stage.execute(context)
+            self.assertEqual(context.get_extra_data(), expected[context.get_path()])
+            self.assertEqual(len(scanner.list_files('/')[0]), len(os.listdir(self.ROOT)))
+        stage.close()
+        scanner.disconnect()
+        self.assertEqual(stage.stats.connections, 0)
+
+    def testScannerConnectionFails(self):
+        root = tempfile.mkdtemp()
+        try:
+            dirs = ['/d1', '/d2', '/d3', '/d3/sub']
+            for d in dirs:
+                os.makedirs(root + d)
+                for name in ('v1andv24tags.mp3', 'v23tag.mp3'):
+                    shutil.copy(os.path.join(self.ROOT, name), root + d)
+
+            class FailingHandler(FTPHandler):
+                # The first RETR fails, on the connection of the scanner
+                failures = [1]
+
+                def ftp_RETR(self, file):
+                    if self.failures:
+                        self.failures.pop()
+                        self.respond('450 File unavailable.')
+                        return
+                    return FTPHandler.ftp_RETR(self, file)
+
+            # Both servers would share the IOLoop of pyftpdlib
+            self.server.close_all()
+            self.server = start_ftp_server(root, FailingHandler)
+            port = self.server.address[1]
+            scanner = FTPScanner('127.0.0.1', make_ftp_class(port))
+            stage = index.FTPFetchID3TagsStage('127.0.0.1:%d' % port, scanner=scanner)
+            listed = set()
+            for files in scanner.iter_scan():
+                for path, size, mtime in files:
+                    listed.add(os.path.dirname(path))
+                    context = index.FileIndexerContext(path, size, mtime)
+                    stage.execute(context)
+                    self.assertEqual(context.get_extra_data()['audio_title'][:5], 'TITLE')
+            stage.close()
+            self.assertEqual(FailingHandler.failures, [])
+            self.assertEqual(listed, set(dirs))
+        finally:
+            shutil.rmtree(root)
+
+    def testTagCache(self):
+        directory = tempfile.mkdtemp()
+        try:
+            cache = tagcache.TagCache(os.path.join(directory, 'tags.sqlite'))
+            stage = index.FetchID3TagsStage(self.addr, tag_cache=cache.server(1))
+            expected = {}
+            for context in self.contexts():
+                stage.execute(context)
+                expected[context.get_path()] = context.get_extra_data()
+            stage.flush()
+            self.assertEqual(cache.stats.hits + cache.stats.name_hits, 0)
+
+            # Nothing fetched from the server for the same files
+            self.server.close_all()
+            for server_id, make_stage in [(1, lambda c: index.FetchID3TagsStage(self.addr, tag_cache=c)),
+                                          (2, lambda c: index.ConcurrentFetchID3TagsStage(self.addr, None,
+                                                                                          tag_cache=c))]:
+                server_cache = cache.server(server_id)
+                stage = make_stage(server_cache)
+                for context in self.contexts():
+                    self.assertTrue(stage.execute(context))
+                    self.assertEqual(context.get_extra_data(), expected[context.get_path()])
+                stage.flush()
+                self.assertEqual(stage.stats.requests, 0)
+                self.assertEqual(server_cache.stats.hit_rate(), 1)
+            self.assertEqual(server_cache.stats.name_hits, server_cache.stats.lookups())
+            cache.close()
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestFetchOtherFormats(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.files = []
+        for name, content in audio_files():
+            with open(os.path.join(self.dir, name), 'wb') as f:
+                f.write(content)
+            self.files.append(('/' + name, len(content)))
+        self.server = start_ftp_server(self.dir)
+        self.addr = '127.0.0.1:%d' % self.server.address[1]
+
+    def tearDown(self):
+        self.server.close_all()
+        shutil.rmtree(self.dir)
+
+    def testCandidates(self):
+        stage = index.FetchID3TagsStage(self.addr)
+        for path in ('/a/song.flac', '/a/SONG.MP3', '/a/song.wav', '/a/song.wma', '/a/song.ogg'):
+            self.assertTrue(stage._is_candidate(path, 1000), path)
+        for path in ('/a/song.xflac', '/a/bigwav', '/a.mp3/notes', '/a/song.m4a'):
+            self.assertFalse(stage._is_candidate(path, 1000), path)
+        self.assertFalse(stage._is_candidate('/a/song.mp3', 0))
+        self.assertFalse(stage._is_candidate('/a/song.mp3', 9))
+
+    def testEmptyFiles(self):
+        files = [('/empty.mp3', 0), ('/short.mp3', 5), ('/empty.flac', 0)]
+        for path, size in files:
+            with open(self.dir + path, 'wb') as f:
+                f.write(b'\xff' * size)
+        for make_stage in [lambda: index.FetchID3TagsStage(self.addr),
+                           lambda: index.FTPFetchID3TagsStage(self.addr),
+                           lambda: index.ConcurrentFetchID3TagsStage(self.addr, None)]:
+            stage = make_stage()
+            for path, size in files:
+                context = index.FileIndexerContext(path, size, OLD)
+                self.assertTrue(stage.execute(context))
+                self.assertEqual(context.get_extra_data(), {})
+            stage.flush()
+            stage.close()
+            self.assertEqual(stage.stats.files, 0)
+
+    def testStages(self):
+        for make_stage in [lambda: index.FetchID3TagsStage(self.addr),
+                           lambda: index.FTPFetchID3TagsStage(self.addr),
+                           lambda: index.ConcurrentFetchID3TagsStage(self.addr, None)]:
+            stage = make_stage()
+            for path, size in self.files:
+                context = index.FileIndexerContext(path, size, OLD)
+                self.assertTrue(stage.execute(context))
+                for tag, value in expected_tags(path).items():
+                    self.assertEqual(context.get_extra_data()['audio_' + tag], value, path)
+            stage.flush()
+            stage.close()
+            self.assertEqual(stage.stats.files, len(self.files))
+            # Neither the audio data nor the pictures
+            self.assertLess(stage.stats.bytes / stage.stats.files, 64 * 1024)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""Write-ahead journal of the changes not commited in the index yet.
+
+Every document added and every deletion is appended to the journal
+before being given to the whoosh writer, and the journal is emptied once
+the changes are commited. When the indexer is killed, the operations of
+the journal are replayed the next time the index is opened, instead of
+scanning and fetching the tags of the files again.
+
+Each record is a pickled operation prefixed by its length and CRC, a
+record torn by a crash is dropped with everything after it. The records
+are written to the file at once, so that they survive the death of the
+process, and the file is fsynced by batches, to survive a crash of the
+system with a bounded loss.
+"""
+
+import fcntl
+import logging
+import os
+import pickle
+import struct
+import time
+import zlib
+
+
+class JournalLocked(Exception):
+    """The journal is used by another process."""
+
+
+class Journal(object):
+    FILENAME = 'journal.bin'
+    HEADER = struct.Struct('<II')   # length and CRC32 of the record
+
+    def __init__(self, directory, sync_every=100, sync_interval=5):
+        """
+        :Parameters:
+            -`directory`: the directory of the index
+            -`sync_every`: number of records between two fsyncs
+            -`sync_interval`: maximum seconds between two fsyncs
+        """
+        self.log = logging.getLogger('ftpvista.journal')
+        self.path = os.path.join(directory, self.FILENAME)
+        self._sync_every = sync_every
+        self._sync_interval = sync_interval
+        self._file = open(self.path, 'a+b', buffering=0)
+        try:
+            fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._file.close()
+            raise JournalLocked('%s is used by another process' % self.path)
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def records(self):
+        """Yields the operations of the journal, in order.
+
+        The end of the file is cut at the first invalid record.
+        """
+        self._file.seek(0)
+        offset = 0
+        while True:
+            header = self._file.read(self.HEADER.size)
+            if len(header) == 0:
+                return
+            record = None
+            if len(header) == self.HEADER.size:
+                length, crc = self.HEADER.unpack(header)
+                record = self._file.read(length)
+                if len(record) != length or zlib.crc32(record) != crc:
+                    record = None
+            if record is None:
+                self.log.warning('Torn record at offset %d of the journal, dropped' % offset)
+                self._file.truncate(offset)
+                return
+            offset += self.HEADER.size + len(record)
+            yield pickle.loads(record)
+
+    def __len__(self):
+        return os.fstat(self._file.fileno()).st_size
+
+    def append(self, operation):
+        record = pickle.dumps(operation, pickle.HIGHEST_PROTOCOL)
+        self._file.write(self.HEADER.pack(len(record), zlib.crc32(record)) + record)
+        self._unsynced += 1
+        if (self._unsynced >= self._sync_every or
+                time.monotonic() - self._last_sync >= self._sync_interval):
+            self.sync()
+
+    def sync(self):
+        if self._unsynced > 0:
+            os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def truncate(self):
+        """Forget every record, once the changes are commited."""
+        self._file.truncate(0)
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        self.sync()
+        self._file.close()
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from datetime import datetime
+
+from whoosh.query import Term
+from whoosh.writing import IndexingError
+
+from . import index
+from . import journal
+from . import shards
+
+
+MTIME = datetime(2015, 1, 2, 3, 4, 5)
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testRecords(self):
+        j = journal.Journal(self.dir, sync_every=2)
+        j.append(('add', {'path': '/a', 'mtime': MTIME}))
+        j.append(('delete', 1, ['/b']))
+        j.append(('add', {'path': '/c'}))
+        self.assertEqual(list(j.records()), [('add', {'path': '/a', 'mtime': MTIME}),
+                                             ('delete', 1, ['/b']), ('add', {'path': '/c'})])
+        # Only one process may use it
+        self.assertRaises(journal.JournalLocked, journal.Journal, self.dir)
+        j.truncate()
+        self.assertEqual(len(j), 0)
+        self.assertEqual(list(j.records()), [])
+        j.close()
+
+    def testTornRecord(self):
+        j = journal.Journal(self.dir)
+        j.append(('add', {'path': '/a'}))
+        j.append(('add', {'path': '/b'}))
+        j.close()
+        with open(os.path.join(self.dir, journal.Journal.FILENAME), 'r+b') as f:
+            f.truncate(os.path.getsize(f.name) - 3)
+
+        j = journal.Journal(self.dir)
+        self.assertEqual(list(j.records()), [('add', {'path': '/a'})])
+        j.append(('add', {'path': '/c'}))
+        self.assertEqual(list(j.records()), [('add', {'path': '/a'}), ('add', {'path': '/c'})])
+        j.close()
+
+
+class TestIndexJournal(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'index')
+        os.mkdir(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def open(self, layout='single'):
+        return shards.open_index(self.path, None, layout, 2, journal.Journal(self.path))
+
+    def kill(self, idx):
+        """Drop the index as a killed process would."""
+        if isinstance(idx, shards.ShardedIndex):
+            writers = idx._writers.values()
+        else:
+            writers = [idx._writer] if idx._writer is not None else []
+        for writer in writers:
+            writer.cancel()
+        idx._journal._file.close()
+
+    def paths(self):
+        with shards.open_searcher(self.path) as searcher:
+            return sorted(hit['path'] for hit in searcher.search_page(Term('has_id', 'a'), 1, pagelen=100))
+
+    def testReplay(self):
+        for layout in ('single', 'hash'):
+            idx = self.open(layout)
+            for path in ('/a.txt', '/b.txt', '/c.txt'):
+                idx.add_document('1', path[1:], path, 10, MTIME)
+            idx.commit()
+            self.assertEqual(len(idx._journal), 0)
+
+            idx.delete_file(1, '/a.txt')
+            idx.add_document('1', 'b.txt', '/b.txt', 20, datetime(2016, 1, 1))
+            idx.add_document('1', 'd.txt', '/d.txt', 10, MTIME)
+            self.kill(idx)
+
+            idx = self.open(layout)
+            self.assertEqual(len(idx._journal), 0)
+            self.assertEqual(sorted(idx.get_indexed_files(1)), ['/b.txt', '/c.txt', '/d.txt'])
+            self.assertEqual(idx.get_indexed_files(1)['/b.txt'], index.mtime_seconds(datetime(2016, 1, 1)))
+            idx.close()
+            self.assertEqual(self.paths(), ['/b.txt', '/c.txt', '/d.txt'])
+            shutil.rmtree(self.path)
+            os.mkdir(self.path)
+
+    def testReplayTwice(self):
+        # Killed after the commit, before the journal was emptied
+        idx = self.open()
+        idx.add_document('1', 'a.txt', '/a.txt', 10, MTIME)
+        idx.delete_file(1, '/nothing.txt')
+        idx._journal.sync()
+        with open(idx._journal.path, 'rb') as f:
+            records = f.read()
+        idx.commit()
+        idx.close()
+        with open(os.path.join(self.path, journal.Journal.FILENAME), 'wb') as f:
+            f.write(records)
+
+        idx = self.open()
+        self.assertEqual(list(idx.get_indexed_files(1)), ['/a.txt'])
+        idx.close()
+        self.assertEqual(self.paths(), ['/a.txt'])
+
+    def testRollback(self):
+        for layout in ('single', 'hash'):
+            idx = self.open(layout)
+            idx.add_document('1', 'a.txt', '/a.txt', 10, MTIME)
+            idx.commit()
+            idx.add_document('1', 'b.txt', '/b.txt', 10, MTIME)
+            idx.delete_file(1, '/a.txt')
+            idx.rollback()
+            self.assertEqual(len(idx._journal), 0)
+            idx.add_document('1', 'c.txt', '/c.txt', 10, MTIME)
+            idx.commit()
+            self.assertEqual(sorted(idx.get_indexed_files(1)), ['/a.txt', '/c.txt'])
+            idx.close()
+            self.assertEqual(self.paths(), ['/a.txt', '/c.txt'])
+            shutil.rmtree(self.path)
+            os.mkdir(self.path)
+
+    def lock(self, idx):
+        """Returns a writer locking the first shard of the index, as
+        another process would, and the path of a document of that shard."""
+        shard = idx.shards()[0]
+        # Nothing is locked until the index is written
+        locker = idx._whoosh_index(shard).writer()
+        if shard is None:
+            return locker, '/a.txt'
+        return locker, next(p for p in ('/a.txt', '/b.txt', '/c.txt', '/d.txt')
+                            if idx.shard_of(1, p) == shard)
+
+    def testLockedCommit(self):
+        # The index is locked by another writer as the documents are added,
+        # their commit is deferred until it is released
+        for layout in ('single', 'hash'):
+            idx = self.open(layout)
+            locker, path = self.lock(idx)
+            idx.add_document('1', path[1:], path, 10, MTIME)
+            threading.Timer(0.5, locker.cancel).start()
+            idx.commit()
+            self.assertEqual(len(idx._journal), 0)
+            self.assertEqual(list(idx.get_indexed_files(1)), [path])
+            idx.close()
+            self.assertEqual(self.paths(), [path])
+            shutil.rmtree(self.path)
+            os.mkdir(self.path)
+
+    def testLockTimeout(self):
+        # The lock is not released in time, the commit fails and is dropped
+        # by the rollback, even if the lock is released later
+        for layout in ('single', 'hash'):
+            idx = self.open(layout)
+            idx.LOCK_TIMEOUT = 0.5
+            locker, path = self.lock(idx)
+            idx.add_document('1', path[1:], path, 10, MTIME)
+            self.assertRaises(IndexingError, idx.commit)
+            idx.rollback()
+            locker.cancel()
+            time.sleep(0.5)
+            self.assertEqual(list(idx.get_indexed_files(1)), [])
+            self.assertEqual(self.paths(), [])
+
+            idx.add_document('1', 'e.txt', '/e.txt', 10, MTIME)
+            idx.commit()
+            self.assertEqual(list(idx.get_indexed_files(1)), ['/e.txt'])
+            idx.close()
+            self.assertEqual(self.paths(), ['/e.txt'])
+            shutil.rmtree(self.path)
+            os.mkdir(self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""Size and modification time of the indexed files, by server.
+
+The manifest is a SQLite file stored in the directory of the Whoosh index.
+It answers "what is indexed for this server ?" without reading the stored
+fields of the documents, and is kept in sync by Index.commit. It is shared
+with the thread merging the segments, hence the lock.
+
+The generation of the whoosh index the manifest matches is kept with it,
+one per shard when the documents are split between several indexes,
+and so is the time of the last optimization, which outlives the process.
+"""
+
+import logging
+import os.path
+import sqlite3
+import threading
+
+
+class Manifest(object):
+    FILENAME = 'manifest.sqlite'
+    LAST_OPTIMIZATION_KEY = 'last_optimization'
+
+    def __init__(self, directory):
+        self.log = logging.getLogger('ftpvista.manifest')
+        self._db = sqlite3.connect(os.path.join(directory, self.FILENAME),
+                                   check_same_thread=False)
+        self._lock = threading.Lock()
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS files (
+                server_id INTEGER NOT NULL,
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime INTEGER NOT NULL,
+                PRIMARY KEY (server_id, path)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );''')
+
+    @staticmethod
+    def _generation_key(shard):
+        return 'generation' if shard is None else 'generation/%s' % shard
+
+    @property
+    def generation(self):
+        """Generation of the index the manifest matches, None if unknown."""
+        return self.get_generation()
+
+    def get_generation(self, shard=None):
+        """Generation of the shard the manifest matches, None if unknown."""
+        with self._lock:
+            row = self._db.execute('SELECT value FROM meta WHERE key = ?',
+                                   (self._generation_key(shard),)).fetchone()
+        return None if row is None else row[0]
+
+    def generations(self):
+        """Returns a {shard => generation} mapping, the shard being None
+        for an index which is not sharded."""
+        with self._lock:
+            rows = self._db.execute("SELECT key, value FROM meta WHERE key LIKE 'generation%'").fetchall()
+        return dict((None if key == 'generation' else key.partition('/')[2], value)
+                    for key, value in rows)
+
+    def get_last_optimization(self):
+        """Seconds since the Epoch of the last optimization of the index,
+        None if unknown."""
+        with self._lock:
+            row = self._db.execute('SELECT value FROM meta WHERE key = ?',
+                                   (self.LAST_OPTIMIZATION_KEY,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_last_optimization(self, seconds):
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                             (self.LAST_OPTIMIZATION_KEY, seconds))
+
+    def get_files(self, server_id):
+        """Returns a {path => mtime} mapping of the files of the server,
+        the mtimes being in seconds since the Epoch."""
+        with self._lock:
+            return dict(self._db.execute('SELECT path, mtime FROM files WHERE server_id = ?',
+                                         (int(server_id),)))
+
+    def count(self, server_id=None):
+        with self._lock:
+            if server_id is None:
+                return self._db.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+            return self._db.execute('SELECT COUNT(*) FROM files WHERE server_id = ?',
+                                    (int(server_id),)).fetchone()[0]
+
+    def apply(self, deleted, added, generation, deleted_servers=(), shard=None):
+        """Apply the changes commited in the index, in a single transaction.
+
+        deleted          -- an iterable of (server_id, path)
+        added            -- an iterable of (server_id, path, size, mtime),
+                            added after the deletion
+        generation       -- the new generation of the shard, None if the
+                            shard was removed
+        deleted_servers  -- ids of the servers whose files were all deleted
+        """
+        with self._lock, self._db:
+            self._db.executemany('DELETE FROM files WHERE server_id = ?',
+                                 ((int(server_id),) for server_id in deleted_servers))
+            self._db.executemany('DELETE FROM files WHERE server_id = ? AND path = ?',
+                                 ((int(server_id), path) for server_id, path in deleted))
+            self._db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                                 ((int(server_id), path, size, mtime)
+                                  for server_id, path, size, mtime in added))
+            self._set_generation(shard, generation)
+
+    def rebuild(self, files, generations):
+        """Replace the content of the manifest.
+
+        files        -- an iterable of (server_id, path, size, mtime)
+        generations  -- a {shard => generation} mapping, see generations
+        """
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM files')
+            self._db.execute("DELETE FROM meta WHERE key LIKE 'generation%'")
+            self._db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                                 ((int(server_id), path, size, mtime)
+                                  for server_id, path, size, mtime in files))
+            for shard, generation in generations.items():
+                self._set_generation(shard, generation)
+        self.log.info('Manifest rebuilt : %d files' % self.count())
+
+    def _set_generation(self, shard, generation):
+        if generation is None:
+            self._db.execute('DELETE FROM meta WHERE key = ?', (self._generation_key(shard),))
+        else:
+            self._db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                             (self._generation_key(shard), generation))
+
+    def close(self):
+        self._db.close()
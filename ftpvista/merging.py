@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""Merging of the segments of the index, out of the indexing path.
+
+Each server update is commited as a new segment, without merging
+anything. A background MergeScheduler merges the segments by size tiers
+when the indexer is mostly idle, or inside a configured time window,
+and from time to time optimizes the whole index.
+"""
+
+import logging
+import math
+import threading
+import time
+from datetime import datetime, timedelta
+
+from whoosh.reading import SegmentReader
+
+
+class SizeTieredMerge(object):
+    """A whoosh merge function merging segments of similar sizes.
+
+    The segments are put in tiers by the logarithm of their number of
+    documents, in base `factor`. The smallest tier holding `factor`
+    segments or more is merged into a single segment of the next tier,
+    so that each document is only rewritten about log(N) times.
+    """
+
+    def __init__(self, factor=10):
+        self.factor = max(2, factor)
+
+    def tier(self, doc_count):
+        return int(math.log(max(1, doc_count), self.factor))
+
+    def plan(self, doc_counts):
+        """Returns the indexes of the segments to merge, given the number
+        of documents of each segment, or an empty list."""
+        tiers = {}
+        for i, doc_count in enumerate(doc_counts):
+            tiers.setdefault(self.tier(doc_count), []).append(i)
+        for tier in sorted(tiers):
+            if len(tiers[tier]) >= self.factor:
+                return tiers[tier]
+        return []
+
+    def __call__(self, writer, segments):
+        to_merge = set(self.plan([segment.doc_count_all() for segment in segments]))
+        remaining = []
+        for i, segment in enumerate(segments):
+            if i not in to_merge:
+                remaining.append(segment)
+                continue
+            reader = SegmentReader(writer.storage, writer.schema, segment)
+            writer.add_reader(reader)
+            reader.close()
+        return remaining
+
+
+def parse_window(window):
+    """Parse a 'HH:MM-HH:MM' time window, returns a (start, end) tuple of
+    times or None if `window` is empty. The window may span midnight."""
+    if not window or not window.strip():
+        return None
+    start, _, end = window.partition('-')
+    return (datetime.strptime(start.strip(), '%H:%M').time(),
+            datetime.strptime(end.strip(), '%H:%M').time())
+
+
+def in_window(window, now):
+    if window is None:
+        return False
+    start, end = window
+    if start <= end:
+        return start <= now.time() < end
+    return now.time() >= start or now.time() < end
+
+
+class MergeScheduler(object):
+    """Merge the segments of an Index in a background thread."""
+
+    def __init__(self, myindex, policy=None, window=None, idle_rate=10,
+                 check_interval=300, optimize_interval=timedelta(days=7),
+                 clock=datetime.now):
+        """
+        :Parameters:
+            -`myindex`: the Index to merge
+            -`policy`: the merge function, a SizeTieredMerge by default
+            -`window`: a (start, end) tuple of times during which merging
+                       is always allowed, see parse_window
+            -`idle_rate`: merging is allowed when less than this number of
+                          documents per minute were written since the last
+                          check
+            -`check_interval`: seconds between two checks
+            -`optimize_interval`: a timedelta, minimum time between two
+                                  full optimizations, None to never
+                                  optimize
+        """
+        self.log = logging.getLogger('ftpvista.merging')
+        self._index = myindex
+        self._policy = policy or SizeTieredMerge()
+        self._window = window
+        self._idle_rate = idle_rate
+        self._check_interval = check_interval
+        self._optimize_interval = optimize_interval
+        self._clock = clock
+        self._last_check = clock()
+        self._last_writes = myindex.write_count
+
+    def _write_rate(self, now):
+        """Documents written per minute since the last check."""
+        writes = self._index.write_count
+        minutes = max((now - self._last_check).total_seconds() / 60, 1 / 60)
+        rate = (writes - self._last_writes) / minutes
+        self._last_check, self._last_writes = now, writes
+        return rate
+
+    def can_merge(self):
+        now = self._clock()
+        rate = self._write_rate(now)
+        if in_window(self._window, now):
+            return True
+        return rate < self._idle_rate
+
+    def run_once(self):
+        """Merge the segments if allowed, returns the number of merges."""
+        if not self.can_merge():
+            return 0
+
+        merges = 0
+        for shard in self._index.shards():
+            while self._policy.plan(self._index.segment_sizes(shard)):
+                if not self._index.merge(self._policy, shard=shard):
+                    return merges
+                merges += 1
+
+        if (self._optimize_interval is not None and
+                any(len(self._index.segment_sizes(shard)) > 1 for shard in self._index.shards()) and
+                self._index.optimization_age(self._clock()) >= self._optimize_interval):
+            if self._index.optimize(self._clock()):
+                merges += 1
+        return merges
+
+    def run(self):
+        while True:
+            time.sleep(self._check_interval)
+            try:
+                self.run_once()
+            except Exception:
+                self.log.exception('Error while merging the index')
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name='ftpvista-merging')
+        thread.daemon = True
+        thread.start()
+        return thread
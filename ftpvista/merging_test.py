@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, time, timedelta
+
+from . import index
+from . import merging
+
+
+MTIME = datetime(2015, 1, 2, 3, 4, 5)
+
+
+class Clock(object):
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class TestSizeTieredMerge(unittest.TestCase):
+    def testPlan(self):
+        policy = merging.SizeTieredMerge(3)
+        self.assertEqual(policy.plan([1, 2, 100]), [])
+        self.assertEqual(policy.plan([1, 2, 100, 1]), [0, 1, 3])
+        # The smallest tier first
+        self.assertEqual(policy.plan([10, 1, 10, 2, 10, 1]), [1, 3, 5])
+        self.assertEqual(policy.plan([10, 11, 100, 12]), [0, 1, 3])
+
+    def testWindow(self):
+        window = merging.parse_window('22:30-06:00')
+        self.assertEqual(window, (time(22, 30), time(6, 0)))
+        self.assertTrue(merging.in_window(window, datetime(2016, 1, 1, 23, 0)))
+        self.assertTrue(merging.in_window(window, datetime(2016, 1, 1, 5, 59)))
+        self.assertFalse(merging.in_window(window, datetime(2016, 1, 1, 12, 0)))
+        self.assertEqual(merging.parse_window(''), None)
+        self.assertFalse(merging.in_window(None, datetime(2016, 1, 1, 12, 0)))
+
+
+class TestMergeScheduler(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.idx = index.Index(os.path.join(self.dir, 'index'), None)
+        self.clock = Clock(datetime(2016, 1, 1, 12, 0))
+
+    def tearDown(self):
+        self.idx.close()
+        shutil.rmtree(self.dir)
+
+    def addSegments(self, count, docs=1):
+        for i in range(count):
+            for j in range(docs):
+                path = '/%d/%d.txt' % (len(self.idx.segment_sizes()), j)
+                self.idx.add_document('1', os.path.basename(path), path, 10, MTIME)
+            self.idx.commit(merge=False)
+
+    def scheduler(self, **kwargs):
+        return merging.MergeScheduler(self.idx, merging.SizeTieredMerge(3), clock=self.clock, **kwargs)
+
+    def testTieredMerge(self):
+        scheduler = self.scheduler(optimize_interval=None)
+        self.addSegments(4)
+        self.addSegments(1, 5)
+        self.assertEqual(self.idx.segment_sizes(), [1, 1, 1, 1, 5])
+        self.clock.now += timedelta(minutes=10)
+        self.assertEqual(scheduler.run_once(), 1)
+        self.assertEqual(sorted(self.idx.segment_sizes()), [4, 5])
+        self.assertEqual(self.idx.get_indexed_files(1)['/0/0.txt'], index.mtime_seconds(MTIME))
+        # The manifest still matches the index
+        self.assertEqual(self.idx._manifest.generation, self.idx._idx.latest_generation())
+
+    def testBusy(self):
+        scheduler = self.scheduler(idle_rate=1, window=merging.parse_window('02:00-04:00'))
+        self.addSegments(4)
+        # 4 documents in a minute, the indexer is busy
+        self.clock.now += timedelta(minutes=1)
+        self.assertEqual(scheduler.run_once(), 0)
+        self.assertEqual(len(self.idx.segment_sizes()), 4)
+
+        # But merging is always allowed inside the window
+        self.addSegments(1)
+        self.clock.now = datetime(2016, 1, 2, 3, 0)
+        self.assertEqual(scheduler.run_once(), 1)
+        self.assertEqual(self.idx.segment_sizes(), [5])
+
+    def testLocked(self):
+        scheduler = self.scheduler()
+        self.addSegments(4)
+        # An update is being written
+        self.idx.add_document('1', 'a.txt', '/a.txt', 10, MTIME)
+        self.clock.now += timedelta(hours=1)
+        self.assertEqual(scheduler.run_once(), 0)
+        self.idx.commit(merge=False)
+        self.assertEqual(self.idx.segment_sizes(), [1, 1, 1, 1, 1])
+
+    def testOptimizeInterval(self):
+        scheduler = self.scheduler(optimize_interval=timedelta(days=1))
+        self.addSegments(2)
+        self.clock.now += timedelta(hours=1)
+        self.assertEqual(scheduler.run_once(), 1)
+        self.assertEqual(self.idx.segment_sizes(), [2])
+
+        # Too soon for another optimization
+        self.addSegments(1)
+        self.clock.now += timedelta(hours=1)
+        self.assertEqual(scheduler.run_once(), 0)
+        self.assertEqual(self.idx.segment_sizes(), [2, 1])
+
+        self.clock.now += timedelta(days=1)
+        self.assertEqual(scheduler.run_once(), 1)
+        self.assertEqual(self.idx.segment_sizes(), [3])
+
+    def testOptimizeIntervalReopened(self):
+        scheduler = self.scheduler(optimize_interval=timedelta(days=1))
+        self.addSegments(2)
+        self.clock.now += timedelta(hours=1)
+        self.assertEqual(scheduler.run_once(), 1)
+
+        # The time of the optimization is kept by the next process
+        self.idx.close()
+        self.idx = index.Index(os.path.join(self.dir, 'index'), None)
+        self.assertEqual(self.idx.optimization_age(self.clock.now), timedelta(0))
+        scheduler = self.scheduler(optimize_interval=timedelta(days=1))
+        self.addSegments(1)
+        self.clock.now += timedelta(hours=1)
+        self.assertEqual(scheduler.run_once(), 0)
+        self.assertEqual(self.idx.segment_sizes(), [2, 1])
+
+        self.clock.now += timedelta(days=1)
+        self.assertEqual(scheduler.run_once(), 1)
+        self.assertEqual(self.idx.segment_sizes(), [3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import json
 import logging
 import time
 import sqlalchemy
@@ -79,6 +80,153 @@ class FTPServer(Base):
         return (self.last_seen + timedelta(seconds=310)) >= datetime.now()
 
 
+class ScanCheckpointDirectory(Base):
+    """A directory listed by an interrupted scan, see FTPScanner"""
+    __tablename__ = 'scancheckpointdirectory'
+
+    server_id = Column(Integer, primary_key=True)
+    path = Column(Text, primary_key=True)
+    saved = Column(sqlalchemy.types.DateTime(timezone=True), nullable=False, default=now)
+    files = Column(Text, nullable=False)
+    dirs = Column(Text, nullable=False)
+
+    def __init__(self, server_id, path, files, dirs):
+        self.server_id = server_id
+        self.path = path
+        self.files = json.dumps(files)
+        self.dirs = json.dumps(dirs)
+
+    def get_entry(self):
+        return [self.path, json.loads(self.files), json.loads(self.dirs)]
+
+
+class ServerScanCheckpoint(object):
+    """Stores the checkpoints of the scan of a server in the DB, one row
+    per listed directory.
+
+    Checkpoints older than `max_age` (a timedelta) are ignored.
+    """
+
+    def __init__(self, persist, server, max_age):
+        self._persist = persist
+        self._server = server
+        self._max_age = max_age
+
+    def load(self):
+        return self._persist.get_scan_checkpoint(self._server, self._max_age)
+
+    def append(self, directories):
+        self._persist.append_scan_checkpoint(self._server, directories)
+
+    def clear(self):
+        self._persist.delete_scan_checkpoint(self._server)
+
+
+class DirectoryListing(Base):
+    """Cached listing of a directory, see ServerListingCache"""
+    __tablename__ = 'directorylisting'
+
+    server_id = Column(Integer, primary_key=True)
+    path = Column(Text, primary_key=True)
+    modify = Column(String(32))
+    fingerprint = Column(String(16), nullable=False)
+    entries = Column(Text, nullable=False)
+
+    def __init__(self, server_id, path):
+        self.server_id = server_id
+        self.path = path
+
+
+class ListingCachePass(Base):
+    """Number of scans of a server made with the listing cache"""
+    __tablename__ = 'listingcachepass'
+
+    server_id = Column(Integer, primary_key=True)
+    passes = Column(Integer, nullable=False, default=0)
+
+    def __init__(self, server_id):
+        self.server_id = server_id
+        self.passes = 0
+
+
+class ServerListingCache(object):
+    """Stores the directory listings of a server in the DB, see
+    scanner.ListingCache.
+
+    Every `full_rescan_every` scans, the cache is not used so that the
+    changes deep in an unchanged directory are eventually found.
+    """
+
+    COMMIT_EVERY = 500
+
+    def __init__(self, persist, server, full_rescan_every):
+        self._persist = persist
+        self._server = server
+        self._full_rescan_every = full_rescan_every
+        self._pending = 0
+
+    def begin_pass(self):
+        passes = self._persist.next_listing_cache_pass(self._server)
+        return self._full_rescan_every <= 1 or passes % self._full_rescan_every == 0
+
+    def get(self, path):
+        listing = self._persist.get_directory_listing(self._server, path)
+        if listing is None:
+            return None
+        return listing.modify, listing.fingerprint, json.loads(listing.entries)
+
+    def put(self, path, modify, fingerprint, entries):
+        self._persist.set_directory_listing(self._server, path, modify, fingerprint, json.dumps(entries))
+        self._pending += 1
+        if self._pending >= self.COMMIT_EVERY:
+            self._persist.save()
+            self._pending = 0
+
+    def end_pass(self, visited):
+        self._persist.delete_directory_listings(self._server, keep=visited)
+        self._pending = 0
+
+
+class ServerCapabilities(Base):
+    """Features supported by a FTP server, see scanner.FTPCapabilities"""
+    __tablename__ = 'servercapabilities'
+
+    server_id = Column(Integer, primary_key=True)
+    probed = Column(sqlalchemy.types.DateTime(timezone=True), nullable=False, default=now)
+    utf8 = Column(Boolean)
+    mlsd = Column(Boolean)
+    path_listing = Column(Boolean)
+    list_recursive = Column(Boolean)
+    stat_recursive = Column(Boolean)
+    rest = Column(Boolean)
+
+    FIELDS = ('utf8', 'mlsd', 'path_listing', 'list_recursive', 'stat_recursive', 'rest')
+
+    def __init__(self, server_id):
+        self.server_id = server_id
+
+    def get_values(self):
+        return dict((field, getattr(self, field)) for field in self.FIELDS)
+
+    def set_values(self, values):
+        for field in self.FIELDS:
+            setattr(self, field, values.get(field))
+
+
+class ServerTombstone(Base):
+    """A server offline for a long time, hidden from the search results,
+    see archive.ServerArchive"""
+    __tablename__ = 'servertombstone'
+
+    server_id = Column(Integer, primary_key=True)
+    hidden = Column(sqlalchemy.types.DateTime(timezone=True), nullable=False, default=now)
+    # When its documents were moved from the index to the archive
+    archived = Column(sqlalchemy.types.DateTime(timezone=True))
+
+    def __init__(self, server_id):
+        self.server_id = server_id
+
+
 class FTPVistaPersist(object):
     def __init__(self, db_uri):
         self.log = logging.getLogger('ftpvista.persist')
@@ -89,6 +237,7 @@ class FTPVistaPersist(object):
 
         self._tools = ftp_tools.FTPTools()
         self.index = None
+        self.archive = None
 
     def initialize_store(self):
         Base.metadata.create_all(self.engine)
@@ -96,6 +245,11 @@ class FTPVistaPersist(object):
     def set_index(self, index):
         self.index = index
 
+    def set_archive(self, archive):
+        """Archive of the documents of the servers offline for a long
+        time, an archive.ServerArchive. Without it they are deleted."""
+        self.archive = archive
+
     def get_server_by_ip(self, ip_addr, create=True):
         server = self.session.query(FTPServer).filter_by(ip=ip_addr).first()
 
@@ -113,40 +267,202 @@ class FTPVistaPersist(object):
         server = self.session.query(FTPServer).filter_by(id=server_id).first()
         return server
 
-    def get_servers(self):
-        return self.session.query(FTPServer).all()
+    def get_servers(self, hidden=True):
+        """Returns every server, but the hidden ones if `hidden` is False."""
+        query = self.session.query(FTPServer)
+        if not hidden:
+            query = query.filter(~FTPServer.id.in_(self.session.query(ServerTombstone.server_id)))
+        return query.all()
 
-    def launch_online_checker(self, interval=300, purgeinterval=30):
+    def get_hidden_server_ids(self):
+        return [server_id for server_id, in self.session.query(ServerTombstone.server_id)]
+
+    def launch_online_checker(self, interval=300, purgeinterval=30, archiveinterval=None):
         """ Launch a check every 'interval' (in seconds) to verify if servers in database are online.
-            If a server have not been seen since 'purgeinterval' days, it is deleted from the index and the database.
+            If a server have not been seen since 'purgeinterval' days, it is hidden from the search results,
+            and after 'archiveinterval' days its documents are moved to the archive, see check.
         """
         self.log = logging.getLogger('ftpvista.oc')
         while True:
-            self.check(purgeinterval)
+            self.check(purgeinterval, archiveinterval)
             time.sleep(int(interval))
 
-    def check(self, purgeinterval=None):
+    def check(self, purgeinterval=None, archiveinterval=None):
+        """Update the last seen date of the online servers.
+
+        A server not seen for 'purgeinterval' days is hidden, its documents
+        stay in the index. After 'archiveinterval' days (never if None),
+        they are moved to the archive, or deleted with the server if there
+        is no archive. A hidden server seen again is shown again, an
+        archived one is restored by the indexer before being updated.
+        """
         servers = self.get_servers()
+        hidden = dict((tombstone.server_id, tombstone) for tombstone in self.session.query(ServerTombstone))
         if purgeinterval is not None:
             deltapurgeinterval = timedelta(days=int(purgeinterval))
+        if archiveinterval is not None:
+            deltaarchiveinterval = timedelta(days=int(archiveinterval))
         for server in servers:
+            tombstone = hidden.get(server.get_server_id())
             if self._tools.is_ftp_open(server.get_ip_addr()):
                 last_seen = server.last_seen
                 server.update_last_seen()
                 self.log.debug('Server %s is online. Last seen value was %s' % (server.get_ip_addr(), last_seen))
-            elif purgeinterval is not None and (server.get_last_seen() + deltapurgeinterval) < datetime.now():
-                self.log.debug('Server %s has been offline for more than %d days. It will be deleted' % (server.get_ip_addr(), purgeinterval))
-                self.delete_server(server)
+                if tombstone is not None and tombstone.archived is None:
+                    self.log.info('Server %s is back, shown again' % server.get_ip_addr())
+                    self.session.delete(tombstone)
+            elif tombstone is None:
+                if purgeinterval is not None and (server.get_last_seen() + deltapurgeinterval) < datetime.now():
+                    self.log.debug('Server %s has been offline for more than %d days. It will be hidden' % (server.get_ip_addr(), purgeinterval))
+                    self.hide_server(server)
+            elif tombstone.archived is None and archiveinterval is not None and \
+                    (server.get_last_seen() + deltaarchiveinterval) < datetime.now():
+                self.log.debug('Server %s has been offline for more than %d days. It will be archived' % (server.get_ip_addr(), archiveinterval))
+                self.archive_server(server, tombstone)
         self.save()
         self.log.debug('Online information saved !')
 
+    def hide_server(self, server):
+        """Hide the documents of the server from the search results."""
+        if self.get_tombstone(server) is None:
+            self.session.add(ServerTombstone(server.get_server_id()))
+        self.save()
+
+    def get_tombstone(self, server):
+        return self.session.query(ServerTombstone).filter_by(server_id=server.get_server_id()).first()
+
+    def archive_server(self, server, tombstone):
+        """Move the documents of a hidden server from the index to the
+        archive, then evict the oldest archives if it is full."""
+        if self.archive is None:
+            self.delete_server(server)
+            return
+        self.archive.store(server.get_server_id(), self.index.server_documents(server.get_server_id()))
+        self.index.delete_all_docs(server)
+        tombstone.archived = datetime.now()
+        self.save()
+        for server_id in self.archive.evict():
+            evicted = self.get_server(server_id)
+            if evicted is not None:
+                self.log.info('Archive of server %s evicted, it is deleted' % evicted.get_ip_addr())
+                self.delete_server(evicted)
+
+    def restore_server(self, server):
+        """Show a hidden server again, putting its archived documents back
+        in the index, so that its next update only indexes the files
+        changed since it was archived.
+
+        Returns the number of documents restored.
+        """
+        tombstone = self.get_tombstone(server)
+        if tombstone is None:
+            return 0
+        count = 0
+        if tombstone.archived is not None and self.archive is not None and \
+                server.get_server_id() in self.archive:
+            for fields in self.archive.load(server.get_server_id()):
+                self.index.add_fields(fields)
+                count += 1
+            self.index.commit()
+            self.archive.remove(server.get_server_id())
+            self.log.info('%d documents of server %s restored from the archive' % (count, server.get_ip_addr()))
+        self.session.delete(tombstone)
+        self.save()
+        return count
+
     def delete_server(self, server):
         """ Delete server files from index """
         self.index.delete_all_docs(server)
+        if self.archive is not None:
+            self.archive.remove(server.get_server_id())
         """ Delete server from DB """
+        self.session.query(ScanCheckpointDirectory).filter_by(server_id=server.get_server_id()).delete()
+        self.session.query(DirectoryListing).filter_by(server_id=server.get_server_id()).delete()
+        self.session.query(ListingCachePass).filter_by(server_id=server.get_server_id()).delete()
+        self.session.query(ServerCapabilities).filter_by(server_id=server.get_server_id()).delete()
+        self.session.query(ServerTombstone).filter_by(server_id=server.get_server_id()).delete()
         self.session.query(FTPServer).filter_by(id=server.get_server_id()).delete()
         self.save()
 
+    def get_scan_checkpoint(self, server, max_age):
+        """Returns the [path, files, dirs] entries of the directories listed
+        by the last interrupted scan of the server, or None if there is none
+        saved less than `max_age` ago."""
+        query = self.session.query(ScanCheckpointDirectory).filter_by(server_id=server.get_server_id())
+        saved = query.with_entities(func.max(ScanCheckpointDirectory.saved)).scalar()
+        if saved is None:
+            return None
+        if saved + max_age < datetime.now():
+            self.log.debug('Scan checkpoint of %s has expired' % server.get_ip_addr())
+            self.delete_scan_checkpoint(server)
+            return None
+        return [directory.get_entry() for directory in query]
+
+    def append_scan_checkpoint(self, server, directories):
+        """Add the [path, files, dirs] entries of directories listed since
+        the last checkpoint."""
+        for path, files, dirs in directories:
+            self.session.add(ScanCheckpointDirectory(server.get_server_id(), path, files, dirs))
+        self.save()
+
+    def delete_scan_checkpoint(self, server):
+        self.session.query(ScanCheckpointDirectory).filter_by(server_id=server.get_server_id()).delete()
+        self.save()
+
+    def next_listing_cache_pass(self, server):
+        """Count a new scan of the server using the listing cache,
+        returns the number of scans made before it."""
+        counter = self.session.query(ListingCachePass).filter_by(server_id=server.get_server_id()).first()
+        if counter is None:
+            counter = ListingCachePass(server.get_server_id())
+            self.session.add(counter)
+        passes = counter.passes
+        counter.passes = passes + 1
+        self.save()
+        return passes
+
+    def get_directory_listing(self, server, path):
+        return self.session.query(DirectoryListing).filter_by(server_id=server.get_server_id(), path=path).first()
+
+    def set_directory_listing(self, server, path, modify, fingerprint, entries):
+        """Store the listing of a directory, changes need to be saved."""
+        listing = self.get_directory_listing(server, path)
+        if listing is None:
+            listing = DirectoryListing(server.get_server_id(), path)
+            self.session.add(listing)
+        listing.modify = modify
+        listing.fingerprint = fingerprint
+        listing.entries = entries
+
+    def delete_directory_listings(self, server, keep=()):
+        """Delete the cached listings of the server, but those of the
+        directories in `keep`."""
+        query = self.session.query(DirectoryListing.path).filter_by(server_id=server.get_server_id())
+        for path, in query.all():
+            if path not in keep:
+                self.session.query(DirectoryListing).filter_by(server_id=server.get_server_id(), path=path).delete()
+        self.save()
+
+    def get_capabilities(self, server, max_age):
+        """Returns the capabilities of the server as a dict, or None if
+        they were never probed or were probed more than `max_age` ago."""
+        capabilities = self.session.query(ServerCapabilities).filter_by(server_id=server.get_server_id()).first()
+        if capabilities is None or capabilities.probed + max_age < datetime.now():
+            return None
+        return capabilities.get_values()
+
+    def save_capabilities(self, server, values, probed=True):
+        """Store the capabilities of the server, `probed` being False if
+        they come from the DB and were only completed by the scan."""
+        capabilities = self.session.query(ServerCapabilities).filter_by(server_id=server.get_server_id()).first()
+        if capabilities is None:
+            capabilities = ServerCapabilities(server.get_server_id())
+            self.session.add(capabilities)
+        capabilities.set_values(values)
+        if probed:
+            capabilities.probed = datetime.now()
+        self.save()
+
     def save(self):
         self.session.commit()
 
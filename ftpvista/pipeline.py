@@ -19,6 +19,18 @@ class Stage (object):
            stopped (usefull to implment filters)."""
         raise NotImplementedError
 
+    def flush(self):
+        """Finish the work left on the contexts given so far.
+
+           Only needed by the stages completing the contexts later than
+           when they are executed."""
+        pass
+
+    def close(self):
+        """Release the resources of the stage, once it is not used
+        anymore."""
+        pass
+
 
 class Pipeline (Stage):
     """Sequencial pipeline.
@@ -39,3 +51,13 @@ class Pipeline (Stage):
         for stage in self._stages:
             if not stage.execute(context):
                 break
+
+    def flush(self):
+        """Flush every stage, in order"""
+        for stage in self._stages:
+            stage.flush()
+
+    def close(self):
+        """Close every stage"""
+        for stage in self._stages:
+            stage.close()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""Read-only file object over a remote file, fetched by ranges.
+
+The tinytag parsers read the tags of Ogg, FLAC, Wave and WMA files by
+seeking over the audio data and the pictures. Given a RangeFile, only the
+blocks they actually read are fetched, the contiguous missing blocks of a
+read in a single request, and each block only once.
+"""
+
+import os
+
+
+class RangeFile(object):
+    def __init__(self, read_range, size, block_size=16384):
+        """
+        :Parameters:
+            -`read_range`: called with the first and the last byte of a
+                           range, returns its bytes
+            -`size`: size of the file
+            -`block_size`: bytes fetched at least by a request
+        """
+        self._read_range = read_range
+        self._size = size
+        self._block_size = block_size
+        self._blocks = {}  # block number => bytes
+        self._pos = 0
+        # Ranges fetched and their bytes
+        self.requests = 0
+        self.bytes = 0
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self._size
+        self._pos = max(offset, 0)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def _fetch(self, first, last):
+        """Fetch the blocks first to last missing from the cache."""
+        block = first
+        while block <= last:
+            if block in self._blocks:
+                block += 1
+                continue
+            end = block
+            while end < last and end + 1 not in self._blocks:
+                end += 1
+            data = self._read_range(block * self._block_size,
+                                    min((end + 1) * self._block_size, self._size) - 1)
+            self.requests += 1
+            self.bytes += len(data)
+            for n in range(block, end + 1):
+                offset = (n - block) * self._block_size
+                self._blocks[n] = data[offset:offset + self._block_size]
+            block = end + 1
+
+    def read(self, n=-1):
+        end = self._size if n is None or n < 0 else min(self._pos + n, self._size)
+        if end <= self._pos:
+            return b''
+        first = self._pos // self._block_size
+        last = (end - 1) // self._block_size
+        self._fetch(first, last)
+        data = b''.join(self._blocks[block] for block in range(first, last + 1))
+        offset = self._pos - first * self._block_size
+        data = data[offset:offset + end - self._pos]
+        self._pos += len(data)
+        return data
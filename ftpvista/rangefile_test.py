@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+import os
+import struct
+import unittest
+
+from . import rangefile
+from . import tinytag
+from .index import id3_tag_size
+
+
+MP3_DIR = os.path.join(os.path.dirname(__file__), 'test', 'mp3')
+
+TAGS = {'artist': 'The Artist', 'title': 'A Title', 'album': 'The Album'}
+
+
+def vorbis_comment(tags):
+    vendor = b'ftpvista'
+    data = struct.pack('<I', len(vendor)) + vendor + struct.pack('<I', len(tags))
+    for key, value in sorted(tags.items()):
+        comment = ('%s=%s' % (key.upper(), value)).encode('utf-8')
+        data += struct.pack('<I', len(comment)) + comment
+    return data
+
+
+def flac_file(tags, picture=0, audio=1 << 20):
+    """A FLAC file with the given tags, a picture of `picture` bytes and
+    `audio` bytes of audio data."""
+    def block(block_type, data, last=False):
+        return struct.pack('>I', ((block_type | (0x80 if last else 0)) << 24) | len(data)) + data
+    # 44100 Hz, 2 channels, 16 bits, 10 seconds
+    streaminfo = struct.pack('>HH6xQ16x', 4096, 4096, (44100 << 44) | (1 << 41) | (15 << 36) | 441000)
+    return (b'fLaC' + block(0, streaminfo) + block(4, vorbis_comment(tags)) +
+            block(6, b'\0' * picture, last=True) + b'\0' * audio)
+
+
+def ogg_file(tags, audio=1 << 20):
+    """An Ogg Vorbis file with the given tags and `audio` bytes of audio
+    data, not a valid stream."""
+    def page(seq, packets):
+        lacing = b''
+        for packet in packets:
+            lacing += b'\xff' * (len(packet) // 255) + bytes([len(packet) % 255])
+        return (struct.pack('<4sBBqIIiB', b'OggS', 0, 0, 0, 1, seq, 0, len(lacing)) +
+                lacing + b''.join(packets))
+    identification = b'\x01vorbis' + struct.pack('<IBIiiiBB', 0, 2, 44100, 0, 128000, 0, 0xb8, 1)
+    comment = b'\x03vorbis' + vorbis_comment(tags) + b'\x01'
+    setup = b'\x05vorbis' + b'\0' * 100
+    return page(0, [identification]) + page(1, [comment, setup]) + b'\0' * audio
+
+
+def id3v2_tag():
+    """The ID3v2.3 tag of a test mp3."""
+    with open(os.path.join(MP3_DIR, 'v1andv23tags.mp3'), 'rb') as f:
+        content = f.read()
+    return content[:id3_tag_size(content[:10]) + 10]
+
+
+def wave_file(audio=1 << 20):
+    """A Wave file with `audio` bytes of audio data, followed by the ID3
+    tag of id3v2_tag, with padding."""
+    def chunk(chunk_id, data):
+        return chunk_id + struct.pack('<I', len(data)) + data + b'\0' * (len(data) % 2)
+    fmt = struct.pack('<HHIIHH', 1, 2, 44100, 44100 * 4, 4, 16)
+    chunks = chunk(b'fmt ', fmt) + chunk(b'data', b'\0' * audio) + chunk(b'id3 ', id3v2_tag())
+    return b'RIFF' + struct.pack('<I', len(chunks) + 4) + b'WAVE' + chunks
+
+
+def wma_file(tags, padding=0, audio=1 << 20):
+    """A WMA file with the title and the artist of `tags`, an unknown
+    object of `padding` bytes in its header and `audio` bytes of audio
+    data."""
+    def asf_object(guid, data):
+        return guid + struct.pack('<Q', len(data) + 24) + data
+
+    def string(value):
+        return value.encode('utf-16-le') + b'\0\0'
+    title, artist = string(tags['title']), string(tags['artist'])
+    description = struct.pack('<5H', len(title), len(artist), 0, 0, 0) + title + artist
+    objects = (asf_object(tinytag.Wma.ASF_CONTENT_DESCRIPTION_OBJECT, description) +
+               asf_object(b'\x01' * 16, b'\0' * padding))
+    header = (b'0&\xb2u\x8ef\xcf\x11\xa6\xd9\x00\xaa\x00b\xcel' +
+              struct.pack('<QI', len(objects) + 30, 2) + b'\x01\x02' + objects)
+    # The data object
+    return header + asf_object(b'6&\xb2u\x8ef\xcf\x11\xa6\xd9\x00\xaa\x00b\xcel', b'\0' * audio)
+
+
+def expected_tags(name):
+    """The tags of the test file of audio_files named `name`"""
+    if name.endswith('.wav'):
+        return {'artist': 'ARTIST123456789012345678901234', 'title': 'TITLE1234567890123456789012345',
+                'album': 'ALBUM1234567890123456789012345'}
+    if name.endswith('.wma'):
+        return {'artist': TAGS['artist'], 'title': TAGS['title']}
+    return TAGS
+
+
+def audio_files():
+    """Returns the (name, content) of test files of the formats read with
+    a RangeFile, see expected_tags."""
+    return [('song.flac', flac_file(TAGS, picture=200000)),
+            ('song.ogg', ogg_file(TAGS)),
+            ('song.wav', wave_file()),
+            ('song.wma', wma_file(TAGS, padding=200000))]
+
+
+class TestRangeFile(unittest.TestCase):
+    def open(self, content, block_size=16):
+        self.ranges = []
+
+        def read_range(first, last):
+            self.ranges.append((first, last))
+            return content[first:last + 1]
+        return rangefile.RangeFile(read_range, len(content), block_size)
+
+    def testRead(self):
+        content = bytes(range(100))
+        f = self.open(content)
+        self.assertEqual(f.read(4), content[:4])
+        self.assertEqual(f.read(20), content[4:24])
+        self.assertEqual(f.tell(), 24)
+        f.seek(-10, os.SEEK_END)
+        self.assertEqual(f.read(), content[90:])
+        self.assertEqual(f.read(1), b'')
+        f.seek(-50, os.SEEK_CUR)
+        self.assertEqual(f.read(5), content[50:55])
+        f.seek(0)
+        self.assertEqual(f.read(100), content)
+        # Each block fetched once, the missing ones at once
+        self.assertEqual(self.ranges, [(0, 15), (16, 31), (80, 99), (48, 63), (32, 47), (64, 79)])
+        self.assertEqual((f.requests, f.bytes), (6, 100))
+
+    def testParsers(self):
+        for name, content in audio_files():
+            parser = {'flac': tinytag.Flac, 'ogg': tinytag.Ogg, 'wav': tinytag.Wave,
+                      'wma': tinytag.Wma}[name.rpartition('.')[2]]
+            f = self.open(content, 16384)
+            tags = parser(f, len(content))
+            tags.load(tags=True, duration=False, image=False)
+            for tag, value in expected_tags(name).items():
+                self.assertEqual(getattr(tags, tag), value, name)
+            # The audio data and the pictures are not fetched
+            self.assertLess(f.bytes, 64 * 1024, name)
+
+
+if __name__ == '__main__':
+    unittest.main()
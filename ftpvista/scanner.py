@@ -2,12 +2,21 @@
 """FTP scanning layer, used to sweep FTP servers for data.
 """
 
+import collections
 import ftplib
+import hashlib
+import itertools
 import os.path
 import logging
+import queue
 import re
+import tempfile
+import threading
+import time
 from datetime import datetime
 
+from .filelist import FileList
+
 
 class TooDeepError(Exception):
     def __init__(self, depth, path):
@@ -18,14 +27,260 @@ class TooDeepError(Exception):
         return 'Too deep (%d levels!). Stopping at %s' % (self.depth, self.path)
 
 
-class FTPScanner(object):
+# Beginning of a line of a Unix-like LIST output
+LIST_LINE_PATTERN = re.compile(r'^[-dlbcps][-rwxsStTl]{9}[+@.]?\s')
 
-    DATE_FORMAT = '%Y%m%d%H%M%S'
+# drwxr-xr-x   2 owner    group        4096 Mar 15 01:07 name
+# -rw-r--r--   1 owner              123456 Jan 02  2015 name with spaces
+UNIX_LIST_LINE = re.compile(
+    r'([-dlbcps])[-rwxsStTl]{9}[+@.]?\s+\d+\s+\S+\s+(?:\S+\s+)?(\d+)\s+'
+    r'([A-Za-z]{3})\s+(\d{1,2})\s+(?:(\d{1,2}):(\d{2})|(\d{4}))\s(.+)')
 
-    def __init__(self, host, ftp_class=ftplib.FTP):
-        self.host = host
-        self.ftp_class = ftp_class
-        self.log = logging.getLogger('ftpvista.scanner.%s' % self.host.replace('.', '_'))
+# 09-20-15  05:25PM       <DIR>          name
+# 2015-09-20  17:25             123456 name with spaces
+DOS_LIST_LINE = re.compile(
+    r'(\d{2})-(\d{2})-(\d{2}|\d{4})\s+(\d{1,2}):(\d{2})\s*([AaPp][Mm])?\s+'
+    r'(?:(<DIR>)|([\d,]+))\s+(.+)')
+DOS_ISO_LIST_LINE = re.compile(
+    r'(\d{4})-(\d{2})-(\d{2})\s+(\d{1,2}):(\d{2})\s*([AaPp][Mm])?\s+'
+    r'(?:(<DIR>)|([\d,]+))\s+(.+)')
+
+MONTHS = {'jan': '01', 'feb': '02', 'mar': '03', 'apr': '04', 'may': '05', 'jun': '06',
+          'jul': '07', 'aug': '08', 'sep': '09', 'oct': '10', 'nov': '11', 'dec': '12'}
+
+
+_current_year = [0, 0]        # (hour, year)
+
+
+def _this_year():
+    hour = int(time.time() // 3600)
+    if _current_year[0] != hour:
+        _current_year[:] = [hour, time.localtime().tm_year]
+    return _current_year[1]
+
+
+def _list_entry(name, isdir, size, modify):
+    if name == '.':
+        typ = 'cdir'
+    elif name == '..':
+        typ = 'pdir'
+    elif isdir:
+        typ = 'dir'
+    else:
+        typ = 'file'
+    perm = 'flcdmpe' if isdir else 'adfrw'
+    return (name, {'perm': perm, 'type': typ, 'modify': modify, 'size': size})
+
+
+def parse_list_line(line):
+    """Convert a line of a LIST output into MLSD-like (name, facts).
+
+    Unix-like and DOS/IIS-like listings are understood, returns None for
+    the other lines. The dates without a year are in the current year.
+    """
+    if line[:1].isdigit():
+        match = DOS_LIST_LINE.match(line)
+        if match is not None:
+            month, day, year, hour, minute, ampm, isdir, size, name = match.groups()
+            if len(year) == 2:
+                year = ('20' if year < '70' else '19') + year
+        else:
+            match = DOS_ISO_LIST_LINE.match(line)
+            if match is None:
+                return None
+            year, month, day, hour, minute, ampm, isdir, size, name = match.groups()
+        hour = int(hour)
+        if ampm is not None:
+            hour = hour % 12 + (12 if ampm in ('PM', 'pm', 'Pm', 'pM') else 0)
+        modify = '%s%s%s%02d%s00' % (year, month, day, hour, minute)
+        return _list_entry(name, isdir is not None, size.replace(',', '') if size else '0',
+                           modify)
+
+    match = UNIX_LIST_LINE.match(line)
+    if match is None:
+        return None
+    typ, size, month, day, hour, minute, year, name = match.groups()
+    month = MONTHS.get(month.lower())
+    if month is None:
+        return None
+    if year is None:
+        modify = '%d%s%s%s%s00' % (_this_year(), month, day.zfill(2), hour.zfill(2), minute)
+    else:
+        modify = year + month + day.zfill(2) + '000000'
+    if typ == 'l':
+        name = name.split(' -> ', 1)[0]
+    return _list_entry(name, typ == 'd', size, modify)
+
+
+class FTPCapabilities(object):
+    """What a FTP server supports, found with FEAT or by trying.
+
+    Every capability is True, False or None if it is still unknown.
+    """
+
+    FIELDS = ('utf8', 'mlsd', 'path_listing', 'list_recursive', 'stat_recursive', 'rest')
+
+    def __init__(self, probed=False, **kwargs):
+        self.probed = probed
+        for field in self.FIELDS:
+            setattr(self, field, kwargs.get(field))
+
+    def parse_feat(self, response):
+        """Read the reply of the FEAT command."""
+        features = [line.strip().upper() for line in response.splitlines()[1:-1]]
+        self.utf8 = any(f.startswith('UTF8') for f in features)
+        self.rest = any(f.startswith('REST STREAM') for f in features)
+        if any(f.startswith('MLST') for f in features):
+            self.mlsd = True
+        elif self.mlsd is None and len(features) == 0:
+            # No FEAT at all, MLSD is newer than FEAT
+            self.mlsd = False
+        self.probed = True
+
+    def to_dict(self):
+        return dict((field, getattr(self, field)) for field in self.FIELDS)
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(probed=True, **values)
+
+    def __eq__(self, other):
+        return isinstance(other, FTPCapabilities) and self.to_dict() == other.to_dict()
+
+    def __str__(self):
+        return ', '.join('%s=%s' % (field, getattr(self, field)) for field in self.FIELDS)
+
+
+class ScanStats(object):
+    """Counts the directories listed and the FTP commands sent during a
+    scan, the commands opening a data connection being counted as
+    transfers too."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.directories = 0
+        self.commands = 0
+        self.transfers = 0
+
+    def count(self, directories=0, commands=0, transfers=0):
+        with self._lock:
+            self.directories += directories
+            self.commands += commands
+            self.transfers += transfers
+
+    def commands_per_directory(self):
+        return self.commands / max(1, self.directories)
+
+    def __str__(self):
+        return ('%d directories listed, %d commands (%.1f per directory), %d transfers'
+                % (self.directories, self.commands, self.commands_per_directory(), self.transfers))
+
+
+class ListingCache(object):
+    """Interface of the cache of directory listings used by FTPScanner.
+
+    The listing of a directory is served from the cache when the modify
+    fact of the directory, given by the listing of its parent, did not
+    change since it was stored. Its whole subtree is then served from the
+    cache as well.
+    """
+
+    def begin_pass(self):
+        """Called when a scan starts, returns True if the cache must not be
+        used for this scan (full rescan)."""
+        raise NotImplementedError
+
+    def get(self, path):
+        """Returns the (modify, fingerprint, entries) stored for the
+        directory, or None."""
+        raise NotImplementedError
+
+    def put(self, path, modify, fingerprint, entries):
+        raise NotImplementedError
+
+    def end_pass(self, visited):
+        """Called when a scan completes with the set of the directories
+        found on the server, so that the others can be forgotten."""
+        raise NotImplementedError
+
+
+class _ListingCacheSession(object):
+    """Use of a ListingCache during one scan, shared by the scan workers."""
+
+    def __init__(self, cache, log, lock):
+        self.log = log
+        self._cache = cache
+        self._lock = lock
+        self._full = cache.begin_pass()
+        self._modifies = {}     # path => modify fact given by the parent listing
+        self._trusted = set()   # paths whose parent was served from the cache
+        self._visited = None
+        self.listed = 0
+        self.cached = 0
+        if self._full:
+            self.log.info('Full rescan, the listing cache is not used')
+
+    @staticmethod
+    def fingerprint(entries):
+        digest = hashlib.sha1()
+        for filename, facts in sorted(entries):
+            digest.update(('%s/%s/%s/%s\n' % (filename, facts['type'], facts.get('size'),
+                                               facts.get('modify'))).encode('utf-8', 'replace'))
+        return digest.hexdigest()[:16]
+
+    def _children(self, dir, entries, trusted):
+        for filename, facts in entries:
+            if facts['type'] == 'dir':
+                path = os.path.join(dir, filename)
+                self._modifies[path] = facts.get('modify')
+                if trusted:
+                    self._trusted.add(path)
+
+    def lookup(self, dir):
+        """Returns the cached entries of the directory if it can be trusted."""
+        with self._lock:
+            modify = self._modifies.get(dir)
+            trusted = dir in self._trusted
+            if self._full or (modify is None and not trusted):
+                return None
+            cached = self._cache.get(dir)
+            if cached is None or not (trusted or cached[0] == modify):
+                return None
+            self._modifies.pop(dir, None)
+            self._trusted.discard(dir)
+            entries = [(filename, facts) for filename, facts in cached[2]]
+            self._children(dir, entries, True)
+            self.cached += 1
+            return entries
+
+    def store(self, dir, entries):
+        """Store the fresh listing of the directory."""
+        # Only keep what is needed to build the files and the subdirectories
+        kept = [(filename, dict((k, facts[k]) for k in ('type', 'size', 'perm', 'modify') if k in facts))
+                for filename, facts in entries if facts['type'] in ('dir', 'file')]
+        fingerprint = self.fingerprint(kept)
+        with self._lock:
+            modify = self._modifies.pop(dir, None)
+            self._trusted.discard(dir)
+            self._children(dir, kept, False)
+            self.listed += 1
+            cached = self._cache.get(dir)
+            if cached is None or cached[0] != modify or cached[1] != fingerprint:
+                self._cache.put(dir, modify, fingerprint, kept)
+
+    def set_visited(self, visited):
+        self._visited = visited
+
+    def finish(self):
+        self.log.info('%d directories listed, %d served from the listing cache' % (self.listed, self.cached))
+        if self._visited is not None:
+            self._cache.end_pass(self._visited)
+
+
+class BaseScanner(object):
+    """Listing interpretation shared by the FTP scanning engines."""
+
+    DATE_FORMAT = '%Y%m%d%H%M%S'
 
     def grab_info(self, facts):
         isdir, skip = False, False
@@ -42,6 +297,88 @@ class FTPScanner(object):
 
         return isdir, not skip
 
+    def add_entry(self, dir, filename, facts, files, extra_dirs):
+        """Sort a listing entry of `dir` into `files` or `extra_dirs`.
+
+        facts content example
+
+        facts['type'] : 'cdir'
+        facts['perm'] : 'fle'
+        facts['modify'] : '20150920172522'
+        facts['size'] : '77'
+        """
+
+        is_dir, interesting = self.grab_info(facts)
+        full_path = os.path.join(dir, filename)
+
+        if interesting:
+            if is_dir:
+                extra_dirs.append(full_path)
+            else:
+                try:
+                    date = datetime.strptime(facts['modify'].split('.', 1)[0], BaseScanner.DATE_FORMAT)
+                    # Fix dates in the future
+                    if date is not None and date > datetime.now():
+                        date = date.replace(datetime.now().year - 1)
+
+                    files.add(dir, filename, int(facts['size']), date)
+                except ValueError:
+                    return
+
+    def _too_deep(self, depth, cwd):
+        self.log.error('The path is too deep (%d levels)' % depth)
+        self.log.error('Stopping at %s' % cwd)
+        self.log.error('Probably an ill-configured server.')
+        raise TooDeepError(depth, cwd)
+
+
+class FTPScanner(BaseScanner):
+
+    MLSD_FACTS = ("type", "size", "perm", "modify")
+
+    # Recursive listing commands, with the matching FTPCapabilities attribute
+    RECURSIVE_COMMANDS = collections.OrderedDict([('LIST -R', 'list_recursive'),
+                                                  ('STAT -R', 'stat_recursive')])
+
+    def __init__(self, host, ftp_class=ftplib.FTP, connections=1,
+                 checkpoint=None, checkpoint_interval=60, listing_cache=None,
+                 recursive=False, capabilities=None, stats=None):
+        """
+        :Parameters:
+            -`host`: the server IP address
+            -`ftp_class`: class used to open the FTP connections
+            -`connections`: number of anonymous connections used to crawl
+                            the server in parallel
+            -`checkpoint`: optional object with `load()`, `append(directories)`
+                           and `clear()` methods, used to resume interrupted
+                           scans, see _load_checkpoint
+            -`checkpoint_interval`: seconds between two checkpoints
+            -`listing_cache`: optional ListingCache, used to skip the
+                              directories which did not change
+            -`recursive`: try to get the whole tree at once with LIST -R
+                          or STAT -R before walking the directories
+            -`capabilities`: FTPCapabilities of the server found by a
+                             previous scan, probed if None
+            -`stats`: ScanStats counting the work done, shared by the
+                      connections of the scan
+        """
+        self.host = host
+        self.ftp_class = ftp_class
+        self.connections = max(1, connections)
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self._last_checkpoint = 0
+        # Directories listed since the last checkpoint
+        self._unsaved = []
+        self.listing_cache = listing_cache
+        self._cache_session = None
+        self.recursive = recursive
+        self.capabilities = capabilities or FTPCapabilities()
+        self.stats = stats or ScanStats()
+        # The checkpoints and the listing cache may share the same storage
+        self._store_lock = threading.Lock()
+        self.log = logging.getLogger('ftpvista.scanner.%s' % self.host.replace('.', '_'))
+
     def parse_date(self, date):
         if re.match(self.DATE_WITH_YEAR_PATTERN, date):
             return datetime.strptime(date, '%b %d %Y')
@@ -60,115 +397,445 @@ class FTPScanner(object):
         self.ftp = self.ftp_class(self.host)
         self.ftp.login()
         self.ftp.set_pasv(True)
-        self.ftp.sendcmd("OPTS UTF8 ON")
+        self.stats.count(commands=2)
+        if not self.capabilities.probed:
+            self._probe_features()
+        if self.capabilities.utf8:
+            self._sendcmd("OPTS UTF8 ON")
+        if self.capabilities.mlsd is not False:
+            # Once per connection rather than before each MLSD
+            try:
+                self._sendcmd('OPTS MLST ' + ''.join(f + ';' for f in self.MLSD_FACTS))
+            except ftplib.error_perm as e:
+                self.log.debug('OPTS MLST failed: %s' % e)
         self.ftp.encoding = 'utf-8'
 
-    def disconnect(self):
-        self.ftp.quit()
-
-    def scan_legacy(self, parse_line):
-        items = []
-        files = self.ftp.nlst()
-        self.ftp.retrlines('LIST', items.append)
-        items = [item.split() for item in items]
-
-        def interpret_line(line, file_name):
-            import datetime
-            import time
-            permissions = line.pop(0)
-            line.pop(0)
-            line.pop(0)
-            line.pop(0)
-            size = line.pop(0)
-            month = line.pop(0)
-            month = datetime.datetime.strptime(month, "%b").month
-            if month < 10:
-                month = '0%d' % month
-            else:
-                month = str(month)
-            day = line.pop(0)
-            hour = line.pop(0)
-            if re.match('([0-9]+)\:([0-9])', hour):
-                year = str(datetime.date.today().year)
-            else:
-                year = hour
-                hour = '00:00'
-            hour = re.sub(':', '', hour)
-            modify = '%s%s%s%s00' % (year, month, day, hour)
-            if file_name == '.':
-                typ = 'cdir'
-            elif file_name == '..':
-                typ = 'pdir'
-            elif permissions[0] == 'd':
-                typ = 'dir'
-            else:
-                typ = 'file'
-            if typ == 'file':
-                perm = 'adfrw'
-            else:
-                perm = 'flcdmpe'
-            return (file_name, {'perm': perm, 'type': typ, 'modify': modify, 'size': size})
+    def _sendcmd(self, cmd):
+        self.stats.count(commands=1)
+        return self.ftp.sendcmd(cmd)
+
+    def _cwd(self, dir):
+        self.stats.count(commands=1)
+        self.ftp.cwd(dir)
+
+    def _probe_features(self):
+        try:
+            self.capabilities.parse_feat(self._sendcmd('FEAT'))
+        except ftplib.error_perm as e:
+            # FEAT came with MLSD and UTF8, none of them is supported
+            self.log.info('FEAT is not supported: %s' % e)
+            self.capabilities.parse_feat('')
+        self.log.debug('Server capabilities : %s' % self.capabilities)
 
-        i = 0
-        for line in items:
-            filename, facts = interpret_line(line, files[i])
-            parse_line(filename, facts)
-            i+=1
+    def disconnect(self):
+        try:
+            self.ftp.quit()
+        except ftplib.all_errors:
+            # Already broken, everything was listed anyway
+            self.ftp.close()
+
+    def scan_legacy(self, parse_line, path=''):
+        """List with LIST, when MLSD is not supported."""
+        self.stats.count(commands=1, transfers=1)
+
+        def parse(line):
+            entry = parse_list_line(line)
+            if entry is not None:
+                parse_line(*entry)
+            elif line.strip() and not line.startswith('total '):
+                self.log.debug('Unable to parse LIST line: %s' % line)
+
+        self.ftp.retrlines('LIST %s' % path if path else 'LIST', parse)
+
+    def _list_dir(self, path, parse_line):
+        """List `path`, or the current directory if `path` is empty."""
+        if self.capabilities.mlsd is not False:
+            try:
+                self.stats.count(commands=1, transfers=1)
+                for filename, facts in self.ftp.mlsd(path):
+                    parse_line(filename, facts)
+                self.capabilities.mlsd = True
+                return
+            except ftplib.error_perm as e:
+                # 501 may be about the path argument, not about MLSD
+                unsupported = ('500', '502') if path else ('500', '501', '502')
+                if str(e).split()[0] not in unsupported:
+                    raise
+                # Do not try again in the other directories
+                self.capabilities.mlsd = False
+        self.scan_legacy(parse_line, path)
+
+    def list_entries(self, dir):
+        """Returns the (filename, facts) entries of the listing of `dir`.
+
+        The absolute path is given to MLSD or LIST to save a CWD, unless
+        the server is known not to accept it.
+        """
+        entries = []
 
+        def parse_line(filename, facts):
+            entries.append((filename, facts))
+
+        self.stats.count(directories=1)
+        # LIST may take its argument as a pattern
+        by_path = (self.capabilities.path_listing is not False and
+                   not (self.capabilities.mlsd is False and any(c in dir for c in '*?[')))
+        mlsd = self.capabilities.mlsd
+        if by_path:
+            try:
+                self._list_dir(dir, parse_line)
+                self.capabilities.path_listing = True
+                return entries
+            except ftplib.error_perm as e:
+                if self.capabilities.path_listing:
+                    self.log.warn('Unable to list %s: %s' % (dir, e))
+                    return entries
+                self.log.debug('Listing %s by path failed, trying with CWD: %s' % (dir, e))
+                del entries[:]
+
+        self._cwd(dir)
+        try:
+            self._list_dir('', parse_line)
+            # The path was maybe fine, but not MLSD
+            if by_path and not (mlsd is not False and self.capabilities.mlsd is False):
+                self.log.info('The server does not accept a path to list, using CWD')
+                self.capabilities.path_listing = False
+        except ftplib.error_perm as e:
+            self.log.warn('Unable to list %s: %s' % (dir, e))
+        return entries
 
     def list_files(self, dir):
         extra_dirs = []
-        files = []
+        files = FileList()
+        for filename, facts in self.list_entries(dir):
+            self.add_entry(dir, filename, facts, files, extra_dirs)
+        return files, extra_dirs
 
-        def parse_line(filename, facts):
-            """
-            facts content example
+    def _list(self, worker, dir):
+        """List `dir` with the connection of `worker`, or get its listing
+        from the cache if the directory did not change."""
+        if self._cache_session is None:
+            return worker.list_files(dir)
 
-            facts['type'] : 'cdir'
-            facts['perm'] : 'fle'
-            facts['modify'] : '20150920172522'
-            facts['size'] : '77'
-            """
+        entries = self._cache_session.lookup(dir)
+        if entries is None:
+            entries = worker.list_entries(dir)
+            self._cache_session.store(dir, entries)
 
-            is_dir, interesting = self.grab_info(facts)
-            full_path = os.path.join(dir, filename)
+        extra_dirs = []
+        files = FileList()
+        for filename, facts in entries:
+            self.add_entry(dir, filename, facts, files, extra_dirs)
+        return files, extra_dirs
 
-            if interesting:
-                if is_dir:
-                    extra_dirs.append(full_path)
-                else:
+    def _iter_scan(self, ignores, max_depth):
+        ignores = ignores or []
+        ignores = set(ignores)
+
+        if self.connections > 1:
+            yield from self._iter_scan_parallel(ignores, max_depth)
+            return
+
+        self.connect()
+
+        # (path, depth) we need to process, paths already processed and
+        # files found before the scan was interrupted
+        dirs, visited, resumed = self._load_checkpoint()
+        yield from resumed.chunks()
+        del resumed
+
+        # directories whose listing failed once
+        retried = set()
+        try:
+            if self.recursive and len(visited) == 0:
+                yield from self._iter_recursive(self, dirs, visited, ignores, max_depth)
+
+            while len(dirs) > 0:
+                try:
+                    cwd, depth = dirs.pop()
+
+                    if cwd in ignores:
+                        self.log.info('Skipping %s' % cwd)
+                        continue
+
+                    if cwd in visited:
+                        self.log.warn('Loop detected, %s was already visited' % cwd)
+                        continue
+
+                    cwd_files, cwd_dirs = self._list(self, cwd)
+
+                    if depth < max_depth:
+                        for d in cwd_dirs:
+                            dirs.add((d, depth+1))
+                    else:
+                        self._too_deep(depth, cwd)
+
+                    visited.add(cwd)
+                    self._listed(cwd, cwd_files, cwd_dirs, depth + 1)
+
+                    self.log.debug('%d directories left to scan' % len(dirs))
+                except ftplib.all_errors as e:
+                    self.log.error("Okay, got an exception here.")
+                    self.log.error("Trying to reconnect and continue.")
+                    self.log.error("Error: %s" % e)
+                    self.log.error(e.__class__)
                     try:
-                        date = datetime.strptime(facts['modify'].split('.', 1)[0], FTPScanner.DATE_FORMAT)
-                        # Fix dates in the future
-                        if date is not None and date > datetime.now():
-                            date = date.replace(datetime.now().year - 1)
+                        self.connect()
+                    except ftplib.all_errors:
+                        # The server is probably gone, save the progress to
+                        # resume the scan the next time it is seen
+                        if self.checkpoint is not None:
+                            self._save_checkpoint()
+                        raise
+                    # Listed again once on the new connection, its files
+                    # would be deleted from the index otherwise
+                    if cwd not in retried:
+                        retried.add(cwd)
+                        dirs.add((cwd, depth))
+                    continue
 
-                        files.append((full_path, int(facts['size']), date))
-                    except ValueError:
-                        return
+                self._maybe_checkpoint()
+                if len(cwd_files) > 0:
+                    yield cwd_files
+        except TooDeepError:
+            self._clear_checkpoint()
+            raise
 
-        self.ftp.cwd(dir)
+        self._clear_checkpoint()
+        if self._cache_session is not None:
+            self._cache_session.set_visited(visited)
+        self.disconnect()
+
+    def _recursive_lines(self, worker, command):
+        """Run a recursive listing command, returns a file containing the
+        lines sent by the server and whether the output is complete.
+
+        The output is spooled to disk so that the transfer does not stall
+        while the files are indexed.
+        """
+        spool = tempfile.TemporaryFile('w+', encoding='utf-8', errors='replace')
+        complete = False
+        if getattr(self.capabilities, self.RECURSIVE_COMMANDS[command]) is False:
+            spool.seek(0)
+            return spool, complete
         try:
-            for filename, facts in self.ftp.mlsd(facts=["type", "size", "perm", "modify"]):
-                parse_line(filename, facts)
+            if command == 'LIST -R':
+                worker._cwd('/')
+                worker._sendcmd('TYPE A')
+                worker.stats.count(commands=1, transfers=1)
+                conn = worker.ftp.transfercmd(command)
+                with conn.makefile('r', encoding=worker.ftp.encoding, errors='replace') as fp:
+                    for line in fp:
+                        spool.write(line.rstrip('\r\n') + '\n')
+                conn.close()
+                worker.ftp.voidresp()
+            else:
+                response = worker._sendcmd('%s /' % command)
+                # Drop the first and last lines of the reply, the other ones
+                # may be indented by one space
+                for line in response.splitlines()[1:-1]:
+                    spool.write(line[1:] + '\n' if line.startswith(' ') else line + '\n')
+            complete = True
         except ftplib.error_perm as e:
-            if str(e).split()[0] == '501':
-                self.scan_legacy(parse_line)
+            self.log.info('%s is not supported: %s' % (command, e))
+            setattr(self.capabilities, self.RECURSIVE_COMMANDS[command], False)
+        except ftplib.all_errors as e:
+            self.log.warn('%s interrupted: %s' % (command, e))
+            worker.connect()
+        spool.seek(0)
+        return spool, complete
+
+    def _parse_recursive(self, lines):
+        """Split the output of a recursive listing in sections, yields a
+        (directory, entries, ok) tuple per section, `ok` being False if
+        some lines of the section could not be parsed."""
+        current, entries, ok = '/', [], True
+        for line in lines:
+            line = line.rstrip('\n')
+            if line.strip() == '' or line.startswith('total '):
+                continue
+            entry = parse_list_line(line)
+            if entry is not None:
+                entries.append(entry)
+            elif LIST_LINE_PATTERN.match(line):
+                ok = False
+            elif line.endswith(':'):
+                if len(entries) > 0 or not ok:
+                    yield current, entries, ok
+                header = line[:-1]
+                if header.startswith('./'):
+                    header = header[1:]
+                elif header == '.':
+                    header = '/'
+                elif not header.startswith('/'):
+                    header = '/' + header
+                current, entries, ok = header.rstrip('/') or '/', [], True
+            else:
+                ok = False
+        yield current, entries, ok
+
+    @staticmethod
+    def _all_but_last(iterable):
+        previous = None
+        for item in iterable:
+            if previous is not None:
+                yield previous
+            previous = item
+
+    def _iter_recursive(self, worker, dirs, visited, ignores, max_depth):
+        """Get the tree of the server with a single recursive listing.
+
+        The directories expected to be in the listing but for which no
+        complete section was found are left in `dirs` to be walked.
+        """
+        expected = dict(dirs)           # path => depth
+        for command in self.RECURSIVE_COMMANDS:
+            spool, complete = self._recursive_lines(worker, command)
+            sections = self._parse_recursive(spool)
+            if not complete:
+                # The last section may be truncated
+                sections = self._all_but_last(sections)
+            first = next(sections, None)
+            if first is None or not first[2]:
+                spool.close()
+                if complete:
+                    # Probably ignored -R, or sent something unexpected
+                    setattr(self.capabilities, self.RECURSIVE_COMMANDS[command], False)
+                continue
+            if complete:
+                setattr(self.capabilities, self.RECURSIVE_COMMANDS[command], True)
+
+            count = 0
+            for cwd, entries, ok in itertools.chain([first], sections):
+                count += 1
+                if cwd in ignores or any(cwd.startswith(i.rstrip('/') + '/') for i in ignores):
+                    continue
+                if cwd in visited:
+                    self.log.warn('Loop detected, %s was already visited' % cwd)
+                    continue
+                if not ok or cwd not in expected:
+                    continue
 
-        return files, extra_dirs
+                depth = expected.pop(cwd)
+                if self._cache_session is not None:
+                    self._cache_session.store(cwd, entries)
+                cwd_files, cwd_dirs = FileList(), []
+                for filename, facts in entries:
+                    self.add_entry(cwd, filename, facts, cwd_files, cwd_dirs)
 
-    def _scan(self, ignores, max_depth):
-        ignores = ignores or []
-        ignores = set(ignores)
+                if depth < max_depth:
+                    for d in cwd_dirs:
+                        expected[d] = depth + 1
+                else:
+                    spool.close()
+                    self._too_deep(depth, cwd)
 
-        self.connect()
+                visited.add(cwd)
+                self._listed(cwd, cwd_files, cwd_dirs, depth + 1)
+                if len(cwd_files) > 0:
+                    yield cwd_files
+            spool.close()
+            self.log.info('%s returned %d directories' % (command, count))
+            break
+
+        dirs.clear()
+        dirs.update(expected.items())
+        self.log.debug('%d directories left to scan' % len(dirs))
+
+    def _load_checkpoint(self):
+        """Returns the (dirs, visited, files) state to start the scan with,
+        `files` being a FileList of the files found before the scan was
+        interrupted.
+
+        The checkpoint holds a [path, files, dirs] entry per listed
+        directory, appended as the scan goes : the directories left are the
+        sub-directories of the entries which were not listed yet.
+        """
+        dirs = set([('/', 0)])
+        visited = set()
+        files = FileList()
+        self._unsaved = []
+        if self.checkpoint is None:
+            return dirs, visited, files
+
+        self._last_checkpoint = time.time()
+        directories = self.checkpoint.load()
+        if directories is not None:
+            for path, dir_files, subdirs in directories:
+                visited.add(path)
+                files.extend((file_path, size, datetime.strptime(mtime, BaseScanner.DATE_FORMAT))
+                             for file_path, size, mtime in dir_files)
+                dirs.update((subdir, depth) for subdir, depth in subdirs)
+            dirs = set((path, depth) for path, depth in dirs if path not in visited)
+            self.log.info('Resuming scan : %d directories done, %d left, %d files found'
+                          % (len(visited), len(dirs), len(files)))
+        return dirs, visited, files
+
+    def _listed(self, cwd, files, subdirs, depth):
+        """Keep a listed directory, its files and its sub-directories of
+        the given depth until the next checkpoint."""
+        if self.checkpoint is not None:
+            self._unsaved.append([cwd,
+                                  [[path, size, mtime.strftime(BaseScanner.DATE_FORMAT)]
+                                   for path, size, mtime in files],
+                                  [[subdir, depth] for subdir in subdirs]])
+
+    def _save_checkpoint(self):
+        """Append the directories listed since the last checkpoint."""
+        if len(self._unsaved) > 0:
+            with self._store_lock:
+                self.checkpoint.append(self._unsaved)
+            self.log.debug('Checkpoint saved : %d more directories listed' % len(self._unsaved))
+            self._unsaved = []
+        self._last_checkpoint = time.time()
+
+    def _maybe_checkpoint(self):
+        if self.checkpoint is not None and \
+                time.time() - self._last_checkpoint >= self.checkpoint_interval:
+            self._save_checkpoint()
+
+    def _clear_checkpoint(self):
+        if self.checkpoint is not None:
+            self.checkpoint.clear()
+
+    def _iter_scan_parallel(self, ignores, max_depth):
+        """Crawl the server using a pool of `self.connections` connections.
+
+        Every worker owns its own FTP connection and pops directories from
+        a shared frontier. The scan ends when the frontier is empty and no
+        worker is still listing a directory.
+        The files found by the workers are handed to the caller through a
+        bounded queue, so that slow consumers throttle the crawl.
+        """
+        cond = threading.Condition()
+        # (path, depth) we need to process, paths already processed or being
+        # processed and files found before the scan was interrupted
+        dirs, visited, resumed = self._load_checkpoint()
+        results = queue.Queue(self.connections * 4)
+        state = {'busy': 0, 'error': None, 'cancelled': False}
+        # paths listed again after an error
+        retried = set()
+
+        def stopped():
+            return state['error'] is not None or state['cancelled']
+
+        def publish(item):
+            while True:
+                try:
+                    results.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    if state['cancelled']:
+                        return
 
-        dirs = set([('/', 0)])          # (path, depth) we need to process
-        visited = set()                 # paths already processed
-        files = []
+        def next_dir():
+            # Must be called with the condition acquired
+            while True:
+                while len(dirs) == 0 and state['busy'] > 0 and not stopped():
+                    cond.wait()
+                if stopped() or len(dirs) == 0:
+                    return None
 
-        while len(dirs) > 0:
-            try:
                 cwd, depth = dirs.pop()
 
                 if cwd in ignores:
@@ -179,41 +846,171 @@ class FTPScanner(object):
                     self.log.warn('Loop detected, %s was already visited' % cwd)
                     continue
 
-                cwd_files, cwd_dirs = self.list_files(cwd)
+                visited.add(cwd)
+                state['busy'] += 1
+                return cwd, depth
+
+        def work(worker):
+            while True:
+                with cond:
+                    item = next_dir()
+                    if item is None:
+                        cond.notify_all()
+                        return
+                cwd, depth = item
+
+                try:
+                    cwd_files, cwd_dirs = self._list(worker, cwd)
+                except ftplib.all_errors as e:
+                    worker.log.error("Okay, got an exception here.")
+                    worker.log.error("Trying to reconnect and continue.")
+                    worker.log.error("Error: %s" % e)
+                    worker.log.error(e.__class__)
+                    # Still busy while reconnecting, the other workers must
+                    # not end the scan before the directory is queued again
+                    worker.connect()
+                    with cond:
+                        visited.discard(cwd)
+                        state['busy'] -= 1
+                        # Listed again once on the new connection, its files
+                        # would be deleted from the index otherwise
+                        if cwd not in retried:
+                            retried.add(cwd)
+                            dirs.add((cwd, depth))
+                        cond.notify_all()
+                    continue
 
-                if depth < max_depth:
-                    for d in cwd_dirs:
-                        dirs.add((d, depth+1))
-                else:
-                    self.log.error('The path is too deep (%d levels)' % depth)
-                    self.log.error('Stopping at %s' % cwd)
-                    self.log.error('Probably an ill-configured server.')
-                    raise TooDeepError(depth, cwd)
+                if len(cwd_files) > 0:
+                    publish(cwd_files)
 
-                files.extend(cwd_files)
-                visited.add(cwd)
+                with cond:
+                    state['busy'] -= 1
+                    self._listed(cwd, cwd_files, cwd_dirs, depth + 1)
+                    if depth < max_depth:
+                        for d in cwd_dirs:
+                            dirs.add((d, depth+1))
+                    else:
+                        state['error'] = TooDeepError(depth, cwd)
+                        cond.notify_all()
+                        self._too_deep(depth, cwd)
+                    cond.notify_all()
 
-                self.log.debug('%d directories left to scan' % len(dirs))
-            except ftplib.all_errors as e:
-                self.log.error("Okay, got an exception here.")
-                self.log.error("Trying to reconnect and continue.")
-                self.log.error("Error: %s" % e)
-                self.log.error(e.__class__)
-                self.connect()
+                    self.log.debug('%d directories left to scan' % len(dirs))
 
-        self.disconnect()
-        return files
+        def run(worker, connected):
+            try:
+                if not connected:
+                    try:
+                        worker.connect()
+                    except ftplib.all_errors as e:
+                        # The server may limit the number of connections per
+                        # client, just continue with a smaller pool
+                        worker.log.warn('Unable to open an extra connection: %s' % e)
+                        return
+                work(worker)
+                worker.disconnect()
+            except TooDeepError:
+                pass
+            except Exception as e:
+                with cond:
+                    if state['error'] is None:
+                        state['error'] = e
+                    cond.notify_all()
+            finally:
+                publish(None)
+
+        # The first connection is opened here so that login errors are
+        # reported exactly as in the sequential scan
+        workers = [self._spawn_worker(n) for n in range(self.connections)]
+        workers[0].connect()
+
+        if self.recursive and len(visited) == 0:
+            try:
+                yield from self._iter_recursive(workers[0], dirs, visited, ignores, max_depth)
+            except TooDeepError:
+                self._clear_checkpoint()
+                raise
+
+        threads = []
+        for n, worker in enumerate(workers):
+            thread = threading.Thread(target=run, args=(worker, n == 0),
+                                      name='scanner-%s-%d' % (self.host, n))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        def checkpoint(force=False):
+            if self.checkpoint is None:
+                return
+            with cond:
+                if force:
+                    self._save_checkpoint()
+                else:
+                    self._maybe_checkpoint()
 
-    def scan(self, ignores=None, max_depth=50):
-        self.log.info('Starting FTP scan.')
         try:
-            files = self._scan(ignores, max_depth)
-            self.log.info('Scan complete.')
-            return files
-        except ftplib.error_perm as e:
+            yield from resumed.chunks()
+            del resumed
+
+            finished = 0
+            while finished < len(threads):
+                cwd_files = results.get()
+                if cwd_files is None:
+                    finished += 1
+                else:
+                    checkpoint()
+                    yield cwd_files
+
+            if isinstance(state['error'], TooDeepError):
+                self._clear_checkpoint()
+            elif state['error'] is not None:
+                checkpoint(force=True)
+            else:
+                self._clear_checkpoint()
+                if self._cache_session is not None:
+                    self._cache_session.set_visited(visited)
+            if state['error'] is not None:
+                raise state['error']
+        finally:
+            # Stop the workers if the caller gave up on the scan
+            with cond:
+                state['cancelled'] = True
+                cond.notify_all()
+
+    def _spawn_worker(self, n):
+        worker = FTPScanner(self.host, self.ftp_class, capabilities=self.capabilities,
+                            stats=self.stats)
+        worker.log = logging.getLogger('%s.%d' % (self.log.name, n))
+        return worker
+
+    def iter_scan(self, ignores=None, max_depth=50):
+        """Scan the server, yields the list of the files of each directory
+        as soon as it has been listed.
+
+        Unlike `scan`, FTP errors aborting the scan are raised.
+        """
+        self.log.info('Starting FTP scan.')
+        if self.listing_cache is not None:
+            self._cache_session = _ListingCacheSession(self.listing_cache, self.log, self._store_lock)
+        yield from self._iter_scan(ignores, max_depth)
+        if self._cache_session is not None:
+            self._cache_session.finish()
+            self._cache_session = None
+        self.log.info('Scan complete : %s' % self.stats)
+
+    def log_scan_error(self, e):
+        if isinstance(e, ftplib.error_perm):
             self.log.error('Permission error during scan, probably couldn\'t log in.')
             self.log.error('Error was: %s' % e)
-            self.log.error('Scan terminated.')
-        except ftplib.all_errors as e:
+        else:
             self.log.error('Error while scanning FTP: %s' % e)
-            self.log.error('Scan terminated.')
+        self.log.error('Scan terminated.')
+
+    def scan(self, ignores=None, max_depth=50):
+        try:
+            files = FileList()
+            for cwd_files in self.iter_scan(ignores, max_depth):
+                files.extend(cwd_files)
+            return files
+        except ftplib.all_errors as e:
+            self.log_scan_error(e)
@@ -1,6 +1,8 @@
 #!/usr/bin/env python2.5
 # -*- coding: utf-8 -*-
 
+import ftplib
+import threading
 import unittest
 import logging
 from datetime import datetime
@@ -139,6 +141,568 @@ class TestFTPScanner(unittest.TestCase):
         self.assertEquals(set(self.ftp.scan(['/hda'])), expected_files)
 
 
+MLSD_TREE = {
+    '/': [('.', {'type': 'cdir', 'perm': 'el'}),
+          ('a', {'type': 'dir', 'perm': 'el', 'modify': '20150101000000'}),
+          ('b', {'type': 'dir', 'perm': 'el', 'modify': '20150101000000'}),
+          ('locked', {'type': 'dir', 'perm': 'r', 'modify': '20150101000000'}),
+          ('root.txt', {'type': 'file', 'size': '10', 'modify': '20150102030405'})],
+    '/a': [('a1', {'type': 'dir', 'perm': 'el', 'modify': '20150101000000'}),
+           ('a.txt', {'type': 'file', 'size': '20', 'modify': '20150102030405'})],
+    '/a/a1': [('a1.txt', {'type': 'file', 'size': '30', 'modify': '20150102030405.123'})],
+    '/b': [('b.txt', {'type': 'file', 'size': '40', 'modify': '20150102030405'})],
+}
+
+
+FEAT_RESPONSE = '211-Features:\n MLST type*;size*;modify*;perm*;\n UTF8\n REST STREAM\n211 End'
+
+
+class MockMLSDFTP(object):
+    """A fake FTP connection serving MLSD_TREE.
+
+    `failures` maps a path to the number of times listing it must fail.
+    Without MLSD support, LIST_TREE is served instead. Without
+    `path_listing`, only the current directory can be listed.
+    """
+    failures = {}
+    connections = 0
+    listed = []
+    stat_output = None
+    offline_after_failure = False
+    offline = False
+    features = FEAT_RESPONSE
+    mlsd_supported = True
+    path_listing = True
+    commands = []
+
+    def __init__(self, host):
+        assert host == TEST_IP
+        if MockMLSDFTP.offline:
+            raise ConnectionRefusedError(111, 'Connection refused')
+        self._cwd = '/'
+        MockMLSDFTP.connections += 1
+
+    def login(self):
+        pass
+
+    def set_pasv(self, on):
+        pass
+
+    def sendcmd(self, cmd):
+        MockMLSDFTP.commands.append(cmd)
+        if cmd == 'FEAT':
+            if MockMLSDFTP.features is None:
+                raise ftplib.error_perm('500 Unknown command.')
+            return MockMLSDFTP.features
+        if cmd.startswith('STAT'):
+            if MockMLSDFTP.stat_output is None:
+                raise ftplib.error_perm('500 Unknown command.')
+            return MockMLSDFTP.stat_output
+
+    def transfercmd(self, cmd):
+        raise ftplib.error_perm('550 -R: No such file or directory.')
+
+    def cwd(self, dir):
+        MockMLSDFTP.commands.append('CWD')
+        self._cwd = dir
+
+    def _target(self, path):
+        if path and not MockMLSDFTP.path_listing:
+            raise ftplib.error_perm('501 Invalid argument.')
+        return path or self._cwd
+
+    def mlsd(self, path='', facts=[]):
+        MockMLSDFTP.commands.append('MLSD')
+        if not MockMLSDFTP.mlsd_supported:
+            raise ftplib.error_perm('500 Unknown command.')
+        path = self._target(path)
+        if MockMLSDFTP.failures.get(path, 0) > 0:
+            MockMLSDFTP.failures[path] -= 1
+            MockMLSDFTP.offline = MockMLSDFTP.offline_after_failure
+            raise ftplib.error_temp('425 Can\'t open data connection.')
+        MockMLSDFTP.listed.append(path)
+        return iter(MLSD_TREE[path])
+
+    def retrlines(self, cmd, callback):
+        MockMLSDFTP.commands.append('LIST')
+        path = self._target(cmd[len('LIST '):])
+        MockMLSDFTP.listed.append(path)
+        for line in LIST_TREE[path]:
+            callback(line)
+
+    def quit(self):
+        pass
+
+
+EXPECTED_MLSD_FILES = set([
+    ('/root.txt', 10, datetime(2015, 1, 2, 3, 4, 5)),
+    ('/a/a.txt', 20, datetime(2015, 1, 2, 3, 4, 5)),
+    ('/a/a1/a1.txt', 30, datetime(2015, 1, 2, 3, 4, 5)),
+    ('/b/b.txt', 40, datetime(2015, 1, 2, 3, 4, 5)),
+])
+
+
+class TestParallelFTPScanner(unittest.TestCase):
+    def setUp(self):
+        MockMLSDFTP.failures = {}
+        MockMLSDFTP.connections = 0
+        self.ftp = scanner.FTPScanner(TEST_IP, ftp_class=MockMLSDFTP, connections=3)
+
+    def testSequentialScan(self):
+        ftp = scanner.FTPScanner(TEST_IP, ftp_class=MockMLSDFTP)
+        self.assertEqual(set(ftp.scan()), EXPECTED_MLSD_FILES)
+
+    def testFullScan(self):
+        self.assertEqual(set(self.ftp.scan()), EXPECTED_MLSD_FILES)
+        self.assertEqual(MockMLSDFTP.connections, 3)
+
+    def testScanHandlesIgnoredPaths(self):
+        self.assertEqual(set(self.ftp.scan(['/a'])),
+                         set([('/root.txt', 10, datetime(2015, 1, 2, 3, 4, 5)),
+                              ('/b/b.txt', 40, datetime(2015, 1, 2, 3, 4, 5))]))
+
+    def testTooDeep(self):
+        self.assertRaises(scanner.TooDeepError, self.ftp.scan, max_depth=1)
+
+    def testReconnectsOnError(self):
+        MockMLSDFTP.failures = {'/a': 1}
+        # The failing directory is listed again on the new connection, like
+        # in the sequential scan
+        self.assertEqual(set(self.ftp.scan()), EXPECTED_MLSD_FILES)
+        self.assertEqual(MockMLSDFTP.connections, 4)
+
+    def testSkipsAfterRetry(self):
+        MockMLSDFTP.failures = {'/a': 2}
+        # Only retried once
+        self.assertEqual(set(self.ftp.scan()),
+                         set([('/root.txt', 10, datetime(2015, 1, 2, 3, 4, 5)),
+                              ('/b/b.txt', 40, datetime(2015, 1, 2, 3, 4, 5))]))
+        self.assertEqual(MockMLSDFTP.connections, 5)
+
+
+class MemoryCheckpoint(object):
+    def __init__(self):
+        self.directories = None
+        self.appends = 0
+
+    def load(self):
+        return self.directories
+
+    def append(self, directories):
+        self.directories = (self.directories or []) + list(directories)
+        self.appends += 1
+
+    def clear(self):
+        self.directories = None
+
+
+class TestResumableScan(unittest.TestCase):
+    def setUp(self):
+        MockMLSDFTP.failures = {'/a': 1}
+        MockMLSDFTP.offline_after_failure = True
+        MockMLSDFTP.offline = False
+        self.checkpoint = MemoryCheckpoint()
+
+    def tearDown(self):
+        MockMLSDFTP.offline_after_failure = False
+        MockMLSDFTP.offline = False
+
+    def scanner(self, connections):
+        return scanner.FTPScanner(TEST_IP, ftp_class=MockMLSDFTP, connections=connections,
+                                  checkpoint=self.checkpoint, checkpoint_interval=3600)
+
+    def testResume(self):
+        for connections in (1, 3):
+            self.setUp()
+            found = []
+            try:
+                for files in self.scanner(connections).iter_scan():
+                    found.extend(files)
+                self.fail('The server went offline')
+            except ftplib.all_errors:
+                pass
+            listed = [path for path, _, _ in self.checkpoint.directories]
+            self.assertIn('/', listed)
+            self.assertNotIn('/a', listed)
+            self.assertEqual(set(found), set(tuple(f) for f in found))
+
+            MockMLSDFTP.offline = False
+            self.assertEqual(set(self.scanner(connections).scan()), EXPECTED_MLSD_FILES)
+            self.assertEqual(self.checkpoint.directories, None)
+
+    def testAppendOnly(self):
+        # Each checkpoint only adds the directories listed since the last one
+        MockMLSDFTP.failures = {'/b': 1}
+        found = []
+        ftp = self.scanner(1)
+        ftp.checkpoint_interval = 0
+        try:
+            for files in ftp.iter_scan():
+                found.extend(files)
+            self.fail('The server went offline')
+        except ftplib.all_errors:
+            pass
+        listed = [path for path, _, _ in self.checkpoint.directories]
+        self.assertEqual(len(listed), len(set(listed)))
+        self.assertEqual(self.checkpoint.appends, len(listed))
+        self.assertNotIn('/b', listed)
+
+        MockMLSDFTP.offline = False
+        self.assertEqual(set(self.scanner(1).scan()), EXPECTED_MLSD_FILES)
+
+
+class MemoryListingCache(object):
+    def __init__(self, full_rescan_every):
+        self.listings = {}
+        self.passes = 0
+        self.full_rescan_every = full_rescan_every
+
+    def begin_pass(self):
+        self.passes += 1
+        return (self.passes - 1) % self.full_rescan_every == 0
+
+    def get(self, path):
+        return self.listings.get(path)
+
+    def put(self, path, modify, fingerprint, entries):
+        self.listings[path] = (modify, fingerprint, entries)
+
+    def end_pass(self, visited):
+        for path in list(self.listings):
+            if path not in visited:
+                del self.listings[path]
+
+
+class TestListingCache(unittest.TestCase):
+    def setUp(self):
+        MockMLSDFTP.failures = {}
+        MockMLSDFTP.listed = []
+        self.tree = dict((path, [(name, dict(facts)) for name, facts in entries])
+                         for path, entries in MLSD_TREE.items())
+        self.cache = MemoryListingCache(3)
+
+    def tearDown(self):
+        MLSD_TREE.clear()
+        MLSD_TREE.update(self.tree)
+
+    def scan(self, connections=1):
+        MockMLSDFTP.listed = []
+        ftp = scanner.FTPScanner(TEST_IP, ftp_class=MockMLSDFTP, connections=connections,
+                                 listing_cache=self.cache)
+        return set(ftp.scan())
+
+    def testUnchangedSubtreesAreNotListed(self):
+        for connections in (1, 3):
+            self.setUp()
+            self.assertEqual(self.scan(connections), EXPECTED_MLSD_FILES)
+            self.assertEqual(sorted(MockMLSDFTP.listed), ['/', '/a', '/a/a1', '/b'])
+
+            self.assertEqual(self.scan(connections), EXPECTED_MLSD_FILES)
+            self.assertEqual(MockMLSDFTP.listed, ['/'])
+
+    def testChangedDirectoryIsListed(self):
+        self.scan()
+        MLSD_TREE['/b'] = [('new.txt', {'type': 'file', 'size': '50', 'modify': '20150102030405'})]
+        MLSD_TREE['/'][2][1]['modify'] = '20160101000000'
+        files = self.scan()
+        self.assertEqual(sorted(MockMLSDFTP.listed), ['/', '/b'])
+        self.assertIn(('/b/new.txt', 50, datetime(2015, 1, 2, 3, 4, 5)), files)
+        self.assertNotIn(('/b/b.txt', 40, datetime(2015, 1, 2, 3, 4, 5)), files)
+
+        # served from the cache with the new listing
+        self.assertEqual(self.scan(), files)
+        self.assertEqual(MockMLSDFTP.listed, ['/'])
+
+    def testFullRescan(self):
+        self.scan()
+        self.scan()
+        self.scan()
+        self.assertEqual(MockMLSDFTP.listed, ['/'])
+        # every 3 scans, everything is listed again
+        self.scan()
+        self.assertEqual(sorted(MockMLSDFTP.listed), ['/', '/a', '/a/a1', '/b'])
+
+    def testRemovedDirectoriesAreForgotten(self):
+        self.scan()
+        del MLSD_TREE['/'][1]
+        MLSD_TREE['/'][0][1]['modify'] = '20160101000000'
+        self.scan()
+        self.assertEqual(sorted(self.cache.listings), ['/', '/b'])
+
+
+STAT_SECTIONS = [
+    '''drwxr-xr-x   2 ftp      ftp          4096 Mar 15 01:07 a
+ drwxr-xr-x   2 ftp      ftp          4096 Mar 15 01:07 b
+ -rw-r--r--   1 ftp      ftp            10 Jan 02  2015 root.txt''',
+    '''/a:
+ drwxr-xr-x   2 ftp      ftp          4096 Mar 15 01:07 a1
+ -rw-r--r--   1 ftp      ftp            20 Jan 02  2015 a.txt''',
+    '''/a/a1:
+ total 1
+ -rw-r--r--   1 ftp      ftp            30 Jan 02  2015 a1 with spaces.txt''',
+    '''/b:
+ -rw-r--r--   1 ftp      ftp            40 Jan 02  2015 b.txt''',
+]
+
+
+def list_tree(sections):
+    """Returns the {path => LIST lines} mapping of a recursive listing."""
+    tree = {}
+    for section in sections:
+        lines = [line.strip() for line in section.splitlines()]
+        path = lines.pop(0)[:-1] if lines[0].endswith(':') else '/'
+        tree[path] = [line for line in lines if not line.startswith('total ')]
+    return tree
+
+
+LIST_TREE = list_tree(STAT_SECTIONS)
+
+
+def stat_output(sections):
+    return '213-Status of /:\n ' + '\n \n '.join(sections) + '\n213 End of status'
+
+
+EXPECTED_STAT_FILES = set([
+    ('/root.txt', 10, datetime(2015, 1, 2)),
+    ('/a/a.txt', 20, datetime(2015, 1, 2)),
+    ('/a/a1/a1 with spaces.txt', 30, datetime(2015, 1, 2)),
+    ('/b/b.txt', 40, datetime(2015, 1, 2)),
+])
+
+
+class TestRecursiveListing(unittest.TestCase):
+    def setUp(self):
+        MockMLSDFTP.failures = {}
+        MockMLSDFTP.listed = []
+        MockMLSDFTP.stat_output = stat_output(STAT_SECTIONS)
+
+    def tearDown(self):
+        MockMLSDFTP.stat_output = None
+
+    def scan(self, connections=1, **kwargs):
+        ftp = scanner.FTPScanner(TEST_IP, ftp_class=MockMLSDFTP, connections=connections,
+                                 recursive=True)
+        return set(ftp.scan(**kwargs))
+
+    def testSingleRoundTrip(self):
+        for connections in (1, 3):
+            MockMLSDFTP.listed = []
+            self.assertEqual(self.scan(connections), EXPECTED_STAT_FILES)
+            self.assertEqual(MockMLSDFTP.listed, [])
+
+    def testMissingSectionsAreWalked(self):
+        MockMLSDFTP.stat_output = stat_output(STAT_SECTIONS[:2])
+        files = self.scan()
+        self.assertEqual(sorted(MockMLSDFTP.listed), ['/a/a1', '/b'])
+        self.assertIn(('/a/a.txt', 20, datetime(2015, 1, 2)), files)
+        self.assertIn(('/b/b.txt', 40, datetime(2015, 1, 2, 3, 4, 5)), files)
+
+    def testUnsupported(self):
+        MockMLSDFTP.stat_output = None
+        self.assertEqual(self.scan(), EXPECTED_MLSD_FILES)
+        self.assertEqual(sorted(MockMLSDFTP.listed), ['/', '/a', '/a/a1', '/b'])
+
+    def testIgnores(self):
+        self.assertEqual(self.scan(ignores=['/a']),
+                         set([('/root.txt', 10, datetime(2015, 1, 2)),
+                              ('/b/b.txt', 40, datetime(2015, 1, 2))]))
+        self.assertEqual(MockMLSDFTP.listed, [])
+
+    def testTooDeep(self):
+        self.assertRaises(scanner.TooDeepError, self.scan, max_depth=1)
+
+
+class TestCapabilities(unittest.TestCase):
+    def setUp(self):
+        MockMLSDFTP.failures = {}
+        MockMLSDFTP.listed = []
+        MockMLSDFTP.commands = []
+
+    def tearDown(self):
+        MockMLSDFTP.features = FEAT_RESPONSE
+        MockMLSDFTP.mlsd_supported = True
+
+    def testParseFeat(self):
+        capabilities = scanner.FTPCapabilities()
+        capabilities.parse_feat(FEAT_RESPONSE)
+        self.assertTrue(capabilities.probed)
+        self.assertEqual(capabilities.to_dict(),
+                         {'utf8': True, 'mlsd': True, 'rest': True, 'path_listing': None,
+                          'list_recursive': None, 'stat_recursive': None})
+
+        capabilities = scanner.FTPCapabilities()
+        capabilities.parse_feat('211 No features')
+        self.assertEqual((capabilities.utf8, capabilities.mlsd, capabilities.rest),
+                         (False, False, False))
+
+    def testNoUTF8(self):
+        MockMLSDFTP.features = None
+        ftp = scanner.FTPScanner(TEST_IP, ftp_class=MockMLSDFTP)
+        ftp.connect()
+        self.assertEqual(MockMLSDFTP.commands, ['FEAT'])
+        self.assertFalse(ftp.capabilities.utf8)
+        # MLSD is newer than FEAT
+        self.assertFalse(ftp.capabilities.mlsd)
+
+    def testProbedOnce(self):
+        ftp = scanner.FTPScanner(TEST_IP, ftp_class=MockMLSDFTP, connections=3)
+        self.assertEqual(set(ftp.scan()), EXPECTED_MLSD_FILES)
+        self.assertEqual(MockMLSDFTP.commands.count('FEAT'), 1)
+        self.assertIn('OPTS UTF8 ON', MockMLSDFTP.commands)
+
+    def testListOnlyServer(self):
+        MockMLSDFTP.features = '211 No features'
+        MockMLSDFTP.mlsd_supported = False
+        ftp = scanner.FTPScanner(TEST_IP, ftp_class=MockMLSDFTP)
+        self.assertEqual(set(ftp.scan()), EXPECTED_STAT_FILES)
+        self.assertNotIn('MLSD', MockMLSDFTP.commands)
+        self.assertNotIn('OPTS UTF8 ON', MockMLSDFTP.commands)
+
+    def testMLSDTriedOnce(self):
+        # MLST is not announced, MLSD is tried only in the first directory
+        MockMLSDFTP.features = '211-Features:\n UTF8\n211 End'
+        MockMLSDFTP.mlsd_supported = False
+        ftp = scanner.FTPScanner(TEST_IP, ftp_class=MockMLSDFTP)
+        self.assertEqual(set(ftp.scan()), EXPECTED_STAT_FILES)
+        self.assertEqual(MockMLSDFTP.commands.count('MLSD'), 1)
+        self.assertEqual(sorted(MockMLSDFTP.listed), ['/', '/a', '/a/a1', '/b'])
+
+    def testKnownCapabilities(self):
+        known = scanner.FTPCapabilities.from_dict({'utf8': True, 'mlsd': False})
+        MockMLSDFTP.mlsd_supported = False
+        ftp = scanner.FTPScanner(TEST_IP, ftp_class=MockMLSDFTP, capabilities=known)
+        self.assertEqual(set(ftp.scan()), EXPECTED_STAT_FILES)
+        self.assertNotIn('FEAT', MockMLSDFTP.commands)
+        self.assertNotIn('MLSD', MockMLSDFTP.commands)
+
+    def testRecursiveListingRemembered(self):
+        MockMLSDFTP.stat_output = stat_output(STAT_SECTIONS)
+        try:
+            capabilities = scanner.FTPCapabilities()
+            for i in range(2):
+                MockMLSDFTP.commands = []
+                ftp = scanner.FTPScanner(TEST_IP, ftp_class=MockMLSDFTP, recursive=True,
+                                         capabilities=capabilities)
+                self.assertEqual(set(ftp.scan()), EXPECTED_STAT_FILES)
+            self.assertFalse(capabilities.list_recursive)
+            self.assertTrue(capabilities.stat_recursive)
+            self.assertNotIn('FEAT', MockMLSDFTP.commands)
+        finally:
+            MockMLSDFTP.stat_output = None
+
+
+class TestPathListing(unittest.TestCase):
+    def setUp(self):
+        MockMLSDFTP.failures = {}
+        MockMLSDFTP.listed = []
+        MockMLSDFTP.commands = []
+
+    def tearDown(self):
+        MockMLSDFTP.path_listing = True
+        MockMLSDFTP.mlsd_supported = True
+
+    def scan(self):
+        ftp = scanner.FTPScanner(TEST_IP, ftp_class=MockMLSDFTP)
+        files = set(ftp.scan())
+        return ftp, files
+
+    def testNoCWD(self):
+        ftp, files = self.scan()
+        self.assertEqual(files, EXPECTED_MLSD_FILES)
+        self.assertNotIn('CWD', MockMLSDFTP.commands)
+        self.assertTrue(ftp.capabilities.path_listing)
+        self.assertEqual(ftp.stats.directories, 4)
+
+    def testFallbackToCWD(self):
+        MockMLSDFTP.path_listing = False
+        ftp, files = self.scan()
+        self.assertEqual(files, EXPECTED_MLSD_FILES)
+        self.assertFalse(ftp.capabilities.path_listing)
+        # the path is only tried in the first directory
+        self.assertEqual(MockMLSDFTP.commands.count('MLSD'), 5)
+        self.assertEqual(MockMLSDFTP.commands.count('CWD'), 4)
+
+    def testLegacyList(self):
+        MockMLSDFTP.mlsd_supported = False
+        ftp, files = self.scan()
+        self.assertEqual(files, EXPECTED_STAT_FILES)
+        self.assertNotIn('CWD', MockMLSDFTP.commands)
+
+    def testFewerCommands(self):
+        with_path, _ = self.scan()
+        MockMLSDFTP.path_listing = False
+        with_cwd, _ = self.scan()
+        self.assertEqual(with_path.stats.directories, with_cwd.stats.directories)
+        self.assertLess(with_path.stats.commands_per_directory(),
+                        with_cwd.stats.commands_per_directory())
+
+
+class TestParseListLine(unittest.TestCase):
+    def assertEntry(self, line, name, typ, size, modify):
+        entry = scanner.parse_list_line(line)
+        self.assertIsNotNone(entry, line)
+        self.assertEqual(entry[0], name)
+        self.assertEqual((entry[1]['type'], entry[1]['size'], entry[1]['modify']),
+                         (typ, size, modify))
+
+    def testUnix(self):
+        year = this_year()
+        self.assertEntry('-rw-r--r--   1 ftp      ftp            10 Jan 02  2015 root.txt',
+                         'root.txt', 'file', '10', '20150102000000')
+        self.assertEntry('-rw-r--r--   1 ftp      ftp            10 Nov  2 19:50 a b  c.txt',
+                         'a b  c.txt', 'file', '10', '%d1102195000' % year)
+        self.assertEntry('drwxr-xr-x   2 ftp      ftp          4096 Mar 15 01:07 music',
+                         'music', 'dir', '4096', '%d0315010700' % year)
+        self.assertEntry('drwxr-xr-x+  2 1000 1000 4096 Mar 15  2015 .',
+                         '.', 'cdir', '4096', '20150315000000')
+        self.assertEntry('lrwxrwxrwx   1 ftp      ftp            12 Jan 02  2015 link -> target dir',
+                         'link', 'file', '12', '20150102000000')
+
+    def testUnixWithoutGroup(self):
+        self.assertEntry('-rw-r--r--   1 owner      123456 Sep 20  2015 no group.mkv',
+                         'no group.mkv', 'file', '123456', '20150920000000')
+
+    def testDOS(self):
+        self.assertEntry('09-20-15  05:25PM       <DIR>          Some Dir',
+                         'Some Dir', 'dir', '0', '20150920172500')
+        self.assertEntry('09-20-15  12:05AM              1,024 file.txt',
+                         'file.txt', 'file', '1024', '20150920000500')
+        self.assertEntry('09-20-2015  17:25             123456 a  b.avi',
+                         'a  b.avi', 'file', '123456', '20150920172500')
+        self.assertEntry('2015-09-20  17:25             123456 iso.avi',
+                         'iso.avi', 'file', '123456', '20150920172500')
+
+    def testGarbage(self):
+        for line in ('total 12', '', '/a:', 'crw-rw-rw- 1 root root 1, 3 Jan 02 2015 null',
+                     '-rw-r--r-- 1 ftp ftp 10 Foo 02 2015 bad month'):
+            self.assertIsNone(scanner.parse_list_line(line), line)
+
+
+class TestIterScan(unittest.TestCase):
+    def setUp(self):
+        MockMLSDFTP.failures = {}
+
+    def testYieldsEachDirectory(self):
+        for connections in (1, 3):
+            ftp = scanner.FTPScanner(TEST_IP, ftp_class=MockMLSDFTP, connections=connections)
+            batches = list(ftp.iter_scan())
+            self.assertEqual(len(batches), 4)
+            for batch in batches:
+                # every batch holds the files of a single directory
+                self.assertEqual(len(set(path.rsplit('/', 1)[0] for path, _, _ in batch)), 1)
+            self.assertEqual(set(f for batch in batches for f in batch), EXPECTED_MLSD_FILES)
+
+    def testStopEarly(self):
+        ftp = scanner.FTPScanner(TEST_IP, ftp_class=MockMLSDFTP, connections=3)
+        batches = ftp.iter_scan()
+        self.assertEqual(len(next(batches)), 1)
+        batches.close()
+        for thread in threading.enumerate():
+            if thread.name.startswith('scanner-'):
+                thread.join(1)
+                self.assertFalse(thread.is_alive())
+
+
 if __name__ == '__main__':
     logging.basicConfig(level=100)
     unittest.main()
@@ -0,0 +1,455 @@
+# -*- coding: utf-8 -*-
+"""Indexes whose documents are split between several whoosh indexes.
+
+The shards are stored in sub-directories of the index directory, next to
+the manifest which stays shared. Each shard has its own writer and lock,
+so that updating one shard does not block the others.
+
+The layout of an index is found from its directory, see index_layout :
+
+- 'single' : one whoosh index, see Index
+- 'server' : one shard per FTP server, see ServerShardedIndex
+- 'hash'   : a fixed number of partitions, see HashShardedIndex
+"""
+
+import heapq
+import itertools
+import logging
+import math
+import os
+import os.path
+import shutil
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from whoosh import index as whoosh_index
+from whoosh.index import EmptyIndexError
+from whoosh.query import Or, Term
+from whoosh.reading import MultiReader
+from whoosh.searching import Searcher
+from whoosh.sorting import FieldFacet
+
+from .index import CancellableAsyncWriter, Index
+from .manifest import Manifest
+
+
+class ShardedIndex(Index):
+    """An Index split between several whoosh indexes, the shards.
+
+    Subclasses choose the shard of each document with shard_of.
+    """
+
+    # Name of the layout, and of the sub-directory holding the shards
+    LAYOUT = None
+    SHARDS_DIR = None
+
+    def __init__(self, directory, persist, journal=None):
+        self.log = logging.getLogger('ftpvista.index')
+
+        self._persist = persist
+        self._shards_dir = os.path.join(directory, self.SHARDS_DIR)
+        if not os.path.isdir(self._shards_dir):
+            self.log.info('Creating the %s sharded index in %s' % (self.LAYOUT, directory))
+            os.makedirs(self._shards_dir)
+        else:
+            self.log.info('Opening the %s sharded index in %s' % (self.LAYOUT, directory))
+        self._shard_indexes = {}
+        # Writers of the shards being updated, and their changes, applied
+        # to the manifest once commited : shard => (deleted, added)
+        self._writers = {}
+        self._pending = {}
+
+        self._manifest = Manifest(directory)
+        generations = dict((shard, self._whoosh_index(shard).latest_generation())
+                           for shard in self.shards())
+        if self._manifest.generations() != generations:
+            self.log.warning('The manifest does not match the shards, rebuilding it')
+            self.rebuild_manifest()
+
+        self._merge_lock = threading.Lock()
+        self.write_count = 0
+        self._load_last_optimization()
+        self._open_journal(journal)
+
+    def shard_of(self, server_id, path):
+        """Returns the name of the shard of a document."""
+        raise NotImplementedError()
+
+    def shards(self):
+        return sorted(name for name in os.listdir(self._shards_dir)
+                      if whoosh_index.exists_in(os.path.join(self._shards_dir, name)))
+
+    def _whoosh_index(self, shard, create=False):
+        path = os.path.join(self._shards_dir, shard)
+        idx = self._shard_indexes.get(shard)
+        # The shard may have been dropped by another process
+        if idx is None or not whoosh_index.exists_in(path):
+            if whoosh_index.exists_in(path):
+                idx = whoosh_index.open_dir(path)
+            elif create:
+                if not os.path.isdir(path):
+                    os.mkdir(path)
+                idx = whoosh_index.create_in(path, schema=self.get_schema())
+            else:
+                raise EmptyIndexError('No shard %s in %s' % (shard, self._shards_dir))
+            self._shard_indexes[shard] = idx
+        return idx
+
+    def _shard_writer(self, shard):
+        writer = self._writers.get(shard)
+        if writer is None:
+            # Wait for a running merge, see Index.open_writer
+            with self._merge_lock:
+                writer = self._writers[shard] = CancellableAsyncWriter(self._whoosh_index(shard, create=True))
+            self._pending[shard] = ([], [])
+        return writer
+
+    def rebuild_manifest(self):
+        def files():
+            for shard in self.shards():
+                with self._whoosh_index(shard).reader() as reader:
+                    for entry in self.manifest_entries(reader):
+                        yield entry
+
+        generations = dict((shard, self._whoosh_index(shard).latest_generation())
+                           for shard in self.shards())
+        self._manifest.rebuild(files(), generations)
+
+    def delete_all_docs(self, server):
+        for shard in self.shards():
+            self._shard_writer(shard).delete_by_term('server_id', str(server.get_server_id()))
+        self.commit()
+        self._manifest.apply([], [], None, deleted_servers=[server.get_server_id()])
+        self.log.info('All documents of server %s deleted' % server.get_ip_addr())
+
+    def _delete_files(self, server_id, paths):
+        by_shard = {}
+        for path in paths:
+            by_shard.setdefault(self.shard_of(server_id, path), []).append(path)
+        for shard, shard_paths in by_shard.items():
+            writer = self._shard_writer(shard)
+            for i in range(0, len(shard_paths), self.DELETE_BATCH):
+                writer.delete_by_query(Or([Term('path_key', self.path_key(server_id, path))
+                                           for path in shard_paths[i:i+self.DELETE_BATCH]]))
+            self._pending[shard][0].extend((server_id, path) for path in shard_paths)
+        self.write_count += len(paths)
+
+    def _add_document(self, fields):
+        shard = self.shard_of(fields['server_id'], fields['path'])
+        self._shard_writer(shard).add_document(**fields)
+        self._pending[shard][1].append(self._manifest_entry(fields))
+        self.write_count += 1
+
+    def commit(self, optimize=False, merge=True):
+        """Commit the changes of every shard written since the last commit,
+        see Index.commit."""
+        self.log.info(' -- Begin of Commit -- ')
+        for shard, writer in sorted(self._writers.items()):
+            idx = self._whoosh_index(shard)
+            generation = idx.latest_generation()
+            # Not cancelled by a rollback once commited
+            del self._writers[shard]
+            deleted, added = self._pending.pop(shard)
+            writer.commit(optimize=optimize, merge=merge)
+            self._wait_commit(idx, writer, generation)
+            self._manifest.apply(deleted, added, idx.latest_generation(), shard=shard)
+        if self._journal is not None:
+            self._journal.truncate()
+        if optimize:
+            self._optimized(datetime.now())
+        self.log.info(' -- End of Commit -- ')
+
+    def rollback(self):
+        for writer in self._writers.values():
+            writer.cancel()
+        self._writers = {}
+        self._pending = {}
+        if self._journal is not None:
+            self._journal.truncate()
+
+    def close(self):
+        self.log.info(' -- Closing the shards -- ')
+        for idx in self._shard_indexes.values():
+            idx.close()
+        self._manifest.close()
+        if self._journal is not None:
+            self._journal.close()
+
+
+class ServerShardedIndex(ShardedIndex):
+    """An Index with one shard per FTP server.
+
+    Dropping a server removes the directory of its shard, and the update
+    of a server only locks its own shard.
+    """
+
+    LAYOUT = 'server'
+    SHARDS_DIR = 'servers'
+
+    def shard_of(self, server_id, path):
+        return str(server_id)
+
+    def delete_all_docs(self, server):
+        shard = str(server.get_server_id())
+        if shard in self._writers:
+            self._writers.pop(shard).cancel()
+            self._pending.pop(shard)
+
+        path = os.path.join(self._shards_dir, shard)
+        if whoosh_index.exists_in(path):
+            # Wait for an update of the server by another process
+            self._whoosh_index(shard).writer(timeout=self.LOCK_TIMEOUT).cancel()
+            self._shard_indexes.pop(shard).close()
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        self._manifest.apply([], [], None, deleted_servers=[server.get_server_id()], shard=shard)
+        self.log.info('Shard of server %s dropped' % server.get_ip_addr())
+
+
+class HashShardedIndex(ShardedIndex):
+    """An Index split in a fixed number of partitions, the documents being
+    spread by a hash of their key.
+
+    The partitions are searched concurrently, see FanOutSearcher.
+    """
+
+    LAYOUT = 'hash'
+    SHARDS_DIR = 'partitions'
+
+    def __init__(self, directory, persist, partitions=8, journal=None):
+        # The partitions must exist before the journal is replayed
+        ShardedIndex.__init__(self, directory, persist)
+        existing = self.shards()
+        if len(existing) == 0:
+            for i in range(partitions):
+                shard = self.partition_name(i)
+                generation = self._whoosh_index(shard, create=True).latest_generation()
+                self._manifest.apply([], [], generation, shard=shard)
+        elif len(existing) != partitions:
+            # The documents would need to be spread again
+            self.log.warning('The index has %d partitions, not %d' % (len(existing), partitions))
+        self._partitions = max(1, len(existing) or partitions)
+        self._open_journal(journal)
+
+    @staticmethod
+    def partition_name(i):
+        return '%03d' % i
+
+    def shard_of(self, server_id, path):
+        # crc32 rather than hash(), which changes with each process
+        key = self.path_key(server_id, path).encode('utf-8', 'surrogatepass')
+        return self.partition_name(zlib.crc32(key) % self._partitions)
+
+
+class FanOutPage(object):
+    """A page of the hits of a FanOutSearcher, behaves like the
+    ResultsPage of whoosh."""
+
+    def __init__(self, hits, total, pagenum, pagelen):
+        """
+        hits   -- the first hits of the query, up to the end of the page
+        total  -- the number of documents matching the query
+        """
+        self.total = total
+        self.pagecount = int(math.ceil(total / pagelen))
+        self.pagenum = min(self.pagecount, pagenum)
+        self.offset = max(0, (self.pagenum - 1) * pagelen)
+        self.hits = hits[self.offset:self.offset + pagelen]
+        self.pagelen = len(self.hits)
+
+    def __len__(self):
+        return self.total
+
+    def __iter__(self):
+        return iter(self.hits)
+
+    def is_last_page(self):
+        return self.pagecount == 0 or self.pagenum == self.pagecount
+
+
+class FanOutSearcher(object):
+    """Search the partitions of an index concurrently, and merge their
+    best hits with a heap.
+
+    Only what the search site needs of a whoosh Searcher is provided :
+    schema, search_page and close. The hits are scored with the statistics
+    of their partition, close to those of the whole index as the documents
+    are spread evenly.
+    """
+
+    def __init__(self, searchers, executor):
+        self.searchers = searchers
+        self.schema = searchers[0].schema
+        self._executor = executor
+
+    @staticmethod
+    def _merge_key(sortedby):
+        if sortedby is None:
+            return lambda hit: hit.score, True
+        if not isinstance(sortedby, FieldFacet):
+            raise ValueError('Only FieldFacet can sort the hits of partitions, not %r' % sortedby)
+        name = sortedby.fieldname
+        if sortedby.reverse:
+            # The documents without a value come last
+            return lambda hit: (hit.get(name) is not None, hit.get(name)), True
+        return lambda hit: (hit.get(name) is None, hit.get(name)), False
+
+    def top_hits(self, query, limit=10, sortedby=None):
+        """Returns the `limit` best hits of the query, and the number of
+        documents matching it."""
+        results = list(self._executor.map(
+            lambda searcher: searcher.search(query, limit=limit, sortedby=sortedby),
+            self.searchers))
+        key, reverse = self._merge_key(sortedby)
+        hits = itertools.chain.from_iterable(results)
+        if reverse:
+            top = heapq.nlargest(limit, hits, key=key)
+        else:
+            top = heapq.nsmallest(limit, hits, key=key)
+        return top, sum(len(r) for r in results)
+
+    def search_page(self, query, pagenum, pagelen=10, sortedby=None):
+        if pagenum < 1:
+            raise ValueError('pagenum must be >= 1')
+        hits, total = self.top_hits(query, pagenum * pagelen, sortedby)
+        return FanOutPage(hits, total, pagenum, pagelen)
+
+    def close(self):
+        for searcher in self.searchers:
+            searcher.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+LAYOUTS = {
+    'single': Index,
+    ServerShardedIndex.LAYOUT: ServerShardedIndex,
+    HashShardedIndex.LAYOUT: HashShardedIndex,
+}
+
+# Shared by the FanOutSearchers of the process
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def search_executor():
+    """Returns the thread pool searching the partitions."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 4)
+        return _executor
+
+
+def index_layout(directory):
+    """Returns the layout of the index in `directory`, None if there is no
+    index yet."""
+    if whoosh_index.exists_in(directory):
+        return 'single'
+    for layout, index_class in LAYOUTS.items():
+        if issubclass(index_class, ShardedIndex) and \
+                os.path.isdir(os.path.join(directory, index_class.SHARDS_DIR)):
+            return layout
+    return None
+
+
+def _new_index(directory, persist, layout, partitions, journal=None):
+    if layout == HashShardedIndex.LAYOUT:
+        return HashShardedIndex(directory, persist, partitions, journal)
+    return LAYOUTS[layout](directory, persist, journal)
+
+
+def open_index(directory, persist, layout='single', partitions=8, journal=None):
+    """Open, or create, the index in `directory` with the given layout.
+
+    partitions -- number of partitions of a new 'hash' index
+    journal    -- see Index
+    """
+    if layout not in LAYOUTS:
+        raise ValueError('Unknown index layout %r' % layout)
+    found = index_layout(directory)
+    if found is not None and found != layout:
+        raise ValueError('The index in %s has the %r layout, not %r, it needs to be migrated first'
+                         % (directory, found, layout))
+    return _new_index(directory, persist, layout, partitions, journal)
+
+
+def open_searcher(directory, executor=None):
+    """Returns a searcher over the index in `directory`, whatever its
+    layout.
+
+    The partitions of a 'hash' index are searched concurrently on
+    `executor`, the pool of search_executor by default. The shards of a
+    'server' index are merged in a whoosh Searcher, which scores them with
+    the statistics of the whole index.
+    """
+    layout = index_layout(directory)
+    if layout in (None, 'single'):
+        return whoosh_index.open_dir(directory).searcher()
+
+    shards_dir = os.path.join(directory, LAYOUTS[layout].SHARDS_DIR)
+    indexes = [whoosh_index.open_dir(os.path.join(shards_dir, name))
+               for name in sorted(os.listdir(shards_dir))
+               if whoosh_index.exists_in(os.path.join(shards_dir, name))]
+    if len(indexes) == 0:
+        raise EmptyIndexError('No shard in %s' % shards_dir)
+    if layout == HashShardedIndex.LAYOUT:
+        return FanOutSearcher([idx.searcher() for idx in indexes], executor or search_executor())
+
+    readers = []
+    for idx in indexes:
+        readers.extend(leaf for leaf, _ in idx.reader().leaf_readers())
+    return Searcher(MultiReader(readers))
+
+
+def migrate_index(directory, persist, layout, partitions=8):
+    """Move the documents of a single index to a sharded layout, in place.
+
+    partitions -- number of partitions of a 'hash' index
+
+    Returns the number of documents moved.
+    """
+    log = logging.getLogger('ftpvista.index')
+    index_class = LAYOUTS[layout]
+    if not issubclass(index_class, ShardedIndex):
+        raise ValueError('%r is not a sharded layout' % layout)
+    if index_layout(directory) != 'single':
+        raise ValueError('No single index to migrate in %s' % directory)
+
+    # Upgrades the schema of the documents if needed
+    single = Index(directory, persist)
+    shards_dir = os.path.join(directory, index_class.SHARDS_DIR)
+    if os.path.isdir(shards_dir):
+        # Left by an interrupted migration
+        shutil.rmtree(shards_dir)
+
+    log.info('Migrating the index in %s to the %s layout' % (directory, layout))
+    sharded = _new_index(directory, persist, layout, partitions)
+    count = 0
+    with single._idx.reader() as reader:
+        for fields in reader.all_stored_fields():
+            fields['path_key'] = Index.path_key(fields['server_id'], fields['path'])
+            sharded._add_document(dict(fields, has_id='a'))
+            count += 1
+            if count % 100000 == 0:
+                sharded.commit(merge=False)
+                log.info('%d documents moved' % count)
+    sharded.commit()
+    single.close()
+    sharded.close()
+
+    # Remove the single index, its files are all named after the 'MAIN' index
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.startswith(('MAIN_', '_MAIN_')) and os.path.isfile(path):
+            os.remove(path)
+        elif name == 'MAIN.tmp' and os.path.isdir(path):
+            shutil.rmtree(path)
+    log.info('Index migrated : %d documents' % count)
+    return count
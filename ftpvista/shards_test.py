@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from whoosh.query import Or, Term
+from whoosh.sorting import FieldFacet
+
+from . import index
+from . import shards
+
+
+MTIME = datetime(2015, 1, 2, 3, 4, 5)
+
+
+class FakeServer(object):
+    def __init__(self, server_id):
+        self.server_id = server_id
+
+    def get_server_id(self):
+        return self.server_id
+
+    def get_ip_addr(self):
+        return '10.0.0.%d' % self.server_id
+
+
+class TestServerShardedIndex(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'index')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def add(self, idx, server_id, path):
+        idx.add_document(str(server_id), os.path.basename(path), path, 10, MTIME)
+
+    def fill(self, idx):
+        for path in ('/a.txt', '/music/a b.txt'):
+            self.add(idx, 1, path)
+        self.add(idx, 2, '/a.txt')
+        self.add(idx, 3, '/c.txt')
+        idx.commit()
+
+    def search(self, query=None):
+        with shards.open_searcher(self.path) as searcher:
+            query = query or Term('has_id', 'a')
+            return sorted((hit['server_id'], hit['path']) for hit in searcher.search(query, limit=None))
+
+    def testShards(self):
+        idx = shards.open_index(self.path, None, 'server')
+        self.fill(idx)
+        self.assertEqual(idx.shards(), ['1', '2', '3'])
+        self.assertEqual(shards.index_layout(self.path), 'server')
+        self.assertEqual(sorted(idx.get_indexed_files(1)), ['/a.txt', '/music/a b.txt'])
+
+        # One writer per shard
+        self.add(idx, 2, '/new.txt')
+        idx.delete_file(1, '/a.txt')
+        self.assertEqual(sorted(idx._writers), ['1', '2'])
+        idx.commit()
+
+        self.assertEqual(self.search(), [('1', '/music/a b.txt'), ('2', '/a.txt'), ('2', '/new.txt'),
+                                         ('3', '/c.txt')])
+        self.assertEqual(self.search(Term('path', 'music')), [('1', '/music/a b.txt')])
+        with shards.open_searcher(self.path) as searcher:
+            page = searcher.search_page(Term('has_id', 'a'), 2, pagelen=3)
+            self.assertEqual(len(list(page)), 1)
+            self.assertTrue(page.is_last_page())
+        idx.close()
+
+        # The manifest matches the shards when opened again
+        idx = shards.open_index(self.path, None, 'server')
+        self.assertEqual(sorted(idx.get_indexed_files(2)), ['/a.txt', '/new.txt'])
+        idx.close()
+
+    def testDropServer(self):
+        idx = shards.open_index(self.path, None, 'server')
+        self.fill(idx)
+        idx.delete_all_docs(FakeServer(1))
+        self.assertEqual(idx.shards(), ['2', '3'])
+        self.assertFalse(os.path.exists(os.path.join(self.path, 'servers', '1')))
+        self.assertEqual(idx.get_indexed_files(1), {})
+        self.assertEqual(self.search(), [('2', '/a.txt'), ('3', '/c.txt')])
+
+        # Updated again later
+        self.add(idx, 1, '/d.txt')
+        idx.commit()
+        self.assertEqual(sorted(idx.get_indexed_files(1)), ['/d.txt'])
+        idx.close()
+        idx = shards.open_index(self.path, None, 'server')
+        self.assertEqual(idx._manifest.generations(),
+                         dict((shard, idx._whoosh_index(shard).latest_generation())
+                              for shard in ('1', '2', '3')))
+        idx.close()
+
+    def testMerge(self):
+        idx = shards.open_index(self.path, None, 'server')
+        for i in range(3):
+            self.add(idx, 1, '/%d.txt' % i)
+            idx.commit(merge=False)
+        self.add(idx, 2, '/a.txt')
+        idx.commit(merge=False)
+        self.assertTrue(idx.optimize())
+        self.assertEqual(idx.segment_sizes('1'), [3])
+        self.assertEqual(idx.segment_sizes('2'), [1])
+        self.assertEqual(len(self.search()), 4)
+        idx.close()
+
+    def testMigration(self):
+        idx = index.Index(self.path, None)
+        self.fill(idx)
+        idx.close()
+
+        self.assertRaises(ValueError, shards.open_index, self.path, None, 'server')
+        self.assertEqual(shards.migrate_index(self.path, None, 'server'), 4)
+        self.assertEqual(shards.index_layout(self.path), 'server')
+        self.assertFalse([name for name in os.listdir(self.path) if 'MAIN' in name])
+
+        idx = shards.open_index(self.path, None, 'server')
+        self.assertEqual(idx.shards(), ['1', '2', '3'])
+        self.assertEqual(sorted(idx.get_indexed_files(1)), ['/a.txt', '/music/a b.txt'])
+        self.assertEqual(list(idx._manifest.generations()), ['1', '2', '3'])
+        self.assertEqual(self.search(), [('1', '/a.txt'), ('1', '/music/a b.txt'), ('2', '/a.txt'),
+                                         ('3', '/c.txt')])
+        # The exact keys were moved too
+        idx.delete_file(1, '/a.txt')
+        idx.commit()
+        self.assertEqual(self.search(Term('server_id', '1')), [('1', '/music/a b.txt')])
+        idx.close()
+
+
+
+class TestHashShardedIndex(unittest.TestCase):
+    PATHS = ['/music/artist %d/track %d.mp3' % (i % 7, i) for i in range(40)] + \
+        ['/videos/movie %d.avi' % i for i in range(20)]
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.single = index.Index(os.path.join(self.dir, 'single'), None)
+        self.hashed = shards.open_index(os.path.join(self.dir, 'hash'), None, 'hash', 4)
+        for i, path in enumerate(self.PATHS):
+            for idx in (self.single, self.hashed):
+                mtime = datetime(2015, 1, 1) + timedelta(days=i * 7 % 60)
+                idx.add_document(str(1 + i % 2), os.path.basename(path), path, i, mtime)
+        self.single.commit()
+        self.hashed.commit()
+
+    def tearDown(self):
+        self.single.close()
+        self.hashed.close()
+        shutil.rmtree(self.dir)
+
+    def searchers(self):
+        return (shards.open_searcher(os.path.join(self.dir, 'single')),
+                shards.open_searcher(os.path.join(self.dir, 'hash')))
+
+    def testPartitions(self):
+        self.assertEqual(self.hashed.shards(), ['000', '001', '002', '003'])
+        sizes = [sum(self.hashed.segment_sizes(shard)) for shard in self.hashed.shards()]
+        self.assertEqual(sum(sizes), len(self.PATHS))
+        self.assertTrue(all(size > 0 for size in sizes))
+        self.assertEqual(self.hashed.get_indexed_files(2)['/music/artist 1/track 1.mp3'],
+                         index.mtime_seconds(datetime(2015, 1, 8)))
+
+        # The partitions do not change when the index is opened again, nor
+        # the manifest
+        self.hashed.close()
+        self.hashed = shards.open_index(os.path.join(self.dir, 'hash'), None, 'hash', 8)
+        self.assertEqual(len(self.hashed.shards()), 4)
+        self.hashed.delete_files(1, self.PATHS[:10:2])
+        self.hashed.commit()
+        self.assertEqual(len(self.hashed.get_indexed_files(1)), 25)
+        self.hashed.delete_all_docs(FakeServer(2))
+        self.assertEqual(self.hashed.get_indexed_files(2), {})
+        with shards.open_searcher(os.path.join(self.dir, 'hash')) as searcher:
+            hits, total = searcher.top_hits(Term('has_id', 'a'), limit=100)
+            self.assertEqual(total, 25)
+            self.assertEqual(set(hit['server_id'] for hit in hits), set(['1']))
+
+    def testSearchPage(self):
+        single, hashed = self.searchers()
+        query = Or([Term('path', 'music'), Term('name', 'movi')])
+        for sortedby in (None, FieldFacet('mtime', reverse=True), FieldFacet('size')):
+            expected = [(hit['path'], hit.score) for hit in single.search(query, limit=None, sortedby=sortedby)]
+            found = []
+            for pagenum in range(1, 8):
+                page = hashed.search_page(query, pagenum, pagelen=9, sortedby=sortedby)
+                self.assertEqual(len(page), 60)
+                self.assertEqual(page.is_last_page(), pagenum >= 7)
+                found.extend((hit['path'], hit.score) for hit in page)
+            if sortedby is None:
+                # Scored with the statistics of each partition
+                self.assertEqual(sorted(path for path, _ in found), sorted(path for path, _ in expected))
+                self.assertEqual([score for _, score in found], sorted([score for _, score in found], reverse=True))
+            else:
+                stored = dict((fields['path'], fields) for fields in single.documents())
+                key = lambda hit: stored[hit[0]][sortedby.fieldname]
+                self.assertEqual([key(hit) for hit in found], [key(hit) for hit in expected])
+        # Past the last page
+        page = hashed.search_page(query, 10, pagelen=9)
+        self.assertEqual(page.pagenum, 7)
+        self.assertEqual(len(list(page)), 6)
+        page = hashed.search_page(Term('path', 'nothing'), 1)
+        self.assertEqual(list(page), [])
+        self.assertTrue(page.is_last_page())
+        single.close()
+        hashed.close()
+
+    def testMigration(self):
+        directory = os.path.join(self.dir, 'single')
+        self.single.close()
+        self.assertEqual(shards.migrate_index(directory, None, 'hash', 3), 60)
+        self.single = shards.open_index(directory, None, 'hash')
+        self.assertEqual(len(self.single.shards()), 3)
+        self.assertEqual(len(self.single.get_indexed_files(1)), 30)
+
+
+if __name__ == '__main__':
+    unittest.main()
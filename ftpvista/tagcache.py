@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""Cache of the audio tags fetched from the servers.
+
+The tags of a file are stored in a SQLite file, keyed by the server, the
+path, the size and the modification time of the file. A file whose mtime
+changed, or which is on another server, is most often the same song :
+when the first key misses, the tags of a file with the same name and the
+same size are used.
+
+The least recently used entries are evicted beyond `max_entries`.
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+
+class TagCacheStats(object):
+    """Hits and misses of a tag cache."""
+
+    def __init__(self):
+        self.hits = 0
+        self.name_hits = 0
+        self.misses = 0
+
+    def lookups(self):
+        return self.hits + self.name_hits + self.misses
+
+    def hit_rate(self):
+        return (self.hits + self.name_hits) / max(self.lookups(), 1)
+
+    def __str__(self):
+        return ('%d lookups, %.1f%% hits (%d by path, %d by name and size)'
+                % (self.lookups(), self.hit_rate() * 100, self.hits, self.name_hits))
+
+
+class TagCache(object):
+    COMMIT_EVERY = 500
+
+    def __init__(self, path, max_entries=1000000):
+        """
+        :Parameters:
+            -`path`: the SQLite file of the cache
+            -`max_entries`: maximum number of files in the cache, 0 for no
+                            limit
+        """
+        self.log = logging.getLogger('ftpvista.tagcache')
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._max_entries = max_entries
+        self._pending = 0
+        self.stats = TagCacheStats()
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS tags (
+                server_id INTEGER NOT NULL,
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                tags TEXT NOT NULL,
+                used REAL NOT NULL,
+                PRIMARY KEY (server_id, path)
+            );
+            CREATE INDEX IF NOT EXISTS tags_name ON tags (name, size);
+            CREATE INDEX IF NOT EXISTS tags_used ON tags (used);''')
+
+    @staticmethod
+    def _name(path):
+        return path.rpartition('/')[2]
+
+    def server(self, server_id):
+        """Returns the view of the cache for a server, see ServerTagCache."""
+        return ServerTagCache(self, server_id)
+
+    def get(self, server_id, path, size, mtime, stats=None):
+        """Returns the {tag => value} mapping of a file, None if unknown.
+
+        mtime -- seconds since the Epoch
+        stats -- a TagCacheStats counting the lookup, besides the one of
+                 the cache
+        """
+        counters = [self.stats] if stats is None else [self.stats, stats]
+        with self._lock:
+            row = self._db.execute('SELECT rowid, tags FROM tags WHERE server_id = ? AND path = ? '
+                                   'AND size = ? AND mtime = ?',
+                                   (int(server_id), path, size, mtime)).fetchone()
+            if row is not None:
+                for counter in counters:
+                    counter.hits += 1
+                self._touch(row[0])
+                return json.loads(row[1])
+
+            row = self._db.execute('SELECT tags FROM tags WHERE name = ? AND size = ? '
+                                   'ORDER BY used DESC LIMIT 1', (self._name(path), size)).fetchone()
+            if row is None:
+                for counter in counters:
+                    counter.misses += 1
+                return None
+            for counter in counters:
+                counter.name_hits += 1
+            # Found by the path the next time
+            self._put(server_id, path, size, mtime, row[0])
+            return json.loads(row[0])
+
+    def put(self, server_id, path, size, mtime, tags):
+        """Store the {tag => value} mapping of a file, which may be empty."""
+        with self._lock:
+            self._put(server_id, path, size, mtime, json.dumps(tags))
+
+    def _touch(self, rowid):
+        self._db.execute('UPDATE tags SET used = ? WHERE rowid = ?', (time.time(), rowid))
+        self._written()
+
+    def _put(self, server_id, path, size, mtime, tags):
+        self._db.execute('INSERT OR REPLACE INTO tags VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         (int(server_id), path, size, mtime, self._name(path), tags, time.time()))
+        self._written()
+
+    def _written(self):
+        self._pending += 1
+        if self._pending >= self.COMMIT_EVERY:
+            self._commit()
+
+    def _commit(self):
+        self._evict()
+        self._db.commit()
+        self._pending = 0
+
+    def _evict(self):
+        if self._max_entries <= 0:
+            return
+        count = self._db.execute('SELECT COUNT(*) FROM tags').fetchone()[0]
+        if count > self._max_entries:
+            self._db.execute('DELETE FROM tags WHERE rowid IN '
+                             '(SELECT rowid FROM tags ORDER BY used LIMIT ?)', (count - self._max_entries,))
+            self.log.info('%d files evicted from the tag cache' % (count - self._max_entries))
+
+    def count(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM tags').fetchone()[0]
+
+    def flush(self):
+        """Write the changes, and evict the least recently used files."""
+        with self._lock:
+            self._commit()
+
+    def close(self):
+        self.flush()
+        self._db.close()
+
+
+class ServerTagCache(object):
+    """The tag cache of a server, given to the stages fetching the tags.
+    Counts its own hits and misses."""
+
+    def __init__(self, cache, server_id):
+        self._cache = cache
+        self._server_id = server_id
+        self.stats = TagCacheStats()
+
+    def get(self, path, size, mtime):
+        return self._cache.get(self._server_id, path, size, mtime, self.stats)
+
+    def put(self, path, size, mtime, tags):
+        self._cache.put(self._server_id, path, size, mtime, tags)
+
+    def flush(self):
+        self._cache.flush()
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from . import tagcache
+
+
+class TestTagCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'tags.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testGet(self):
+        cache = tagcache.TagCache(self.path)
+        server = cache.server(1)
+        self.assertIsNone(server.get('/a/song.mp3', 100, 1000))
+        server.put('/a/song.mp3', 100, 1000, {'artist': 'artist', 'track': 3})
+        server.put('/a/notags.mp3', 100, 1000, {})
+        self.assertEqual(server.get('/a/song.mp3', 100, 1000), {'artist': 'artist', 'track': 3})
+        self.assertEqual(server.get('/a/notags.mp3', 100, 1000), {})
+        cache.close()
+
+        # Persistent, the same file moved or on another server
+        cache = tagcache.TagCache(self.path)
+        other = cache.server(2)
+        self.assertEqual(other.get('/b/song.mp3', 100, 2000), {'artist': 'artist', 'track': 3})
+        self.assertIsNone(other.get('/b/song.mp3', 101, 2000))
+        self.assertEqual(cache.server(1).get('/a/song.mp3', 100, 1000), {'artist': 'artist', 'track': 3})
+        self.assertEqual(other.get('/b/song.mp3', 100, 2000), {'artist': 'artist', 'track': 3})
+        self.assertEqual((other.stats.hits, other.stats.name_hits, other.stats.misses), (1, 1, 1))
+        self.assertEqual((cache.stats.hits, cache.stats.name_hits, cache.stats.misses), (2, 1, 1))
+        self.assertEqual(cache.stats.hit_rate(), 0.75)
+        cache.close()
+
+    def testEvict(self):
+        cache = tagcache.TagCache(self.path, max_entries=2)
+        server = cache.server(1)
+        server.put('/1.mp3', 1, 0, {'title': '1'})
+        server.put('/2.mp3', 2, 0, {'title': '2'})
+        server.get('/1.mp3', 1, 0)
+        server.put('/3.mp3', 3, 0, {'title': '3'})
+        cache.flush()
+        self.assertEqual(cache.count(), 2)
+        # The least recently used
+        self.assertIsNone(server.get('/2.mp3', 2, 0))
+        self.assertEqual(server.get('/1.mp3', 1, 0), {'title': '1'})
+        cache.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -496,8 +496,10 @@ class Wave(TinyTag):
             print('not a wave file!')
         channels, samplerate, bitdepth = 2, 44100, 16  # assume CD quality
         chunk_header = fh.read(8)
-        while len(chunk_header) > 0:
+        while len(chunk_header) == 8:
             subchunkid, subchunksize = struct.unpack('4sI', chunk_header)
+            # the chunks are padded to an even size
+            padding = subchunksize % 2
             if subchunkid == b'fmt ':
                 _, channels, self.samplerate = struct.unpack('HHI', fh.read(8))
                 _, _, bitdepth = struct.unpack('<IHH', fh.read(8))
@@ -505,13 +507,16 @@ class Wave(TinyTag):
             elif subchunkid == b'data':
                 self.duration = subchunksize/channels/samplerate/(bitdepth/8)
                 self.audio_offest = fh.tell() - 8  # rewind to data header
-                fh.seek(subchunksize, 1)
+                fh.seek(subchunksize + padding, 1)
             elif subchunkid == b'id3 ' or subchunkid == b'ID3 ':
+                chunk_start = fh.tell()
                 id3 = ID3(fh, 0)
                 id3._parse_id3v2(fh)
                 self.update(id3)
+                # the padding of the tag is not read
+                fh.seek(chunk_start + subchunksize + padding)
             else:  # some other chunk, just skip the data
-                fh.seek(subchunksize, 1)
+                fh.seek(subchunksize + padding, 1)
             chunk_header = fh.read(8)
         self._duration_parsed = True
 
@@ -650,7 +655,8 @@ class Wma(TinyTag):
         if fh.read(2) != b'\x01\x02':
             # http://web.archive.org/web/20131203084402/http://msdn.microsoft.com/en-us/library/bb643323.aspx#_Toc521913958
             return # not a valid asf header!
-        while True:
+        # Only the objects of the header, not the audio data after it
+        for _ in range(obj_count):
             object_id = fh.read(16)
             object_size = self._bytes_to_int_le(fh.read(8))
             if object_size == 0:
@@ -734,4 +740,4 @@ class Wma(TinyTag):
                 fh.read(blocks['type_specific_data_length'] - already_read)
                 fh.read(blocks['error_correction_data_length'])
             else:
-                fh.read(object_size - 24) # read over onknown object ids
+                fh.seek(object_size - 24, os.SEEK_CUR) # skip over unknown object ids
@@ -1,3 +1,5 @@
+from ftpvista.extensions import AUDIO_EXTENSIONS
+
 OTHERS = 0
 VIDEOS = 1
 AUDIOS = 2
@@ -17,7 +19,7 @@ SPAN_CLASS[str(DISKIMAGES)] = "icon-diskimage"
 # Extensions categories
 EXT = {}
 EXT[str(VIDEOS)] = ['avi', 'mpg', 'mkv', 'wmv', 'mp4', 'mov', '3gp', '3gp2', 'mpeg', 'mpg', 'mpg2', 'ogm']
-EXT[str(AUDIOS)] = ['mp3', 'wma', 'cda', 'ogg', 'flac', 'aac', 'aiff', 'm4a', 'wav']
+EXT[str(AUDIOS)] = AUDIO_EXTENSIONS
 EXT[str(IMAGES)] = ['jpep', 'jpg', 'gif', 'png', 'bmp', 'tiff', 'psd']
 EXT[str(DISKIMAGES)] = ['iso', 'bin', 'cue', 'img', 'mds', 'mdf', 'nrg']
 EXT[str(ARCHIVES)] = ['rar', 'tar', 'tgz', 'tz', 'yz', 'zz', 'xz', 'war', 'jar', 'ace', 'zip', '7z', 'gz', 'gzip', 'bz', 'bzip', 'bz2', 'bzip2', 'r00', 'r01', 'deb', 'rpm']
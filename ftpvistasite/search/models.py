@@ -1,18 +1,28 @@
 # -*- coding: utf-8 -*-
 import logging
 from django.conf import settings
-from whoosh import index as whoosh_index, sorting
+from whoosh import sorting
 from whoosh.qparser import *
-from whoosh.query import Or, And, Term, NullQuery
+from whoosh.fields import NUMERIC
+from whoosh.query import Or, And, AndNot, Term, NullQuery, NumericRange, DateRange
 from datetime import datetime, timedelta
 from ftpvistasite.app.filenode import *
 from ftpvista.persist import FTPVistaPersist
+from ftpvista.shards import open_searcher
 
 persist = FTPVistaPersist(settings.PERSIST_DB)
 
 
-def search(query, online=False, exts=None, pagenum=1, pagelen=100, sortbytime=False):
-    index = whoosh_index.open_dir(settings.WHOOSH_IDX)
+def search(query, online=False, exts=None, pagenum=1, pagelen=100, sortbytime=False,
+           min_size=None, max_size=None, after=None, before=None):
+    """Search the index, yields a FileNode per hit then whether this is
+    the last page.
+
+    min_size and max_size (bytes), after and before (datetimes) restrict
+    the hits to a range of sizes and modification dates, None for no limit.
+    """
+    # Single index or shards, the searcher merges the results
+    searcher = open_searcher(settings.WHOOSH_IDX)
     is_online_cache = {}
     searchfilter = None
 
@@ -37,10 +47,9 @@ def search(query, online=False, exts=None, pagenum=1, pagelen=100, sortbytime=Fa
 
         return is_online_cache[server]
 
-    searcher = index.searcher()
     parser = MultifieldParser(["name", "path", "audio_artist", "audio_title",
                                "audio_album"],
-                              schema=index.schema)
+                              schema=searcher.schema)
     parser.add_plugin(PhrasePlugin)
     parser.add_plugin(SingleQuotePlugin)
     parser.add_plugin(PrefixPlugin)
@@ -69,12 +78,31 @@ def search(query, online=False, exts=None, pagenum=1, pagelen=100, sortbytime=Fa
             else:
                 searchfilter = Or(extensionfilter)
 
+    rangefilters = []
+    if min_size is not None or max_size is not None:
+        rangefilters.append(NumericRange("size", min_size, max_size))
+    if after is not None or before is not None:
+        rangefilters.append(DateRange("mtime", after, before))
+    if len(rangefilters) > 0:
+        if not isinstance(searcher.schema["size"], NUMERIC):
+            # The indexer has not migrated the index yet
+            log.warning('Size and date filters need the schema version 3, ignored')
+        elif searchfilter is not None:
+            searchfilter = And([searchfilter] + rangefilters)
+        else:
+            searchfilter = And(rangefilters)
+
     finalquery = Term("has_id", "a")  # Quicker than Every Query. See doc.
     if query is not None:
         finalquery = parser.parse(query)
     if searchfilter is not None:
         finalquery = And([finalquery, searchfilter])
 
+    # The servers offline for a long time are hidden
+    hidden_servers = [Term("server_id", str(server_id)) for server_id in persist.get_hidden_server_ids()]
+    if len(hidden_servers) > 0:
+        finalquery = AndNot(finalquery, Or(hidden_servers))
+
     if sortbytime:
         facet = sorting.FieldFacet("mtime", reverse=True)
         results = searcher.search_page(finalquery, pagenum, pagelen=pagelen, sortedby=facet)
@@ -95,8 +123,12 @@ def search(query, online=False, exts=None, pagenum=1, pagelen=100, sortbytime=Fa
                'url': 'ftp://%s%s' % (server_ip, result['path']),
                'size': int(result['size']),
                'mtime': ''}
-        if result['mtime'] is not None and result['mtime'] != 'None':
-            hit['mtime'] = datetime.strptime(result['mtime'], "%Y-%m-%d %H:%M:%S").strftime("%d/%m/%Y")
+        mtime = result.get('mtime')
+        if isinstance(mtime, datetime):
+            hit['mtime'] = mtime.strftime("%d/%m/%Y")
+        elif mtime is not None and mtime != 'None':
+            # Schema older than version 3
+            hit['mtime'] = datetime.strptime(mtime, "%Y-%m-%d %H:%M:%S").strftime("%d/%m/%Y")
 
         bIsAudio = False
         for extra in['audio_artist', 'audio_title', 'audio_album', 'audio_year']:
@@ -118,18 +150,18 @@ def search(query, online=False, exts=None, pagenum=1, pagelen=100, sortbytime=Fa
 
 def get_nb_files():
     nb_files = 0
-    for server in persist.get_servers():
+    for server in persist.get_servers(hidden=False):
         nb_files += server.get_nb_files()
     return nb_files
 
 
 def get_files_size():
     files_size = 0
-    for server in persist.get_servers():
+    for server in persist.get_servers(hidden=False):
         files_size += server.get_files_size()
     return files_size
 
 
 def get_servers():
     persist.expire_all()
-    return persist.get_servers()
+    return persist.get_servers(hidden=False)